@@ -0,0 +1,234 @@
+'''
+JSON REST API for machine-to-machine scoring, served by the Dash app's
+Flask server next to the UI.
+
+    POST /api/v1/predict
+        application/json: one profile object, a list of them or
+                          {"profiles": [...]}, keys are info_columns + metabolites
+        any other body / multipart "file": a table read by ingest.read_table
+
+    returns {"results": [{"info", "verdicts", "groups", "predictions", "models", "model_errors", "date"}, ...]},
+    "model_errors" - {"model name": "missing features: [...]"} for the models not scored,
+    "date" - the day ages are computed on for profiles without a sample date
+
+    GET /api/v1/reports/<report id>.html
+        static HTML report (html_report.py) of a report still in pipeline.result_cache,
+        any gunicorn worker finds it in the shared disk tier
+
+Concurrent requests are combined by a MicroBatcher: profiles that arrive
+within a few milliseconds go through prepare_cohort and every model in a
+single vectorized call.
+'''
+
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+from flask import Blueprint, current_app, jsonify, request
+
+import bio_df_processing as helper
+import get_main_figure as gmf
+import html_report
+import ingest
+import pipeline
+from model_registry import feature_matrix
+
+
+verdict_columns = ['Результат', 'Нижняя граница', 'Верхняя граница', 'Вывод']
+
+
+def records(df):
+    """
+    DataFrame -> list of dicts with NaN as None (valid JSON)
+    """
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def model_probabilities(profiles, n_patients):
+    """
+    returns list (one item per patient) of {'model name' : {'class' : probability}}
+    and list (one item per patient) of {'model name' : 'missing features: [...]'}
+    for the models a patient has no values of all features for
+    """
+    res = [dict() for _ in range(n_patients)]
+    errors = [dict() for _ in range(n_patients)]
+    # loads the models on first use when the app was not warmed up
+    helper.model_registry.load()
+    for name in helper.model_registry.specs:
+        if not helper.model_registry.is_loaded(name):
+            continue
+        data = feature_matrix(profiles, helper.model_registry.features(name), absent = 'nan')
+        complete = data.notna().all(axis = 1).to_numpy()
+        for row in np.flatnonzero(~complete):
+            errors[row][name] = f'missing features: {list(data.columns[data.iloc[row].isna().to_numpy()])}'
+        if not complete.any():
+            continue
+        proba = helper.model_registry.predict_proba(name, data[complete])
+        classes = [str(x) for x in helper.model_registry.get(name).classes_]
+        for row, p in zip(np.flatnonzero(complete), proba):
+            res[row][name] = dict(zip(classes, p.tolist()))
+    return res, errors
+
+
+def score(df):
+    """
+    df - wide table, one patient per row
+    returns list of JSON-ready results in the order of rows
+    """
+    df = df.reset_index(drop = True)
+    on = pipeline.analysis_date()
+    info, profiles, groups_content = helper.prepare_cohort(df, on)
+    models, model_errors = model_probabilities(profiles, len(df))
+
+    parts = gmf.cohort_parts(profiles).reindex(info.index, fill_value = 0.0)
+
+    results = []
+    for patient in info.index:
+        profile = helper.patient_profile(profiles, patient)
+        verdicts = profile[verdict_columns].rename_axis('Метаболит').reset_index()
+
+        predictions = dict()
+        predictions.update(helper.desease_prediction_cvd(profile))
+        predictions.update(helper.desease_prediction(profile))
+        predictions.update(helper.desease_prediction_lc(profile))
+
+        results.append({
+            'info' : records(info.loc[[patient]])[0],
+            'verdicts' : records(verdicts),
+            'groups' : {name.replace('\n', ' ') : part for name, part in parts.loc[patient].items()},
+            'predictions' : {k.replace('\n', ' ') : v for k, v in predictions.items()},
+            'models' : models[patient],
+            'model_errors' : model_errors[patient],
+            'date' : on,
+            })
+    return results
+
+
+class MicroBatcher:
+    """
+    collects tables submitted by concurrent requests for up to max_wait seconds
+    (or max_rows patients) and scores them with one process_batch call
+    """
+
+    def __init__(self, process_batch, max_rows = 512, max_wait = 0.005):
+        self.process_batch = process_batch
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # a thread started before gunicorn forked its workers does not exist in them
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target = self._run, name = 'api-batcher', daemon = True)
+                self._thread.start()
+
+    def submit(self, df):
+        """
+        returns Future with the list of results for df rows
+        """
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((df, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        rows = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_rows:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout = timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.batches += 1
+            self.items += len(batch)
+
+            # tables with different columns are scored separately, otherwise
+            # a metabolite missing in one table would become NaN in the other
+            by_columns = dict()
+            for df, future in batch:
+                by_columns.setdefault(frozenset(df.columns), []).append((df, future))
+
+            for group in by_columns.values():
+                try:
+                    results = self.process_batch(pd.concat([df for df, _ in group], ignore_index = True))
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                start = 0
+                for df, future in group:
+                    future.set_result(results[start:start + len(df)])
+                    start += len(df)
+
+
+batcher = MicroBatcher(score)
+
+blueprint = Blueprint('api', __name__)
+
+
+def request_table():
+    if request.is_json:
+        payload = request.get_json()
+        if isinstance(payload, dict):
+            payload = payload.get('profiles', [payload])
+        df = pd.DataFrame(payload)
+        return ingest.enforce_schema(df)
+
+    if 'file' in request.files:
+        upload = request.files['file']
+        return ingest.read_table(upload.read(), upload.filename)
+
+    return ingest.read_table(request.get_data(), request.args.get('filename'))
+
+
+@blueprint.route('/api/v1/predict', methods = ['POST'])
+def predict():
+    try:
+        df = request_table()
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error' : str(e)}), 400
+    if df.empty:
+        return jsonify({'results' : []})
+
+    try:
+        results = batcher.submit(df).result()
+    except Exception as e:
+        return jsonify({'error' : repr(e)}), 500
+    return jsonify({'results' : results})
+
+
+@blueprint.route('/api/v1/reports/<key>.html')
+def report(key):
+    result = pipeline.result_cache.get(key)
+    if result is None:
+        return jsonify({'error' : f'report {key} is not cached, upload the file again'}), 404
+    number = re.sub(r'[^\w.-]+', '_', str(result['info']['Номер'].iloc[0]))
+    response = current_app.response_class(html_report.render_report(result), mimetype = 'text/html')
+    response.headers['Content-Disposition'] = f'attachment; filename="report_{number}.html"'
+    return response
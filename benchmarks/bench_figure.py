@@ -0,0 +1,69 @@
+'''
+Render time and payload size of the main figure engines.
+
+    python -m benchmarks.bench_figure [--repeat 10]
+
+Every engine draws the same random part / part_dis inputs, the render
+cache is bypassed. Payload is what ends up in the callback response:
+base64 data URI for PNG / SVG, JSON for the Plotly figure.
+'''
+
+import argparse
+import base64
+import json
+import logging
+import statistics
+import time
+
+import numpy as np
+
+import get_main_figure as gmf
+
+
+def payload_size(engine, figure):
+    if engine == 'plotly':
+        return len(json.dumps(figure))
+    return len(base64.b64encode(figure))
+
+
+def bench_engine(engine, inputs):
+    render_engine, _ = gmf.engines[engine]
+    timings = []
+    sizes = []
+    for part, part_dis in inputs:
+        start = time.perf_counter()
+        figure = render_engine(part, part_dis)
+        timings.append(time.perf_counter() - start)
+        sizes.append(payload_size(engine, figure))
+    return {'engine' : engine,
+            'median_ms' : statistics.median(timings) * 1000,
+            'max_ms' : max(timings) * 1000,
+            'payload_kb' : statistics.mean(sizes) / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type = int, default = 10)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    # missing 'bahnschrift' font spams a warning per text box
+    logging.getLogger('matplotlib.font_manager').disabled = True
+
+    rng = np.random.default_rng(args.seed)
+    inputs = [(rng.integers(0, 100, len(gmf.groups2)).astype(float).tolist(),
+               rng.integers(0, 100, len(gmf.diseases)).astype(float).tolist())
+              for _ in range(args.repeat)]
+
+    # first matplotlib draw pays font cache initialisation
+    gmf.engines['png'][0](*inputs[0])
+
+    print(f"{'engine':<8}{'median ms':>12}{'max ms':>10}{'payload KB':>13}")
+    for engine in gmf.engines:
+        res = bench_engine(engine, inputs)
+        print(f"{res['engine']:<8}{res['median_ms']:>12.1f}{res['max_ms']:>10.1f}{res['payload_kb']:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Read time of the supported input formats on a large multi-patient export.
+
+    python -m benchmarks.bench_ingest [--patients 10000] [--workdir DIR]
+
+A synthetic cohort is built from TEST_test.xlsx and written once as
+xlsx / csv / tsv / parquet. Every file is then read with ingest.read_table
+(format detection + fastest reader + schema check) and, for reference,
+with the plain pd.read_excel used before.
+'''
+
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import ingest
+from bio_df_processing import info_columns
+
+
+def make_cohort(n_patients, seed = 0, template = 'TEST_test.xlsx'):
+    base = pd.read_excel(template)
+    metabolites = [x for x in base.columns if x not in info_columns]
+    rng = np.random.default_rng(seed)
+    df = pd.concat([base] * n_patients, ignore_index = True)
+    df['Номер'] = np.arange(n_patients)
+    df[metabolites] = df[metabolites].to_numpy(dtype = float) * rng.lognormal(0, 0.7, (n_patients, len(metabolites)))
+    return df
+
+
+writers = {'xlsx' : lambda df, fname: df.to_excel(fname, index = False),
+           'csv' : lambda df, fname: df.to_csv(fname, index = False),
+           'tsv' : lambda df, fname: df.to_csv(fname, sep = '\t', index = False),
+           'parquet' : lambda df, fname: df.to_parquet(fname, index = False)}
+
+
+def timed(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type = int, default = 10000)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--workdir', default = None, help = 'keep generated files here')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = 'bench_ingest_')
+    df = make_cohort(args.patients)
+
+    files = {}
+    for fmt, writer in writers.items():
+        fname = os.path.join(workdir, f'cohort_{args.patients}.{fmt}')
+        if not os.path.exists(fname):
+            try:
+                writer(df, fname)
+            except ImportError as e:
+                print(f'{fmt}: skipped, {e}')
+                continue
+        files[fmt] = fname
+
+    print(f'{args.patients} patients x {df.shape[1]} columns')
+    print(f"{'format':<10}{'reader':<28}{'size MB':>9}{'read s':>9}")
+    for fmt, fname in files.items():
+        with open(fname, 'rb') as f:
+            content = f.read()
+        size = len(content) / 2**20
+        if fmt == 'xlsx':
+            t = timed(lambda: pd.read_excel(io.BytesIO(content)), args.repeat)
+            print(f"{fmt:<10}{'pd.read_excel (before)':<28}{size:>9.1f}{t:>9.2f}")
+        t = timed(lambda: ingest.read_table(content, fname), args.repeat)
+        print(f"{fmt:<10}{'ingest.read_table':<28}{size:>9.1f}{t:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+'''
+Time and peak memory of the processing, prediction and rendering stages.
+
+    python -m benchmarks.bench_pipeline [--sizes 1 10 100 1000 10000] [--output results.json]
+    python -m benchmarks.bench_pipeline --save-baseline          # after a known good run
+    python -m benchmarks.bench_pipeline --baseline benchmarks/baseline.json --threshold 0.25
+
+Synthetic patients are generated from the reference range tables: every
+metabolite gets values spread from far below the lower to far above the
+upper bound, so all verdicts occur. Model features without a range get
+lognormal values.
+
+Cohort stages (prepare_cohort, add_analyse, predict:<model>) process all
+patients at once. Per-patient stages (prepare_data, add_all_ranges) loop
+over at most --per-patient-limit patients, the way uploads are processed.
+Per-upload stages (get_plot, render_png, parse_contents) do not depend on
+the cohort size and run once per --samples patients.
+
+The time of a stage is the best of --repeat runs, peak memory is measured
+in a separate run with tracemalloc. Against a baseline a stage regresses
+when its time or peak memory grows by more than --threshold, the exit code
+is 1 then.
+'''
+
+import argparse
+import base64
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import bio_df_processing as helper
+import get_main_figure as gmf
+
+
+default_baseline = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def make_profiles(n_patients, seed = 0):
+    """
+    returns wide table (info_columns + metabolites), one synthetic patient per row
+    """
+    rng = np.random.default_rng(seed)
+    ranges = helper.range_registry.table()
+
+    columns = {'ФИО' : [f'Пациент {i}' for i in range(n_patients)],
+               'Дата рождения' : [f'{d} января {y} года' for d, y in
+                                  zip(rng.integers(1, 29, n_patients), rng.integers(1940, 2005, n_patients))],
+               'Пол' : rng.choice(['Мужской', 'Женский'], n_patients),
+               'Номер' : np.arange(n_patients),
+               'Объект' : ['Плазма крови'] * n_patients}
+
+    lower = ranges['Нижняя граница'].to_numpy(dtype = float)
+    upper = ranges['Верхняя граница'].to_numpy(dtype = float)
+    # log-uniform from lower/10 to upper*10: Понижено ... Повышено,
+    # lower bound 0 counts as upper/100, metabolites without a range get lognormal values
+    lower = np.where(lower > 0, lower, upper / 100)
+    has_range = ~np.isnan(lower) & ~np.isnan(upper)
+    log_values = rng.normal(0, 1, (n_patients, len(ranges)))
+    log_values[:, has_range] = rng.uniform(np.log(lower[has_range] / 10), np.log(upper[has_range] * 10),
+                                           (n_patients, has_range.sum()))
+    values = pd.DataFrame(np.exp(log_values), columns = ranges.index)
+
+    features = []
+    for name in helper.model_registry.specs:
+        if helper.model_registry.is_loaded(name):
+            features += helper.model_registry.features(name)
+    # by canonical name: 'Gly' of one model is 'Глицин' of the range table
+    features = list(dict.fromkeys(helper.canonical_metabolites(features)))
+    extra = [x for x in features if x not in ranges.index]
+    values[extra] = rng.lognormal(0, 1, (n_patients, len(extra)))
+
+    # a few missing measurements as in real exports, model features are
+    # kept complete so that every patient is scored
+    missing = rng.random(values.shape) < 0.01
+    missing[:, values.columns.isin(features)] = False
+    values = values.mask(missing)
+
+    return pd.concat([pd.DataFrame(columns), values], axis = 1)
+
+
+def patient_table(df, i):
+    return df.iloc[[i]].reset_index(drop = True)
+
+
+def upload_contents(df):
+    buf = io.BytesIO()
+    df.to_excel(buf, index = False)
+    return ('data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,'
+            + base64.b64encode(buf.getvalue()).decode('ascii'))
+
+
+def cohort_stages(df, per_patient_limit):
+    """
+    returns {'stage' : (function, patients processed)} for a cohort
+    """
+    n_loop = min(len(df), per_patient_limit)
+    patients = [patient_table(df, i) for i in range(n_loop)]
+
+    def transposed(raw):
+        values = raw.drop(helper.info_columns, axis = 1).T
+        values.columns = ['Результат']
+        values.index = values.index.str.strip()
+        return values
+    raw_profiles = [transposed(x) for x in patients]
+
+    _, profiles, _ = helper.prepare_cohort(df)
+    bounds = profiles[['Результат', 'Нижняя граница', 'Верхняя граница']]
+
+    stages = {'prepare_cohort' : (lambda: helper.prepare_cohort(df), len(df)),
+              'add_analyse' : (lambda: helper.add_analyse(bounds), len(df)),
+              'prepare_data' : (lambda: [helper.prepare_data(x) for x in patients], n_loop),
+              'add_all_ranges' : (lambda: [helper.add_all_ranges(x.copy()) for x in raw_profiles], n_loop)}
+
+    for name in helper.model_registry.specs:
+        if helper.model_registry.is_loaded(name):
+            stages[f'predict:{name}'] = (lambda name = name: helper.model_registry.predict_profiles(name, profiles),
+                                         len(df))
+    return stages
+
+
+def upload_stages(df):
+    """
+    returns {'stage' : (function, uploads processed)}, df - one patient per upload
+    """
+    # synthetic patients stay out of the history and stores of the user
+    store_dir = tempfile.mkdtemp(prefix = 'bench_pipeline_')
+    os.environ['BIO_HISTORY_DB'] = os.path.join(store_dir, 'history.sqlite')
+    os.environ['BIO_JOBS_DB'] = os.path.join(store_dir, 'jobs.sqlite')
+    os.environ['BIO_RESULT_CACHE_DIR'] = os.path.join(store_dir, 'results')
+    os.environ['BIO_IMAGE_DIR'] = os.path.join(store_dir, 'images')
+    import dash_app
+    import pipeline
+    from result_cache import ResultCache
+
+    patients = [patient_table(df, i) for i in range(len(df))]
+    profiles = [helper.prepare_data(x)[1] for x in patients]
+    contents = [upload_contents(x) for x in patients]
+    parts = [gmf.get_parts(x) for x in profiles]
+
+    def get_plot():
+        for profile in profiles:
+            gmf.get_plot(profile)
+
+    def render_png():
+        for part in parts:
+            gmf.matplotlib_bytes(part, gmf.default_part_dis, 'png')
+
+    def parse_contents():
+        for i, x in enumerate(contents):
+            # measure the work, not the result / figure caches
+            pipeline.result_cache = ResultCache(max_bytes = 0)
+            gmf.figure_cache.clear()
+            dash_app.parse_contents(x, f'patient_{i}.xlsx', 0)
+
+    return {'get_plot' : (get_plot, len(df)),
+            'render_png' : (render_png, len(df)),
+            'parse_contents' : (parse_contents, len(df))}
+
+
+def measure(func, repeat):
+    """
+    returns (best seconds, peak bytes)
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def run(sizes, repeat, per_patient_limit, samples, seed = 0):
+    results = {}
+
+    def record(key, stage, scale, count, func):
+        seconds, peak = measure(func, repeat)
+        results[key] = {'stage' : stage,
+                        'scale' : scale,
+                        'count' : count,
+                        'seconds' : seconds,
+                        'per_item_ms' : seconds / count * 1000,
+                        'peak_mb' : peak / 2**20}
+        res = results[key]
+        print(f"{key:<40}{res['seconds']:>10.4f}{res['per_item_ms']:>12.3f}{res['peak_mb']:>10.1f}", flush = True)
+
+    print(f"{'stage/patients':<40}{'seconds':>10}{'ms/item':>12}{'peak MB':>10}")
+    for n in sizes:
+        df = make_profiles(n, seed)
+        for stage, (func, count) in cohort_stages(df, per_patient_limit).items():
+            record(f'{stage}/{n}', stage, n, count, func)
+
+    df = make_profiles(samples, seed + 1)
+    stages = upload_stages(df)
+    # the first matplotlib draw builds the font cache
+    gmf.matplotlib_bytes([0.0] * len(gmf.groups2), gmf.default_part_dis, 'png')
+    for stage, (func, count) in stages.items():
+        record(f'{stage}/upload', stage, 'upload', count, func)
+
+    return results
+
+
+def environment():
+    import matplotlib
+    try:
+        # only needed to export models (tree_ensemble.py)
+        import sklearn
+        sklearn_version = sklearn.__version__
+    except ImportError:
+        sklearn_version = None
+    return {'date' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpus' : os.cpu_count(),
+            'numpy' : np.__version__,
+            'pandas' : pd.__version__,
+            'matplotlib' : matplotlib.__version__,
+            'sklearn' : sklearn_version}
+
+
+def compare(results, baseline, threshold, min_seconds = 0.005, min_mb = 0.5):
+    """
+    returns list of regression messages,
+    differences below min_seconds / min_mb are timer and allocator noise
+    """
+    regressions = []
+    print(f"\n{'stage/patients':<40}{'time':>10}{'memory':>10}")
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        time_ratio = res['seconds'] / base['seconds'] if base['seconds'] else 1
+        memory_ratio = res['peak_mb'] / base['peak_mb'] if base['peak_mb'] else 1
+        flag = ''
+        if time_ratio > 1 + threshold and res['seconds'] - base['seconds'] > min_seconds:
+            regressions.append(f'{key}: {base["seconds"]:.4f} s -> {res["seconds"]:.4f} s')
+            flag = '  slower'
+        if memory_ratio > 1 + threshold and res['peak_mb'] - base['peak_mb'] > min_mb:
+            regressions.append(f'{key}: {base["peak_mb"]:.1f} MB -> {res["peak_mb"]:.1f} MB')
+            flag += '  more memory'
+        print(f'{key:<40}{time_ratio:>9.2f}x{memory_ratio:>9.2f}x{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1, 10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--per-patient-limit', type = int, default = 1000)
+    parser.add_argument('--samples', type = int, default = 3, help = 'uploads for per-upload stages')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = None, help = 'write results JSON here')
+    parser.add_argument('--baseline', default = None, help = 'compare with this results JSON')
+    parser.add_argument('--save-baseline', nargs = '?', const = default_baseline, default = None,
+                        help = f'write results as the baseline, {default_baseline} by default')
+    parser.add_argument('--threshold', type = float, default = 0.25,
+                        help = 'allowed relative growth of time / peak memory')
+    args = parser.parse_args()
+
+    # missing 'bahnschrift' font spams a warning per text box
+    logging.getLogger('matplotlib.font_manager').disabled = True
+
+    helper.range_registry.load()
+    helper.model_registry.load()
+    for name, error in helper.model_registry.errors.items():
+        print(f'predict:{name} skipped, {error}')
+
+    results = run(args.sizes, args.repeat, args.per_patient_limit, args.samples, args.seed)
+    report = {'environment' : environment(),
+              'config' : {'repeat' : args.repeat,
+                          'per_patient_limit' : args.per_patient_limit,
+                          'samples' : args.samples,
+                          'seed' : args.seed},
+              'results' : results}
+
+    for fname in (args.output, args.save_baseline):
+        if fname:
+            with open(fname, 'w', encoding = 'utf8') as f:
+                json.dump(report, f, ensure_ascii = False, indent = 1)
+
+    if args.baseline:
+        with open(args.baseline, encoding = 'utf8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print(f"baseline config {baseline.get('config')} differs from {report['config']}")
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regressions over {args.threshold:.0%}:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('\nno regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Cold start of the app: import time broken down by package, warm-up time
+and resident memory, every run in a fresh interpreter.
+
+    python -m benchmarks.bench_startup [--module dash_app] [--top 15] [--output startup.json]
+    python -m benchmarks.bench_startup --save-baseline          # after a known good run
+    python -m benchmarks.bench_startup --baseline benchmarks/startup_baseline.json --threshold 0.25
+
+The breakdown is the self time of every imported module (python -X
+importtime) summed by top level package, import time itself is measured
+without -X importtime. warm_up is dash_app.warm_up(): reference ranges,
+models and the first figure. Against a baseline the import and warm-up
+times and memory are compared like in bench_pipeline, the exit code is 1
+on a regression.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.bench_pipeline import compare, environment
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_baseline = os.path.join(os.path.dirname(__file__), 'startup_baseline.json')
+
+# runs in the child interpreter, prints one JSON line
+child = '''
+import json, logging, resource, sys, time
+logging.getLogger('matplotlib.font_manager').disabled = True
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+rss_import = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+{warm_up}
+warm = time.perf_counter()
+rss_warm = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'import' : imported - start, 'warm_up' : warm - imported,
+                  'rss_import' : rss_import / 2**10, 'rss_warm' : rss_warm / 2**10,
+                  'modules' : len(sys.modules)}}))
+'''
+
+
+def run_child(module, warm_up, importtime = False):
+    """
+    returns (child JSON, stderr)
+    """
+    code = child.format(module = module, warm_up = f'{module}.warm_up()' if warm_up else 'pass')
+    cmd = [sys.executable, '-W', 'ignore'] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    proc = subprocess.run(cmd, cwd = root, capture_output = True, text = True, check = True)
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def import_breakdown(stderr):
+    """
+    -X importtime output -> {'top level package' : seconds of self time}, largest first
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1e6
+    return dict(sorted(packages.items(), key = lambda x: -x[1]))
+
+
+def run(module, repeat, top):
+    runs = [run_child(module, warm_up = True)[0] for _ in range(repeat)]
+    best = {key : min(x[key] for x in runs) for key in ('import', 'warm_up', 'rss_import', 'rss_warm')}
+    _, stderr = run_child(module, warm_up = False, importtime = True)
+    packages = import_breakdown(stderr)
+
+    results = {f'import/{module}' : {'seconds' : best['import'], 'peak_mb' : best['rss_import']},
+               f'warm_up/{module}' : {'seconds' : best['warm_up'], 'peak_mb' : best['rss_warm']}}
+    for package, seconds in list(packages.items())[:top]:
+        results[f'package/{package}'] = {'seconds' : seconds, 'peak_mb' : 0}
+
+    print(f"{'phase':<40}{'seconds':>10}{'RSS MB':>10}")
+    for key, res in results.items():
+        rss = f"{res['peak_mb']:>10.1f}" if res['peak_mb'] else ''
+        print(f"{key:<40}{res['seconds']:>10.4f}{rss}")
+    print(f"{runs[0]['modules']} modules imported, package times are self times under -X importtime")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default = 'dash_app', help = 'module with a warm_up() function')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--top', type = int, default = 15, help = 'packages shown in the breakdown')
+    parser.add_argument('--output', default = None, help = 'write results JSON here')
+    parser.add_argument('--baseline', default = None, help = 'compare with this results JSON')
+    parser.add_argument('--save-baseline', nargs = '?', const = default_baseline, default = None,
+                        help = f'write results as the baseline, {default_baseline} by default')
+    parser.add_argument('--threshold', type = float, default = 0.25,
+                        help = 'allowed relative growth of time / memory')
+    args = parser.parse_args()
+
+    results = run(args.module, args.repeat, args.top)
+    report = {'environment' : environment(),
+              'config' : {'module' : args.module, 'repeat' : args.repeat},
+              'results' : results}
+
+    for fname in (args.output, args.save_baseline):
+        if fname:
+            with open(fname, 'w', encoding = 'utf8') as f:
+                json.dump(report, f, ensure_ascii = False, indent = 1)
+
+    if args.baseline:
+        with open(args.baseline, encoding = 'utf8') as f:
+            baseline = json.load(f)
+        # the package breakdown explains a regression, it is not checked itself
+        checked = {k : v for k, v in results.items() if not k.startswith('package/')}
+        regressions = compare(checked, baseline['results'], args.threshold, min_seconds = 0.05, min_mb = 5)
+        if regressions:
+            print(f'\n{len(regressions)} regressions over {args.threshold:.0%}:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('\nno regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+'''
+Headless batch screening: prepare_data + desease_prediction_* over many files.
+
+    bio-batch INPUT [INPUT ...] -o OUT_DIR [--jobs N] [--format parquet|csv] [--html] [--date YYYY-MM-DD]
+
+INPUT is a directory (every supported table inside), a file or a glob
+pattern. Files are processed in parallel, one file per worker process.
+For every input OUT_DIR gets
+
+    patients/<file hash>/<row>_<Номер>.csv   profile of every patient
+    summaries/<file hash>.<format>            one row per patient
+    reports/<file hash>/<row>_<Номер>.html    static report of every patient (--html)
+
+and summary.<format> combines all summaries. Inputs whose content hash is
+already listed in OUT_DIR/manifest.json are skipped. Patients without a
+sample date ('Дата забора') are aged on --date, today by default; an input
+whose output depended on that date (age stratified ranges) is skipped only
+for the same --date.
+'''
+
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import bio_df_processing as helper
+import get_main_figure as gmf
+import html_report
+import ingest
+
+
+input_extensions = ('.xlsx', '.xls', '.csv', '.tsv', '.tab', '.parquet')
+
+verdict_names = ['Норма', 'Риск повышения', 'Риск понижения', 'Повышено', 'Понижено']
+
+
+def find_inputs(patterns):
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = sorted(os.listdir(pattern))
+            files += [os.path.join(pattern, x) for x in names
+                      if x.lower().endswith(input_extensions) and not x.startswith('~$')]
+        else:
+            files += sorted(x for x in glob.glob(pattern) if os.path.isfile(x))
+    # same file given twice
+    return list(dict.fromkeys(os.path.abspath(x) for x in files))
+
+
+def file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def safe_name(value):
+    return re.sub(r'[^\w.-]+', '_', str(value)).strip('_') or 'none'
+
+
+def write_table(df, fname, fmt):
+    if fmt == 'parquet':
+        df.to_parquet(fname, index = False)
+    else:
+        df.to_csv(fname, index = False)
+
+
+def read_table(fname, fmt):
+    if fmt == 'parquet':
+        return pd.read_parquet(fname)
+    return pd.read_csv(fname)
+
+
+def summarize(fname, info, profiles):
+    """
+    one row per patient: info, verdict counts, group percentages and predictions
+    """
+    rows = []
+    verdicts = profiles['Вывод'].groupby(level = 'Пациент').value_counts().unstack(fill_value = 0)
+    verdicts = verdicts.reindex(columns = verdict_names, fill_value = 0)
+    parts = gmf.cohort_parts(profiles).reindex(info.index, fill_value = 0.0)
+    for patient in info.index:
+        profile = helper.patient_profile(profiles, patient)
+
+        row = {'Файл' : os.path.basename(fname), 'Пациент' : patient}
+        row.update(info.loc[patient].to_dict())
+        row.update({f'Вывод: {k}' : int(v) for k, v in verdicts.loc[patient].items()})
+        row.update(parts.loc[patient].to_dict())
+        row.update(helper.desease_prediction_cvd(profile))
+        row.update(helper.desease_prediction(profile))
+        row.update(helper.desease_prediction_lc(profile))
+        rows.append(row)
+
+    summary = pd.DataFrame(rows)
+    # names with line breaks are figure labels, not column names
+    summary.columns = [str(x).replace('\n', ' ') for x in summary.columns]
+    return summary
+
+
+def write_report(fname, info, profile, groups_content):
+    report = html_report.report_html(info, profile, groups_content,
+                                     helper.desease_prediction_cvd(profile),
+                                     helper.desease_prediction(profile),
+                                     helper.desease_prediction_lc(profile))
+    with open(fname, 'w', encoding = 'utf8') as f:
+        f.write(report)
+
+
+def process_file(fname, digest, out_dir, fmt, html = False, on = None):
+    """
+    runs in a worker process, returns number of patients and the date the
+    output depends on (bio_df_processing.age_date(), None - none)
+    """
+    df = ingest.read_file(fname)
+    info, profiles, groups_content = helper.prepare_cohort(df, on)
+
+    patients_dir = os.path.join(out_dir, 'patients', digest)
+    os.makedirs(patients_dir, exist_ok = True)
+    reports_dir = os.path.join(out_dir, 'reports', digest)
+    if html:
+        os.makedirs(reports_dir, exist_ok = True)
+    for patient in info.index:
+        profile = helper.patient_profile(profiles, patient)
+        name = f"{safe_name(patient)}_{safe_name(info.loc[patient, 'Номер'])}"
+        profile.rename_axis('Метаболит').to_csv(os.path.join(patients_dir, name + '.csv'))
+        if html:
+            write_report(os.path.join(reports_dir, name + '.html'), info.loc[[patient]], profile, groups_content)
+
+    summary = summarize(fname, info, profiles)
+    write_table(summary, os.path.join(out_dir, 'summaries', f'{digest}.{fmt}'), fmt)
+
+    return len(info), helper.age_date(df, on)
+
+
+def load_manifest(out_dir):
+    fname = os.path.join(out_dir, 'manifest.json')
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, encoding = 'utf8') as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+    fname = os.path.join(out_dir, 'manifest.json')
+    with open(fname + '.tmp', 'w', encoding = 'utf8') as f:
+        json.dump(manifest, f, ensure_ascii = False, indent = 1)
+    os.replace(fname + '.tmp', fname)
+
+
+def run(inputs, out_dir, jobs = None, fmt = 'parquet', force = False, html = False, on = None):
+    """
+    on - date of the ages ('YYYY-MM-DD'), today by default
+    returns dict with processed / skipped / failed counts and throughput
+    """
+    on = on or datetime.date.today().isoformat()
+    os.makedirs(os.path.join(out_dir, 'summaries'), exist_ok = True)
+    manifest = load_manifest(out_dir)
+
+    start = time.perf_counter()
+    todo = []
+    skipped = 0
+    for fname in inputs:
+        digest = file_hash(fname)
+        done = manifest.get(digest)
+        summary_file = os.path.join(out_dir, 'summaries', f'{digest}.{fmt}')
+        reports_dir = os.path.join(out_dir, 'reports', digest)
+        if (not force and done is not None and done.get('date') in (None, on) and os.path.exists(summary_file)
+                and (not html or os.path.isdir(reports_dir))):
+            skipped += 1
+            continue
+        if any(digest == d for _, d in todo):
+            # identical copy of a file already queued
+            skipped += 1
+            continue
+        todo.append((fname, digest))
+
+    patients = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+        futures = {pool.submit(process_file, fname, digest, out_dir, fmt, html, on) : (fname, digest)
+                   for fname, digest in todo}
+        for future in as_completed(futures):
+            fname, digest = futures[future]
+            try:
+                n, date = future.result()
+            except Exception as e:
+                failed.append(fname)
+                print(f'{fname}: {e!r}', file = sys.stderr)
+                continue
+            patients += n
+            manifest[digest] = {'file' : fname, 'patients' : n, 'date' : date}
+            save_manifest(out_dir, manifest)
+
+    summaries = [read_table(os.path.join(out_dir, 'summaries', f'{digest}.{fmt}'), fmt)
+                 for digest in manifest
+                 if os.path.exists(os.path.join(out_dir, 'summaries', f'{digest}.{fmt}'))]
+    if summaries:
+        write_table(pd.concat(summaries, ignore_index = True),
+                    os.path.join(out_dir, f'summary.{fmt}'), fmt)
+
+    elapsed = time.perf_counter() - start
+    return {'processed' : len(todo) - len(failed),
+            'skipped' : skipped,
+            'failed' : len(failed),
+            'patients' : patients,
+            'seconds' : elapsed,
+            'files_per_s' : (len(todo) - len(failed)) / elapsed,
+            'patients_per_s' : patients / elapsed}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'bio-batch', description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs = '+', help = 'directory, file or glob pattern')
+    parser.add_argument('-o', '--out', required = True, help = 'output directory')
+    parser.add_argument('-j', '--jobs', type = int, default = None,
+                        help = 'worker processes, all cores by default')
+    parser.add_argument('--format', choices = ['parquet', 'csv'],
+                        default = 'parquet' if ingest.has_module('pyarrow') else 'csv')
+    parser.add_argument('--force', action = 'store_true', help = 'reprocess already processed inputs')
+    parser.add_argument('--html', action = 'store_true',
+                        help = f'write a static HTML report of every patient, main figure engine '
+                               f'BIO_REPORT_ENGINE ({html_report.REPORT_ENGINE})')
+    parser.add_argument('--date', type = lambda x: datetime.date.fromisoformat(x).isoformat(), default = None,
+                        help = 'date patients without a sample date are aged on, today by default')
+    args = parser.parse_args(argv)
+
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        parser.error('no input files found')
+
+    stats = run(inputs, args.out, args.jobs, args.format, args.force, args.html, args.date)
+    print(f"{stats['processed']} processed, {stats['skipped']} skipped, {stats['failed']} failed: "
+          f"{stats['patients']} patients in {stats['seconds']:.1f} s "
+          f"({stats['files_per_s']:.1f} files/s, {stats['patients_per_s']:.1f} patients/s)")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,16 +4,26 @@ Created on 2 окт. 2022 г.
 @author: Alex
 '''
 
+import datetime
+import os
+import re
+
 import numpy as np
 import pandas as pd
 import pickle
-from sklearn import metrics
-from sklearn import preprocessing
+
+from range_registry import RangeRegistry, StratifiedRanges, sex_code
+from model_registry import ModelRegistry, feature_matrix
+from metabolites import metabolite_registry
+import metrics
 
 
 
 info_columns = ['ФИО', 'Дата рождения', 'Пол', 'Номер', 'Объект' ]
 
+# optional info column: the day the sample was taken, patient ages are computed on it
+sample_date_column = 'Дата забора'
+
 model_requirements = ['Глицин', 'Аспаргиновая кислота', 'Лизин', 'АДМА', 'АДМА/Аргинин', 'Холин (свободный)', 'Карнитин (С0)',
          'Acetylcarnitine (С2)', 'Propionylcarnitine (С3)',
          'Tiglylcarnitine (C5:1)', 'Isovalerylcarnitine (iC5)', 'Hydroxyisovalerylcarnitine (iC5-OH)',
@@ -48,96 +58,358 @@ model_requirements2 = ['Пролин',
  'Indole-3-propionate',
  'Kynurenic acid']
 
-groups = {'Аминокислоты' : r'aminoacids_range.xlsx',
-          'Ацилкарнитины' : r'acillcarnitine_range.xlsx',
-          'Триптофаны' : r'triptofanes_range.xlsx',
-          'Свободный холин и СДМА' : r'holin_range.xlsx'}
+# range and model files are installed next to this module, not looked up in the CWD
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# directory of the range files, e.g. the empirical ranges written by cohort_stats.py
+RANGE_DIR = os.environ.get('BIO_RANGE_DIR') or DATA_DIR
+
+# directory of the model / scaler pickles and their exported .npz arrays
+MODEL_DIR = os.environ.get('BIO_MODEL_DIR') or DATA_DIR
+
+groups = {'Аминокислоты' : os.path.join(RANGE_DIR, r'aminoacids_range.xlsx'),
+          'Ацилкарнитины' : os.path.join(RANGE_DIR, r'acillcarnitine_range.xlsx'),
+          'Триптофаны' : os.path.join(RANGE_DIR, r'triptofanes_range.xlsx'),
+          'Свободный холин и СДМА' : os.path.join(RANGE_DIR, r'holin_range.xlsx')}
+
+range_registry = RangeRegistry(groups)
+
+models = {'RF_model_1711' : {'model' : os.path.join(MODEL_DIR, r'RF_model_1711.pkl'),
+                             'scaler' : os.path.join(MODEL_DIR, r'first_scaler1911.pkl'),
+                             'features' : model_requirements},
+          'RF_second_model_1911' : {'model' : os.path.join(MODEL_DIR, r'RF_second_model_1911.pkl'),
+                                    'scaler' : os.path.join(MODEL_DIR, r'scaler1911.pkl'),
+                                    'features' : model_requirements2},
+          'GrBoost_cardio' : {'model' : os.path.join(MODEL_DIR, r'GrBoost_cardio.pkl'),
+                              'scaler' : None,
+                              'features' : None}}
+
+model_registry = ModelRegistry(models)
+
+# model features are metabolites even without a reference range
+metabolite_registry.register(model_requirements + model_requirements2)
+
+# range table version -> (lower, upper, group) arrays indexed by metabolite id
+_range_arrays = {}
+
+# range table version -> StratifiedRanges or None without stratified rows
+_range_strata = {}
 
-groups_content = {'Аминокислоты' : [],
-          'Ацилкарнитины' : [],
-          'Триптофаны' : [],
-          'Свободный холин и СДМА' : []}
+months = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+          'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря']
 
 
 def extract_info(df):
-    info_df = df[info_columns].copy()
+    columns = info_columns + ([sample_date_column] if sample_date_column in df.columns else [])
+    info_df = df[columns].copy()
     return info_df
 
 
+def range_arrays():
+    """
+    returns lower bounds, upper bounds and group numbers (position in groups, -1 - none)
+    indexed by metabolite id; the extra last item answers id -1 (unknown metabolite)
+    """
+    table = range_registry.table()
+    version = range_registry.version()
+    cached = _range_arrays.get(version)
+    if cached is not None and len(cached[0]) == len(metabolite_registry) + 1:
+        return cached
+
+    # range table spellings are the canonical names
+    ids = metabolite_registry.register(table.index, canonical = True)
+    n = len(metabolite_registry)
+    lower = np.full(n + 1, np.nan)
+    upper = np.full(n + 1, np.nan)
+    group = np.full(n + 1, -1)
+    lower[ids] = table['Нижняя граница'].to_numpy(dtype = float)
+    upper[ids] = table['Верхняя граница'].to_numpy(dtype = float)
+    group[ids] = [list(groups).index(x) for x in table['Группа']]
+
+    _range_arrays.clear()
+    _range_arrays[version] = (lower, upper, group)
+    return lower, upper, group
+
+
+def range_strata():
+    """
+    returns StratifiedRanges of the stratified range rows, None if there are none
+    """
+    strata = range_registry.strata()
+    version = range_registry.version()
+    if version in _range_strata:
+        return _range_strata[version]
+
+    lookup = None
+    if len(strata):
+        range_arrays()
+        lookup = StratifiedRanges(metabolite_registry.ids(strata.index), sex_code(strata['Пол']),
+                                  pd.to_numeric(strata['Возраст от']), pd.to_numeric(strata['Возраст до']),
+                                  strata['Нижняя граница'], strata['Верхняя граница'])
+    _range_strata.clear()
+    _range_strata[version] = lookup
+    return lookup
+
+
+def parse_date(value):
+    """
+    '1 января 1980 года', '01.01.1980', datetime -> Timestamp, NaT if not a date
+    """
+    if isinstance(value, str):
+        match = re.search(r'(\d{1,2})\s+([а-яё]+)\s+(\d{4})', value.lower())
+        if match and match.group(2) in months:
+            day, month, year = match.groups()
+            return pd.Timestamp(int(year), months.index(month) + 1, int(day))
+    return pd.to_datetime(value, dayfirst = True, errors = 'coerce')
+
+
+def reference_dates(info, on = None):
+    """
+    info - patient info (extract_info()), on - the date recorded with the result
+    (today by default)
+    returns the date of every patient's age: its sample date where given, on otherwise
+    """
+    on = pd.Timestamp(on or datetime.date.today())
+    if sample_date_column not in info:
+        return pd.Series(on, index = info.index)
+    sampled = info[sample_date_column]
+    parsed = {x : parse_date(x) for x in sampled.dropna().unique()}
+    return pd.to_datetime(sampled.map(parsed)).fillna(on)
+
+
+def age_date(df, on = None):
+    """
+    df - table as read (info columns + metabolites), on - the date recorded with the result
+    returns on (today by default) when the ranges of df depend on it: the range tables are
+    stratified and some patient has no sample date; None otherwise
+    """
+    if range_strata() is None:
+        return None
+    if sample_date_column in df.columns and df[sample_date_column].map(parse_date).notna().all():
+        return None
+    return on or datetime.date.today().isoformat()
+
+
+def patient_age(birth_dates, on = None):
+    """
+    birth_dates - 'Дата рождения' values, on - date of the age, one date or one
+    per value (reference_dates()), today by default
+    returns array of ages in years, NaN for unparsed dates
+    """
+    birth_dates = pd.Series(birth_dates)
+    if on is None:
+        on = datetime.date.today()
+    on = pd.to_datetime(pd.Series(np.asarray(on) if np.ndim(on) else on, index = birth_dates.index))
+    # parse every distinct value once, cohorts repeat them a lot
+    parsed = {x : parse_date(x) for x in birth_dates.dropna().unique()}
+    dates = pd.to_datetime(birth_dates.map(parsed))
+    return ((on - dates).dt.days / 365.2425).to_numpy(dtype = float)
+
+
+def cell_ranges(ids, sex, age):
+    """
+    ids, sex, age - metabolite id, sex code and age of every patient x metabolite cell
+    returns lower, upper: bounds of the stratum of the patient, the global bounds otherwise
+    """
+    lower, upper, _ = range_arrays()
+    lower, upper = lower[ids], upper[ids]
+    strata = range_strata()
+    if strata is not None:
+        strata_lower, strata_upper, found = strata.lookup(ids, sex, age)
+        lower = np.where(found, strata_lower, lower)
+        upper = np.where(found, strata_upper, upper)
+    return lower, upper
+
+
+def canonical_metabolites(names):
+    """
+    names - metabolite headers as uploaded
+    returns Index of canonical names (range table spelling), see metabolites.py
+    """
+    range_arrays()
+    return pd.Index(metabolite_registry.canonical(names))
+
+
 def add_range(df, group_name):
-    ranges_fname = groups[group_name]
-    range_df = pd.read_excel(ranges_fname, index_col = 'Метаболит')
-    range_df.index = range_df.index.str.strip()
-    
-    existing = [x for x in range_df.index if (x in df.index)]
+    lower, upper, group = range_arrays()
     
-    groups_content[group_name] = existing
+    ids = metabolite_registry.ids(df.index)
+    existing = group[ids] == list(groups).index(group_name)
     
-    df['Нижняя граница'][existing] = range_df['Нижняя граница']
-    df['Верхняя граница'][existing] = range_df['Верхняя граница']
+    df.loc[existing, 'Нижняя граница'] = lower[ids[existing]]
+    df.loc[existing, 'Верхняя граница'] = upper[ids[existing]]
     
     return df
 
 
-def add_all_ranges(df):
-    df['Нижняя граница'] = np.nan
-    df['Верхняя граница'] = np.nan
-    
-    for grp in groups:
-        df = add_range(df, grp)
+def add_all_ranges(df, info = None, on = None):
+    """
+    info - patient info (extract_info()), selects the bounds of the patient's
+    sex and age where the range tables are stratified; on - see reference_dates()
+    """
+    # unknown metabolites (id -1) get the NaN bounds of the last item
+    ids = metabolite_registry.ids(df.index)
+    if info is not None and range_strata() is not None:
+        sex = np.repeat(sex_code(info['Пол'].iloc[:1]), len(ids))
+        age = np.repeat(patient_age(info['Дата рождения'].iloc[:1], reference_dates(info.iloc[:1], on)), len(ids))
+        lower, upper = cell_ranges(ids, sex, age)
+    else:
+        lower, upper, _ = range_arrays()
+        lower, upper = lower[ids], upper[ids]
+    df['Нижняя граница'] = lower
+    df['Верхняя граница'] = upper
     
     return df
 
 
+def get_groups_content(metabolites):
+    """
+    metabolites - index of a profile
+    returns dict: {'group name' : metabolites of the group present in the profile}
+    """
+    _, _, group = range_arrays()
+    present = set(metabolite_registry.ids(metabolites).tolist())
+    table_ids = metabolite_registry.ids(range_registry.table().index)
 
-def make_result_column(x):
-    if x[0] < x[2] < x[1]:
-        return 'Норма'
-    if x[2] / 5 < x[1] < x[2]:
-        return 'Риск повышения'
-    if x[2] * 5 > x[0] > x[2]:
-        return 'Риск понижения'
-    if x[2] / 5 > x[1]:
-        return 'Повышено'
-    else:
-        return 'Понижено'
+    groups_content = dict()
+    for i, grp in enumerate(groups):
+        groups_content[grp] = [metabolite_registry.names[x] for x in table_ids
+                               if group[x] == i and x in present]
+    return groups_content
+
+
+
+def analyse_values(lower, upper, result):
+    """
+    lower, upper, result - arrays of any broadcastable shape
+    (e.g. (n_metabolites,) bounds against (n_patients, n_metabolites) results)
+
+    returns dict of arrays: 'Вывод' and the relative deviation columns
+    """
+    lower, upper, result = np.broadcast_arrays(np.asarray(lower, dtype = float),
+                                               np.asarray(upper, dtype = float),
+                                               np.asarray(result, dtype = float))
+
+    # same rules and precedence as the former row-wise make_result_column,
+    # comparisons with NaN are False so rows without a range end up 'Понижено'
+    conditions = [(lower < result) & (result < upper),
+                  (result / 5 < upper) & (upper < result),
+                  (result * 5 > lower) & (lower > result),
+                  result / 5 > upper]
+    choices = ['Норма', 'Риск повышения', 'Риск понижения', 'Повышено']
+    conclusion = np.select(conditions, choices, default = 'Понижено').astype(object)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rel_up = result / upper
+        rel_down = lower / result
+
+    def between(values, left, right):
+        # Series.between semantics: both ends inclusive, NaN -> not selected
+        return np.where((values >= left) & (values <= right), values, np.nan)
+
+    return {'Вывод' : conclusion,
+            'Понижено' : between(rel_down, 5, np.inf),
+            'Риск понижения' : between(rel_down, 1, 5),
+            'Норма' : between(rel_up, 0, 1),
+            'Риск повышения' : between(rel_up, 1, 5),
+            'Повышено' : between(rel_up, 5, np.inf)}
 
 
 def add_analyse(df):
     existed_cols = df.columns.to_list()
-    df['Вывод'] = df[['Нижняя граница', 'Верхняя граница','Результат']].apply(make_result_column, axis=1)
-    
-    rel_up = df['Результат'] / df['Верхняя граница']
-    df['Риск повышения'] = rel_up.loc[rel_up.between(1, 5)]
-    df['Повышено'] = rel_up.loc[rel_up.between(5, np.inf)]
-    df['Норма'] = rel_up.loc[rel_up.between(0, 1)]
-    rel_down = df['Нижняя граница'] / df['Результат']
-    df['Риск понижения'] = rel_down.loc[rel_down.between(1, 5)]
-    df['Понижено'] = rel_down.loc[rel_down.between(5, np.inf)]
-    
-    new_cols = ['Вывод', 'Понижено', 'Риск понижения', 'Норма', 'Риск повышения', 'Повышено']  
-    
+
+    analysis = analyse_values(df['Нижняя граница'].to_numpy(dtype = float),
+                              df['Верхняя граница'].to_numpy(dtype = float),
+                              df['Результат'].to_numpy(dtype = float))
+
+    new_cols = ['Вывод', 'Понижено', 'Риск понижения', 'Норма', 'Риск повышения', 'Повышено']
+
+    df = df.copy()
+    for col in new_cols:
+        df[col] = analysis[col]
+
     df = df[existed_cols + new_cols]
-    
+
     return df
 
 
-def prepare_data(raw_dataframe):
+def prepare_data(raw_dataframe, on = None):
+    """
+    on - the date recorded with the result, the age of a patient without
+    a sample date is computed on it (see reference_dates())
+    """
     df = raw_dataframe
     
     info = extract_info(df)
     
     # prepare df for the next stage
-    df = df.drop(info_columns, axis = 1)
+    df = df.drop(info.columns, axis = 1)
     df = df.T
     df.columns = ['Результат']
-    df.index = df.index.str.strip()
+    df.index = canonical_metabolites(df.index)
     
-    df = add_all_ranges(df)
+    with metrics.stage('ranges'):
+        df = add_all_ranges(df, info, on)
     
-    df = add_analyse(df)
+    with metrics.stage('verdicts'):
+        df = add_analyse(df)
     
-    return info, df, groups_content
+    return info, df, get_groups_content(df.index)
+
+
+def prepare_cohort(raw_dataframe, on = None):
+    """
+    raw_dataframe - wide table with one patient per row (info_columns + metabolites),
+    on - see prepare_data()
+
+    returns info (one row per patient), profiles in long format indexed by
+    ('Пациент', 'Метаболит') and groups_content. Patient keys are the index
+    of raw_dataframe, so profiles.xs(key) matches prepare_data() for that row.
+    """
+    df = raw_dataframe
+
+    info = extract_info(df)
+
+    values = df.drop(info.columns, axis = 1)
+    metabolites = canonical_metabolites(values.columns)
+
+    n_patients = len(values)
+    with metrics.stage('ranges'):
+        if range_strata() is None:
+            # ranges depend only on the metabolite, resolve them once for the whole cohort
+            ranges = add_all_ranges(pd.DataFrame(index = metabolites))
+            lower = np.tile(ranges['Нижняя граница'].to_numpy(), n_patients)
+            upper = np.tile(ranges['Верхняя граница'].to_numpy(), n_patients)
+        else:
+            # one lookup for all patient x metabolite cells
+            ids = metabolite_registry.ids(metabolites)
+            lower, upper = cell_ranges(np.tile(ids, n_patients),
+                                       np.repeat(sex_code(info['Пол']), len(ids)),
+                                       np.repeat(patient_age(info['Дата рождения'], reference_dates(info, on)), len(ids)))
+
+    profiles = pd.DataFrame({
+        'Результат' : values.to_numpy(dtype = float).ravel(),
+        'Нижняя граница' : lower,
+        'Верхняя граница' : upper,
+        },
+        index = pd.MultiIndex.from_product([values.index, metabolites],
+                                           names = ['Пациент', 'Метаболит']))
+
+    with metrics.stage('verdicts'):
+        profiles = add_analyse(profiles)
+
+    return info, profiles, get_groups_content(metabolites)
+
+
+def patient_profile(profiles, patient):
+    """
+    profiles - 2nd result of prepare_cohort() function
+    returns the profile of one patient in the prepare_data() layout
+    """
+    profile = profiles.xs(patient, level = 'Пациент')
+    profile.index.name = None
+    return profile
+
 
 def desease_prediction_cvd(profile):
     res_cvd = dict()
@@ -149,14 +421,8 @@ def desease_prediction(profile):
     """
     profile - 2nd result of prepare_data() function
     """
-    # loaded_model = pickle.load(open('RF_model_1711.pkl', 'rb'))
-    # scaler_sv1 = pickle.load(open('first_scaler1911.pkl', 'rb')) 
-
-    # data1 = pd.DataFrame(profile['Результат'].T[model_requirements]).T
-    
-    # data1 = scaler_sv1.transform(data1)
-    # data1= preprocessing.normalize(data1, norm='l2')
-    # a = loaded_model.predict_proba(data1)
+    # data1 = feature_matrix(profile, model_requirements)
+    # a = model_registry.predict_proba('RF_model_1711', data1)
     # heart_des_proba = float(a[:,1])*100
     heart_des_proba=78
 
@@ -164,13 +430,8 @@ def desease_prediction(profile):
     # res['ССЗ'] = heart_des_proba
     
     if heart_des_proba >= 70:
-        # loaded_model2 = pickle.load(open('RF_second_model_1911.pkl', 'rb'))
-        # scaler_sv2 = pickle.load(open('scaler1911.pkl', 'rb'))
-        
-        # data2 =  pd.DataFrame(profile['Результат'].T[model_requirements2]).T
-        # data2 = scaler_sv2.transform(data2)
-        # data2 = preprocessing.normalize(data2, norm='l2')
-        # c = loaded_model2.predict_proba(data2)
+        # data2 = feature_matrix(profile, model_requirements2)
+        # c = model_registry.predict_proba('RF_second_model_1911', data2)
         # GB_proba = float(c[:,1])*100
         # IBS_proba = float(c[:,0])*100
         GB_proba=68
@@ -192,14 +453,8 @@ def desease_prediction_lc(profile):
     """
     profile - 2nd result of prepare_data() function
     """
-    # loaded_model = pickle.load(open('RF_model_1711.pkl', 'rb'))
-    # scaler_sv1 = pickle.load(open('first_scaler1911.pkl', 'rb')) 
-
-    # data1 = pd.DataFrame(profile['Результат'].T[model_requirements]).T
-    
-    # data1 = scaler_sv1.transform(data1)
-    # data1= preprocessing.normalize(data1, norm='l2')
-    # a = loaded_model.predict_proba(data1)
+    # data1 = feature_matrix(profile, model_requirements)
+    # a = model_registry.predict_proba('RF_model_1711', data1)
     # heart_des_proba = float(a[:,1])*100
     lc_des_proba=6
     kc_des_proba=5
@@ -220,8 +475,10 @@ def desease_prediction_lc(profile):
 
 
 if __name__ == '__main__':
+    from ingest import read_file
+
     test_fname = r'TEST_test.xlsx'    
-    df = pd.read_excel(test_fname)
+    df = read_file(test_fname)
     
     info, profile, groups_content = prepare_data(df)
     print(groups_content)
@@ -233,8 +490,8 @@ if __name__ == '__main__':
     desease_cvd = desease_prediction_cvd(profile)
     print(desease_cvd)
     
-    categories = deseases.keys()
-    proba = deseases.values()
+    categories = desease_cvd.keys()
+    proba = desease_cvd.values()
     print(list(categories), list(proba))
     
     deseases = desease_prediction(profile)
@@ -0,0 +1,282 @@
+'''
+Streaming population statistics per metabolite.
+
+Profiles are consumed in chunks (wide tables, one patient per row); every
+metabolite keeps
+
+    moments   count, mean, variance (Chan's parallel update), min, max
+    sketch    counts of logarithmic buckets (DDSketch): a quantile is
+              returned within RELATIVE_ACCURACY of the true value
+
+Memory per metabolite is fixed by the bucket range, not by the number of
+profiles, and two CohortStats are merged by adding their arrays, so files
+can be processed separately (or in parallel) and combined afterwards.
+
+    python cohort_stats.py INPUT [INPUT ...] -o stats.npz [--merge old.npz]
+                           [--ranges-dir DIR --lower 2.5 --upper 97.5]
+
+--ranges-dir writes the range files (same names and layout as the
+*_range.xlsx tables) with the empirical percentiles as 'Нижняя граница' /
+'Верхняя граница'; BIO_RANGE_DIR=DIR makes add_all_ranges use them.
+'''
+
+import argparse
+import math
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import bio_df_processing as helper
+from range_registry import range_columns
+
+
+RELATIVE_ACCURACY = 0.01
+
+# values below MIN_VALUE (above MAX_VALUE) share the first (last) bucket,
+# zero and negative values have a bucket of their own
+MIN_VALUE = 1e-4
+MAX_VALUE = 1e6
+
+# rows added at once
+CHUNK_ROWS = 10000
+
+
+class CohortStats:
+
+    def __init__(self, relative_accuracy = RELATIVE_ACCURACY, min_value = MIN_VALUE, max_value = MAX_VALUE):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.offset = math.ceil(math.log(min_value, self.gamma))
+        # bucket 0 - values <= 0, bucket i - (gamma**(i+offset-2), gamma**(i+offset-1)]
+        self.n_buckets = math.ceil(math.log(max_value, self.gamma)) - self.offset + 2
+
+        self.names = []
+        self._rows = {}
+        self.counts = np.zeros((0, self.n_buckets), dtype = np.int64)
+        self.count = np.zeros(0, dtype = np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+
+    def _rows_of(self, names):
+        """
+        row of every metabolite, new metabolites get empty rows
+        """
+        new = [x for x in dict.fromkeys(names) if x not in self._rows]
+        if new:
+            for name in new:
+                self._rows[name] = len(self.names)
+                self.names.append(name)
+            n = len(new)
+            self.counts = np.vstack([self.counts, np.zeros((n, self.n_buckets), dtype = np.int64)])
+            self.count = np.concatenate([self.count, np.zeros(n, dtype = np.int64)])
+            self.mean = np.concatenate([self.mean, np.zeros(n)])
+            self.m2 = np.concatenate([self.m2, np.zeros(n)])
+            self.min = np.concatenate([self.min, np.full(n, np.inf)])
+            self.max = np.concatenate([self.max, np.full(n, -np.inf)])
+        return np.array([self._rows[x] for x in names], dtype = int)
+
+    def bucket(self, values):
+        """
+        bucket of every value (finite values only)
+        """
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            index = np.ceil(np.log(values) / math.log(self.gamma)) - self.offset + 1
+        index = np.clip(np.nan_to_num(index, nan = 1, posinf = self.n_buckets - 1, neginf = 1),
+                        1, self.n_buckets - 1)
+        return np.where(values > 0, index, 0).astype(int)
+
+    def _add(self, rows, counts, count, mean, m2, low, high):
+        """
+        merges per-metabolite statistics into the given rows
+        """
+        total = self.count[rows] + count
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            delta = mean - self.mean[rows]
+            new_mean = np.where(total > 0, self.mean[rows] + delta * count / total, 0)
+            new_m2 = self.m2[rows] + m2 + np.where(total > 0, delta**2 * self.count[rows] * count / total, 0)
+        self.counts[rows] += counts
+        self.count[rows] = total
+        self.mean[rows] = new_mean
+        self.m2[rows] = new_m2
+        self.min[rows] = np.minimum(self.min[rows], low)
+        self.max[rows] = np.maximum(self.max[rows], high)
+
+    def update(self, df):
+        """
+        df - wide table, one patient per row: metabolite columns (patient info
+        columns are skipped), NaN values are ignored
+        """
+        values = df.drop(columns = [x for x in helper.info_columns + [helper.sample_date_column] if x in df.columns])
+        names = helper.canonical_metabolites(values.columns)
+        if names.has_duplicates:
+            raise ValueError(f'duplicate metabolite columns: {sorted(set(names[names.duplicated()]))}')
+        rows = self._rows_of(list(names))
+        values = values.apply(pd.to_numeric, errors = 'coerce').to_numpy(dtype = float)
+
+        for start in range(0, len(values), CHUNK_ROWS):
+            chunk = values[start:start + CHUNK_ROWS]
+            valid = np.isfinite(chunk)
+            count = valid.sum(axis = 0)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean = np.where(count > 0, np.where(valid, chunk, 0).sum(axis = 0) / count, 0)
+                m2 = np.where(valid, (chunk - mean)**2, 0).sum(axis = 0)
+            low = np.where(valid, chunk, np.inf).min(axis = 0)
+            high = np.where(valid, chunk, -np.inf).max(axis = 0)
+
+            # one bincount over (column, bucket) pairs fills all sketches of the chunk
+            columns = np.broadcast_to(np.arange(chunk.shape[1]), chunk.shape)[valid]
+            flat = columns * self.n_buckets + self.bucket(chunk[valid])
+            counts = np.bincount(flat, minlength = chunk.shape[1] * self.n_buckets)
+            counts = counts.reshape(chunk.shape[1], self.n_buckets)
+
+            self._add(rows, counts, count, mean, m2, low, high)
+        return self
+
+    def merge(self, other):
+        """
+        adds the statistics of other (same bucket layout)
+        """
+        if (other.relative_accuracy, other.min_value, other.max_value) != \
+                (self.relative_accuracy, self.min_value, self.max_value):
+            raise ValueError('statistics with different sketch parameters can not be merged')
+        rows = self._rows_of(other.names)
+        self._add(rows, other.counts, other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    def bucket_values(self):
+        """
+        representative value of every bucket, 0 for the bucket of non-positive values
+        """
+        k = np.arange(self.n_buckets) + self.offset - 1
+        return np.where(np.arange(self.n_buckets) == 0, 0, 2 * self.gamma**k / (self.gamma + 1))
+
+    def quantiles(self, q):
+        """
+        q - list of quantiles in [0, 1]
+        returns DataFrame: one row per metabolite, one column per quantile (NaN without data)
+        """
+        q = np.atleast_1d(np.asarray(q, dtype = float))
+        cumulative = np.cumsum(self.counts, axis = 1)
+        ranks = q[None, :] * (self.count[:, None] - 1)
+        index = np.array([np.searchsorted(c, r, side = 'right') for c, r in zip(cumulative, ranks)])
+        index = np.clip(index.reshape(len(self.names), len(q)), 0, self.n_buckets - 1)
+        res = self.bucket_values()[index]
+        # the true minimum / maximum are known exactly
+        res = np.clip(res, self.min[:, None], self.max[:, None])
+        res[self.count == 0] = np.nan
+        return pd.DataFrame(res, index = pd.Index(self.names, name = 'Метаболит'), columns = list(q))
+
+    def percentile_rank(self, profile):
+        """
+        profile - 2nd result of prepare_data()
+        returns Series: percentile (0-100) of every 'Результат' in the population,
+        NaN for metabolites without statistics
+        """
+        values = profile['Результат'].to_numpy(dtype = float)
+        rows = np.array([self._rows.get(x, -1) for x in profile.index], dtype = int)
+        known = (rows >= 0) & np.isfinite(values)
+        known[known] = self.count[rows[known]] > 0
+
+        rows = rows[known]
+        buckets = self.bucket(values[known])
+        inside = self.counts[rows, buckets]
+        below = np.cumsum(self.counts, axis = 1)[rows, buckets] - inside
+        res = np.full(len(values), np.nan)
+        res[known] = (below + inside / 2) / self.count[rows] * 100
+        return pd.Series(res, index = profile.index, name = 'Перцентиль')
+
+    def summary(self, lower = 2.5, upper = 97.5):
+        """
+        returns DataFrame per metabolite: count, mean, std, min, max and the percentiles
+        as 'Нижняя граница' / 'Верхняя граница'
+        """
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            std = np.sqrt(self.m2 / (self.count - 1))
+        bounds = self.quantiles([lower / 100, upper / 100])
+        return pd.DataFrame({'count' : self.count,
+                             'mean' : np.where(self.count > 0, self.mean, np.nan),
+                             'std' : std,
+                             'min' : np.where(self.count > 0, self.min, np.nan),
+                             'max' : np.where(self.count > 0, self.max, np.nan),
+                             range_columns[0] : bounds.iloc[:, 0].to_numpy(),
+                             range_columns[1] : bounds.iloc[:, 1].to_numpy()},
+                            index = bounds.index)
+
+    def write_ranges(self, directory, lower = 2.5, upper = 97.5, min_count = 100):
+        """
+        writes every range file of bio_df_processing.groups to directory with the
+        percentile bounds; metabolites with fewer than min_count values keep the current bounds,
+        stratified rows (sex / age bands) are copied unchanged
+        """
+        os.makedirs(directory, exist_ok = True)
+        summary = self.summary(lower, upper)
+        summary = summary[summary['count'] >= min_count]
+        strata = helper.range_registry.strata()
+        for group_name, fname in helper.groups.items():
+            table = helper.range_registry.group(group_name).copy()
+            known = table.index.intersection(summary.index)
+            table.loc[known, range_columns] = summary.loc[known, range_columns].to_numpy()
+            table = pd.concat([table, strata.loc[strata['Группа'] == group_name].drop(columns = 'Группа')])
+            table = table.dropna(axis = 1, how = 'all')
+            table.index.name = 'Метаболит'
+            table.to_excel(os.path.join(directory, os.path.basename(fname)))
+
+    def save(self, fname):
+        np.savez_compressed(fname, names = np.array(self.names, dtype = str),
+                            params = np.array([self.relative_accuracy, self.min_value, self.max_value]),
+                            counts = self.counts, count = self.count, mean = self.mean, m2 = self.m2,
+                            min = self.min, max = self.max)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname, allow_pickle = False) as f:
+            stats = cls(*f['params'])
+            stats._rows_of(list(f['names']))
+            for key in ('counts', 'count', 'mean', 'm2', 'min', 'max'):
+                setattr(stats, key, f[key].copy())
+        return stats
+
+
+def main(argv = None):
+    import bio_batch
+    import ingest
+
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs = '*', help = 'directory, file or glob pattern')
+    parser.add_argument('-o', '--out', required = True, help = 'statistics file (.npz)')
+    parser.add_argument('--merge', nargs = '+', default = [], help = 'statistics files to add')
+    parser.add_argument('--ranges-dir', default = None, help = 'write range files with the percentile bounds')
+    parser.add_argument('--lower', type = float, default = 2.5, help = 'percentile of the lower bound')
+    parser.add_argument('--upper', type = float, default = 97.5, help = 'percentile of the upper bound')
+    parser.add_argument('--min-count', type = int, default = 100,
+                        help = 'fewer values keep the range table bounds')
+    args = parser.parse_args(argv)
+
+    stats = CohortStats()
+    for fname in args.merge:
+        stats.merge(CohortStats.load(fname))
+    files = bio_batch.find_inputs(args.inputs)
+    for fname in files:
+        try:
+            stats.update(ingest.read_file(fname))
+        except Exception as e:
+            print(f'{fname}: {e!r}', file = sys.stderr)
+    stats.save(args.out)
+
+    summary = stats.summary(args.lower, args.upper)
+    print(f'{len(files)} files, {len(summary)} metabolites, '
+          f'{int(summary["count"].max()) if len(summary) else 0} values at most')
+    if args.ranges_dir:
+        stats.write_ranges(args.ranges_dir, args.lower, args.upper, args.min_count)
+        print(f'range files written to {args.ranges_dir}, serve them with BIO_RANGE_DIR={args.ranges_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,16 +5,18 @@ Created on 24 09. 2022
 
 @author: Alex
 '''
-import base64
 from dash import Dash
 
 from dash import dcc
 from dash import html
 from dash import dash_table
-from dash.dependencies import Input, Output, State
+from dash import ctx, no_update
+from dash.dependencies import Input, Output, State, MATCH
 
-import io
-from io import BytesIO
+import math
+import os
+import time
+import uuid
 
 # import numpy as np
 import pandas as pd
@@ -22,13 +24,31 @@ import pandas as pd
 from dash_table.Format import Format, Scheme
 
 
-import bio_df_processing as helper
 import get_main_figure as gmf
+import pipeline
+import api
+import history
+import image_store
+import jobs
+import metrics
+from session_store import SessionStore
 
 
 app = Dash(__name__, 
            meta_tags=[{"name": "viewport", "content": "width=device-width"}])
 
+# WSGI entry point: gunicorn -c gunicorn.conf.py dash_app:server
+server = app.server
+
+# JSON scoring API for LIS integrations, see api.py
+server.register_blueprint(api.blueprint)
+
+# rendered main figures by content hash, see image_store.py
+server.register_blueprint(image_store.blueprint)
+
+# request timings and Prometheus /metrics, BIO_PROFILE_DIR=dir dumps a cProfile per request
+metrics.instrument(server)
+
 
 # Colors
 bgcolor = "#f3f3f1"  # mapbox light map land color
@@ -38,6 +58,23 @@ bar_color = "#546e7a"  # material blue-gray 600
 bar_selected_color = "#37474f"  # material blue-gray 800
 bar_unselected_opacity = 0.8
 
+# Main figure rendering engine: 'png', 'svg', 'svg-lite' (no matplotlib) or 'plotly'
+FIGURE_ENGINE = os.environ.get('BIO_FIGURE_ENGINE', 'png')
+
+# Rows per page of the metabolite tables, pages are cut on the server
+TABLE_PAGE_SIZE = int(os.environ.get('BIO_TABLE_PAGE_SIZE', 15))
+
+# uploads this large (all files together, bytes) or with this many files go to the
+# background job queue (jobs.py) instead of being processed in the request
+JOB_MIN_BYTES = int(os.environ.get('BIO_JOB_MIN_BYTES', 2 * 2**20))
+JOB_MIN_FILES = int(os.environ.get('BIO_JOB_MIN_FILES', 4))
+
+# profiles of the reports shown in every browser session, see update_metabolit_table
+session_store = SessionStore()
+
+# visits of the patient shown in the trend section of a report, see history.py
+HISTORY_VISITS = int(os.environ.get('BIO_HISTORY_VISITS', 4))
+
 # Figure template
 row_heights = [150, 500, 300]
 template = {"layout": {"paper_bgcolor": bgcolor, "plot_bgcolor": bgcolor}}   
@@ -59,26 +96,124 @@ def patient_info(df):
     ])
     
 
-def metabolit_info(df_in, name = 'Метаболиты'):
+def metabolit_frame(df_in):
     """
-    conditional formatting link
-    https://dash.plotly.com/datatable/conditional-formatting
+    rows of a metabolite table: 'Метаболит' column first, metabolites without a range are skipped
     """
     df = df_in.copy()
     df = df.dropna(subset=['Верхняя граница'])
     df['Метаболит'] = df.index.values
     cols = df.columns.to_list()
     df = df[[cols[-1]] + cols[:-1]]
+    return df
+
+
+filter_operators = [['ge ', '>='],
+                    ['le ', '<='],
+                    ['lt ', '<'],
+                    ['gt ', '>'],
+                    ['ne ', '!='],
+                    ['eq ', '='],
+                    ['contains '],
+                    ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    """
+    '{Результат} > 5' -> ('Результат', 'gt', 5.0)
+    https://dash.plotly.com/datatable/callbacks
+    """
+    for operator_type in filter_operators:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ''
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return name, operator_type[0].strip(), value
+
+    return [None] * 3
+
+
+def filter_table(df, filter_query):
+    """
+    rows of df matching the DataTable filter_query, e.g. '{Результат} > 5 && {Метаболит} contains Gly'
+    """
+    for filter_part in (filter_query or '').split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            column = df[col_name]
+            if isinstance(filter_value, str) and pd.api.types.is_numeric_dtype(column):
+                # text typed into a numeric column matches nothing
+                df = df.iloc[:0]
+                continue
+            if not isinstance(filter_value, str) and not pd.api.types.is_numeric_dtype(column):
+                column = pd.to_numeric(column, errors = 'coerce')
+            df = df.loc[getattr(column, operator)(filter_value)]
+        elif operator == 'contains':
+            df = df.loc[df[col_name].astype(str).str.contains(str(filter_value), case = False, regex = False)]
+        elif operator == 'datestartswith':
+            df = df.loc[df[col_name].astype(str).str.startswith(str(filter_value))]
+    return df
+
+
+def metabolit_page(df_in, page_current = 0, page_size = TABLE_PAGE_SIZE, filter_query = '', abnormal_only = False):
+    """
+    df_in - profile rows of one group
+    returns (records of the requested page, page count)
+    """
+    df = metabolit_frame(df_in)
+    if abnormal_only:
+        df = df.loc[gmf.abnormal_metabolites(df)]
+    df = filter_table(df, filter_query)
+
+    page_count = max(1, math.ceil(len(df) / page_size))
+    start = page_current * page_size
+    return df.iloc[start:start + page_size].to_dict('records'), page_count
+
+
+def metabolit_info(df_in, name = 'Метаболиты', report = None):
+    """
+    conditional formatting link
+    https://dash.plotly.com/datatable/conditional-formatting
+
+    report - report id (pipeline result 'key'), further pages and filtered views
+    are served by update_metabolit_table from session_store
+    """
+    df = metabolit_frame(df_in)
+    data, page_count = metabolit_page(df_in)
     
     return html.Div(children=[
         html.H3(name,
                 style={'text-align':'center','fontSize' : 20, 'font-family' : 'sans-serif'}),
+        dcc.Checklist(
+            id = {'type' : 'abnormal-only', 'report' : report, 'group' : name},
+            options = [{'label' : ' Только отклонения от нормы', 'value' : 'abnormal'}],
+            value = [],
+            style = {'font-family' : 'sans-serif', 'fontSize' : 14, 'margin-bottom' : '6px'}),
         dash_table.DataTable(
-            id = 'metabolit-table',
+            id = {'type' : 'metabolit-table', 'report' : report, 'group' : name},
             columns=[{"name": str(i), "id": str(i), 
-                      'type' :'numeric',
+                      'type' : 'text' if i in ('Метаболит', 'Вывод') else 'numeric',
                       "format" : Format(precision=2, scheme=Scheme.fixed)} for i in df.columns],
-            data = df.to_dict('records'),
+            data = data,
+            page_action = 'custom',
+            page_current = 0,
+            page_size = TABLE_PAGE_SIZE,
+            page_count = page_count,
+            filter_action = 'custom',
+            filter_query = '',
             style_header={
                 'fontWeight': 'bold',
                 'textAlign': 'center'},
@@ -134,14 +269,6 @@ def metabolit_info(df_in, name = 'Метаболиты'):
      
     
     
-def get_graph_color(value, b = 50):
-    """
-    value - in range 0-100
-    """    
-    r = int(255*value/100.)
-    g = 255 - r
-    return f'rgb({r},{g},{b})'
-
 def models_output_cvd(deseases): 
     """ 
     deseases - dict: {'desease name' : desease probability} 
@@ -152,7 +279,7 @@ def models_output_cvd(deseases):
     colors = [] 
     labels = [] 
     for cat in categories: 
-        colors.append(get_graph_color(deseases[cat])) 
+        colors.append(gmf.get_graph_color(deseases[cat])) 
         labels.append(f'<b>{deseases[cat]:.2f} %</b>') 
          
     fig = { 
@@ -212,7 +339,7 @@ def models_output(deseases):
     colors = [] 
     labels = [] 
     for cat in categories: 
-        colors.append(get_graph_color(deseases[cat])) 
+        colors.append(gmf.get_graph_color(deseases[cat])) 
         labels.append(f'<b>{deseases[cat]:.2f} %</b>') 
          
     fig = { 
@@ -262,21 +389,92 @@ def models_output(deseases):
                 }, style = {'margin-top':'10px'}  )
    
 
-def main_figure():
-    fig = gmf.get_plot()
-    # Save it to a temporary buffer.
-    buf = BytesIO()
-    fig.savefig(buf, format="png", dpi=300, bbox_inches='tight')
-    # Embed the result in the html output.
-    fig_data = base64.b64encode(buf.getbuffer()).decode("ascii")
+def main_figure(figure, engine = None):
+    """
+    figure - main figure rendered by get_main_figure.render()
+    engine - one of get_main_figure.engines, FIGURE_ENGINE by default
+    """
+    engine = engine or FIGURE_ENGINE
+    style = {'width':'100%','border-radius':'5px 5px 0px 0px', 'margin-top':'8px', 'margin-bottom':'-10px'}
+    if engine == 'plotly':
+        graph = dcc.Graph(figure=figure, config={'displayModeBar': False}, style=style)
+    else:
+        # referenced by URL, the image itself is served (and cached) by image_store
+        media_type = gmf.engines[engine][1]
+        graph = html.Img(src=app.get_relative_path(image_store.put_image(figure, media_type)), sizes="100%100%",
+                         style=style)
     return html.Div(children = html.Div([
-        html.Img(src="data:image/png;base64,{}".format(fig_data), sizes="100%100%",
-                    style={'width':'100%','border-radius':'5px 5px 0px 0px', 'margin-top':'8px', 'margin-bottom':'-10px'}),
+        graph,
         html.Img(src = 'assets/legend_full.png', style={'width':'100%','border-radius':'0px 0px 5px 5px'})]))
 
 
 
 
+def history_output(patient):
+    """
+    trend of the last HISTORY_VISITS visits of the patient, read from the
+    profile history (history.py) without processing the old uploads again;
+    None for the first visit or without history (BIO_HISTORY_DB='')
+    """
+    if history.profile_history is None:
+        return None
+    visits, values = history.profile_history.trend(patient, last = HISTORY_VISITS)
+    if len(visits) < 2:
+        return None
+    labels = [time.strftime('%d.%m.%Y %H:%M', time.localtime(x)) for x in visits['visit_time']]
+
+    fig = {
+        "data": [
+            {
+                "type": "scatter",
+                "mode": "lines+markers",
+                "x": labels,
+                "y": [parts[i] for parts in visits['parts']],
+                "name": name.replace('\n', ' '),
+            } for i, name in enumerate(gmf.names)
+        ],
+        "layout": {
+            "template": template,
+            "height": 260,
+            "margin": {"l": 10, "r": 10, "t": 10, "b": 10},
+            "xaxis": {"type": "category", "automargin": True},
+            "yaxis": {"title": "% отклонений", "range": [-1, 101], "automargin": True},
+            "legend": {"orientation": "h"},
+        },
+    }
+
+    # metabolites out of range at the latest visit, one column per visit
+    latest = values[values['visit_id'] == visits['visit_id'].iloc[-1]]
+    abnormal = latest.loc[(latest['verdict'] != 'Норма') & latest['upper'].notna(), 'metabolite']
+    table = values.pivot(index = 'metabolite', columns = 'visit_id', values = 'result').reindex(abnormal)
+    table.columns = [str(x) for x in table.columns]
+    table.insert(0, 'Метаболит', table.index)
+
+    return html.Div(children = [
+        html.H3('Динамика показателей',
+                style={'text-align':'center','fontSize' : 20, 'font-family' : 'sans-serif'}),
+        dcc.Graph(figure = fig, config = {'displayModeBar': False}),
+        dash_table.DataTable(
+            columns = [{"name": "Метаболит", "id": "Метаболит", 'type' : 'text'}] +
+                      [{"name": label, "id": str(visit_id), 'type' : 'numeric',
+                        "format" : Format(precision=2, scheme=Scheme.fixed)}
+                       for visit_id, label in zip(visits['visit_id'], labels)],
+            data = table.to_dict('records'),
+            page_size = TABLE_PAGE_SIZE,
+            style_header={
+                'fontWeight': 'bold',
+                'textAlign': 'center'},
+            style_cell={
+                'textAlign': 'center',
+                'fontSize':14,
+                'font-family':'sans-serif'
+            },
+            style_table={'overflowX' : 'auto'},
+        ),
+    ],
+    className = "six columns pretty_container", style={'margin-left':'0px'})
+
+
 #LC part introduction
 def models_output_lc(deseases):
     """
@@ -288,7 +486,7 @@ def models_output_lc(deseases):
     colors = []
     labels = []
     for cat in categories:
-        colors.append(get_graph_color(deseases[cat]))
+        colors.append(gmf.get_graph_color(deseases[cat]))
         labels.append(f'<b>{deseases[cat]:.2f} %</b>')
         
     fig = {
@@ -346,7 +544,7 @@ def models_output_lc(deseases):
 
 
 
-app.layout = html.Div(children=[
+main_layout = html.Div(children=[
     html.Div([html.Div([html.Img(src ='assets/NCMU_logo.jpeg',
                              style={'width':'100px','height':'110px'}),
                        html.Img(src ='assets/sechenov_logo(1).png',
@@ -398,30 +596,66 @@ app.layout = html.Div(children=[
     )
 
 
+def serve_layout():
+    # every page load is a new session for the server-side tables
+    return html.Div([dcc.Store(id = 'session-id', data = uuid.uuid4().hex),
+                     main_layout])
 
-def parse_contents(contents, filename, date):
-    content_type, content_string = contents.split(',')
 
-    decoded = base64.b64decode(content_string)
-    try:
-        df = pd.read_excel(io.BytesIO(decoded))  
-        # df = pd.read_excel('C:\\Users\\MATH\\bio\\TEST_test.xlsx')
-            
-        info, profile, groups_content = helper.prepare_data(df)
-        
-        desease_cvd = helper.desease_prediction_cvd(profile)
-        desease = helper.desease_prediction(profile)
-        desease_lc=helper.desease_prediction_lc(profile)
-    except Exception as e:
-        print(e)
-        return html.Div([
+app.layout = serve_layout
+
+
+
+def error_output():
+    return html.Div([
             'There was an error processing this file.'
         ], className="six columns pretty_container", style={'margin-left':'0px'})
 
-    
+
+def remember_report(session, result):
+    session_store.put(session, result['key'], (result['profile'], result['groups_content']))
+    if history.profile_history is not None:
+        with metrics.stage('history'):
+            history.profile_history.save(result)
+
+
+def parse_contents(contents, filename, date, session = None):
+    result, error = pipeline.analyse_contents(contents, filename, FIGURE_ENGINE)
+    if error is not None:
+        print(error)
+        return error_output()
+    remember_report(session, result)
+    with metrics.stage('layout'):
+        return report_output(result)
+
+
+def report_link(report):
+    """
+    report - report id, the static HTML report is served by api.report
+    """
+    if report is None:
+        return None
+    return html.A('Скачать отчет (HTML)', href = app.get_relative_path(f'/api/v1/reports/{report}.html'),
+                  style = {'display' : 'block', 'margin-top' : '8px', 'font-family' : 'sans-serif', 'fontSize' : 14})
+
+
+def report_output(result):
+    """
+    result - pipeline.analyse_bytes() output
+    """
+    info = result['info']
+    profile = result['profile']
+    groups_content = result['groups_content']
+    desease_cvd = result['desease_cvd']
+    desease = result['desease']
+    desease_lc = result['desease_lc']
+
     meta_tables = []
+    trend = history_output(info['Номер'].iloc[0])
+    if trend is not None:
+        meta_tables.append(trend)
     for name, values in groups_content.items():
-        meta_tables.append(metabolit_info(profile.loc[values], name=name))
+        meta_tables.append(metabolit_info(profile.loc[values], name=name, report=result.get('key')))
     return html.Div([html.Div([
             html.Div([ 
                     html.H3(children='Результаты метаболомного профилирования',
@@ -430,10 +664,11 @@ def parse_contents(contents, filename, date):
                     html.Br(),         
                 
                     patient_info(info),
+                    report_link(result.get('key')),
                     ],
                 className="six columns pretty_container", style={'margin-left':'0px'}
                 ),
-            main_figure(),
+            main_figure(result['figure']),
             
             html.Div(children = [ 
         html.H3('Сердечно-сосудистые патологии', 
@@ -469,17 +704,165 @@ def parse_contents(contents, filename, date):
               Input('upload-data', 'contents'),
               State('upload-data', 'filename'),
               State('upload-data', 'last_modified'),
+              State('session-id', 'data'),
               )
-def update_output(list_of_contents, list_of_names, list_of_dates):
+def update_output(list_of_contents, list_of_names, list_of_dates, session):
     if list_of_contents is not None:
-        children = [
-            parse_contents(c, n, d) for c, n, d in
-            zip(list_of_contents, list_of_names, list_of_dates)]
-        return children
+        # base64 is 4/3 of the file size
+        upload_bytes = sum(len(x) for x in list_of_contents) * 3 // 4
+        if upload_bytes >= JOB_MIN_BYTES or len(list_of_contents) >= JOB_MIN_FILES:
+            return submit_job(list_of_contents, list_of_names, session)
+
+        # files are processed in parallel, the layout keeps the upload order
+        return results_output(pipeline.analyse_uploads(list_of_contents, list_of_names, FIGURE_ENGINE),
+                              session)
+
+
+def results_output(results, session):
+    """
+    results - list of (result, error), see pipeline.analyse_uploads()
+    """
+    children = []
+    for result, error in results:
+        if error is not None:
+            print(error)
+            children.append(error_output())
+        else:
+            remember_report(session, result)
+            with metrics.stage('layout'):
+                children.append(report_output(result))
+    return children
+
+
+job_stage_labels = {'queued' : 'в очереди',
+                    'start' : 'запуск',
+                    'parse' : 'чтение файла',
+                    'analyse' : 'анализ метаболитов',
+                    'models' : 'модели',
+                    'render' : 'построение графика',
+                    'done' : 'готово',
+                    'failed' : 'ошибка',
+                    'cancelled' : 'отменено'}
+
+
+def submit_job(list_of_contents, list_of_names, session):
+    files = []
+    for contents, name in zip(list_of_contents, list_of_names):
+        try:
+            decoded = pipeline.decode_contents(contents)
+        except Exception:
+            # reported as a failed file of the job
+            decoded = b''
+        files.append((name, decoded))
+    job_id = jobs.job_queue.submit(session, files, FIGURE_ENGINE)
+    return job_panel(job_id)
+
+
+def job_status(status):
+    """
+    status - jobs.JobQueue.status() output
+    """
+    finished = sum(x['state'] in jobs.finished_states for x in status)
+    rows = [html.Tr([html.Td(x['filename']),
+                     html.Td(job_stage_labels.get(x['stage'], x['stage'])),
+                     html.Td(f"попытка {x['attempts']}" if x['attempts'] > 1 else '')])
+            for x in status]
+    return [html.P(f'Обработано файлов: {finished} из {len(status)}', style={'margin':'0px'}),
+            html.Progress(value=str(finished), max=str(len(status)), style={'width':'100%'}),
+            html.Table(rows, style={'fontSize':13})]
 
 
+def job_panel(job_id):
+    """
+    progress of a background job, replaced by the reports once every file is processed
+    """
+    status = jobs.job_queue.status(job_id)
+    button_style = {'margin-right':'10px'}
+    return html.Div([
+        dcc.Interval(id={'type' : 'job-poll', 'job' : job_id}, interval=1000),
+        html.Div([
+            html.H5('Обработка загруженных файлов', style={'fontSize' : 16, 'font-family' : 'sans-serif'}),
+            html.Div(job_status(status), id={'type' : 'job-status', 'job' : job_id}),
+            html.Button('Отменить', id={'type' : 'job-cancel', 'job' : job_id}, style=button_style),
+            html.Button('Повторить с ошибками', id={'type' : 'job-retry', 'job' : job_id}, style=button_style),
+            ], className="six columns pretty_container", style={'margin-left':'0px', 'font-family' : 'sans-serif'}),
+        html.Div(id={'type' : 'job-results', 'job' : job_id}),
+        ])
+
+
+@app.callback(Output({'type' : 'job-status', 'job' : MATCH}, 'children'),
+              Output({'type' : 'job-results', 'job' : MATCH}, 'children'),
+              Output({'type' : 'job-poll', 'job' : MATCH}, 'disabled'),
+              Input({'type' : 'job-poll', 'job' : MATCH}, 'n_intervals'),
+              State({'type' : 'job-poll', 'job' : MATCH}, 'id'),
+              State('session-id', 'data'),
+              prevent_initial_call = True,
+              )
+def poll_job(n_intervals, poll_id, session):
+    job_id = poll_id['job']
+    # a restarted worker process picks up the queue again
+    jobs.job_queue.start()
+    status = jobs.job_queue.status(job_id)
+    if not all(x['state'] in jobs.finished_states for x in status):
+        return job_status(status), no_update, False
+    return job_status(status), results_output(jobs.job_queue.results(job_id), session), True
+
+
+@app.callback(Output({'type' : 'job-poll', 'job' : MATCH}, 'disabled', allow_duplicate=True),
+              Input({'type' : 'job-cancel', 'job' : MATCH}, 'n_clicks'),
+              Input({'type' : 'job-retry', 'job' : MATCH}, 'n_clicks'),
+              prevent_initial_call = True,
+              )
+def control_job(cancel_clicks, retry_clicks):
+    job_id = ctx.triggered_id['job']
+    if ctx.triggered_id['type'] == 'job-cancel':
+        jobs.job_queue.cancel(job_id)
+    else:
+        jobs.job_queue.retry(job_id)
+    # poll until the job settles again
+    return False
+
+
+@app.callback(Output({'type' : 'metabolit-table', 'report' : MATCH, 'group' : MATCH}, 'data'),
+              Output({'type' : 'metabolit-table', 'report' : MATCH, 'group' : MATCH}, 'page_count'),
+              Input({'type' : 'metabolit-table', 'report' : MATCH, 'group' : MATCH}, 'page_current'),
+              Input({'type' : 'metabolit-table', 'report' : MATCH, 'group' : MATCH}, 'page_size'),
+              Input({'type' : 'metabolit-table', 'report' : MATCH, 'group' : MATCH}, 'filter_query'),
+              Input({'type' : 'abnormal-only', 'report' : MATCH, 'group' : MATCH}, 'value'),
+              State({'type' : 'metabolit-table', 'report' : MATCH, 'group' : MATCH}, 'id'),
+              State('session-id', 'data'),
+              prevent_initial_call = True,
+              )
+def update_metabolit_table(page_current, page_size, filter_query, abnormal_only, table_id, session):
+    report, group = table_id['report'], table_id['group']
+    stored = session_store.get(session, report)
+    if stored is None:
+        # other worker process or expired session: the report may still be in the result cache
+        result = pipeline.result_cache.get(report)
+        if result is None:
+            print(f'report {report} is no longer available')
+            return [], 1
+        stored = (result['profile'], result['groups_content'])
+        session_store.put(session, report, stored)
+
+    profile, groups_content = stored
+    return metabolit_page(profile.loc[groups_content[group]], page_current or 0,
+                          page_size or TABLE_PAGE_SIZE, filter_query, bool(abnormal_only))
+
+
+
+
+def warm_up():
+    """
+    loads reference ranges and models and draws a first figure; importing this
+    module does no such work, so call it before serving (gunicorn.conf.py does),
+    otherwise the first upload pays for it
+    """
+    with metrics.stage('warm_up'):
+        pipeline.warm_up()
 
 
 # Run the server
 if __name__ == "__main__":
+    warm_up()
     app.run_server(debug=True)
\ No newline at end of file
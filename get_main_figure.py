@@ -1,21 +1,14 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-
-import base64
-from dash import Dash
 
 import io
-from io import BytesIO
-
-from dash import dcc
-from dash import html
-from dash import dash_table
 
-from bio_df_processing import prepare_data, add_all_ranges,\
-extract_info
+import hashlib
+import json
+import threading
+from collections import OrderedDict
 
-df = pd.read_excel("TEST_test.xlsx")
+from metabolites import metabolite_registry
 
 toxic=['Kynurenine', 'Kynurenine/Tryptophan', 'Quinolinic acid','Antranillic acid', 'Xanturenic acid', 
        'Kynurenic acid', 'Tryptophan','Kynurenine/Tryptophan','АДМА',
@@ -27,6 +20,8 @@ aminoacids=['Глицин', 'Аланин', 'Пролин', 'Валин', 'Ле
        'Аспаргиновая кислота', 'Фенилаланин', 'Аргинин', 'Цитруллин', 'Серин',
        'Треонин', 'Лизин', 'Тирозин', 'Метионин']
 groups2=[toxic, microbiota, stress, aminoacids]
+# metabolite ids of every group, duplicates kept: len(group) is the denominator
+groups2_ids=[metabolite_registry.register(group) for group in groups2]
 names=['Окислительный стресс', 'Микробные метаболиты', 'Стресс &\nнастроение', 'Профиль\nаминокислот']
 diseases=['Преждевременное\nстарение организма','Сердечно-сосудистые\nзаболевания', 'Рак легкого', 'Рак почки', 'Колоректальный рак']
 
@@ -35,100 +30,391 @@ proba_CVD = 78.0
 proba_lung = 5.0
 proba_kidney = 4.0
 proba_colorectal = 2.0
+default_part_dis = [proba_age, proba_CVD, proba_lung, proba_kidney, proba_colorectal]
+
+font_family = 'bahnschrift'
 
 y_line=[-0.5,0.8,1.8,2.8]
 y_line_2=[5,7.5,9,10.5,12.0]
 numbers=[8,7,6,5]
 numbers_dis=[5,4,3,2,1]
 
-def process_data(df):
-    info = extract_info(df)
-    df = df.drop(info.columns, axis = 1)
-    df = df.T
-    df.columns = ['Результат']
-    df.index = df.index.str.strip()
-    df_0 = add_all_ranges(df)
-
-    df_selected=df_0.loc[df_0['Результат'] > df_0['Верхняя граница']]
-    df_selected_1=df_0.loc[df_0['Результат'] < df_0['Нижняя граница']]
-    a=df_selected.T.columns
-    a=a.append(df_selected_1.T.columns)
-    return a
-
-part=[]
-for group in groups2:    
-    prop=set(process_data(df).intersection(group))
-    percentage=round(len(prop)/len(group)*100, 0)
-    part.append(percentage)
-    part_dis=[proba_age, proba_CVD, proba_lung, proba_kidney, proba_colorectal]
-
-def get_plot():
-    plt.figure(figsize=(7,5))
-    plt.plot(part, y_line, 'ro', marker='o', markersize=0)
-    plt.hlines(y=14.5, xmin=60, xmax=100, linewidth=10, color='r')
-    plt.hlines(y=14.5, xmin=20, xmax=60, linewidth=10, color='gold')
-    plt.hlines(y=14.5, xmin=0, xmax=20, linewidth=10, color='seagreen')
-    plt.hlines(y=4.3, xmin=0, xmax=100, linewidth=3, color='lightgrey')
-    plt.hlines(y=6.8, xmin=0, xmax=100, linewidth=3, color='lightgrey')
-
-    plt.rcParams['font.family'] = 'bahnschrift'
-    plt.rcParams['figure.dpi'] = 300
-    plt.rcParams['savefig.dpi'] = 300
-    plt.grid(True, linewidth=0.15, color = 'Grey')
-    plt.yticks(c='white')
-    plt.xticks(size=7, c='b')
-    n=0
-    for i_x, i_y in zip(part, y_line):
-        plt.xlim(0,100)
-        plt.ylim(-1,15)
-        number = dict(boxstyle='circle', facecolor='grey', alpha=0.07, edgecolor='black')
-        if i_x < 20.0:
-            prop = dict(boxstyle='round', facecolor='lightgreen', alpha=1, edgecolor='g')
-            
-        elif i_x > 60.0:    
-            prop = dict(boxstyle='round', facecolor='tomato', alpha=1, edgecolor='r')
-        else:
-            prop = dict(boxstyle='round', facecolor='lemonchiffon', alpha=1, edgecolor='sienna')
-        plt.text(i_x-4, i_y+0.2, names[n], color = 'black',  bbox=prop, fontsize = 9)
-        plt.text(i_x, i_y-0.4, numbers[n], color = 'black',  bbox=number, fontsize = 7)
-        n=n+1
-
-    n=0
-    for i_x, i_y in zip(part_dis, y_line_2):
-        plt.xlim(0,100)
-        plt.ylim(-1,16)
-        number = dict(boxstyle='circle', facecolor='black', alpha=0.07, edgecolor='black')
-        if i_x < 20.0:
-            prop = dict(boxstyle='round', facecolor='lightgreen', alpha=1, edgecolor='g')
-            
-        elif i_x > 60.0:    
-            prop = dict(boxstyle='round', facecolor='lightsalmon', alpha=1, edgecolor='r')
-        else:
-            prop = dict(boxstyle='round', facecolor='lemonchiffon', alpha=1, edgecolor='sienna')
-        plt.text(i_x-1, i_y+0.3, diseases[n], color = 'black',  bbox=prop, fontsize = 9)
-        plt.text(i_x, i_y-0.4, numbers_dis[n], color = 'black',  bbox=number, fontsize = 8)
-        n=n+1
-        
-    plt.text(40, 15.1, 'СТЕПЕНЬ РИСКА', color = 'black', fontsize = 11)
-    plt.text(2, 13.5, 'МИНИМАЛЬНАЯ', fontsize = 9)
-    plt.text(34, 13.5, 'СРЕДНЯЯ', fontsize = 9)
-    plt.text(75, 13.5, 'ВЫСОКАЯ', fontsize = 9)
+def abnormal_metabolites(profile):
+    """
+    profile - 2nd result of prepare_data() function
+    returns index of metabolites outside of the reference range
+    """
+    a = profile.index[profile['Результат'] > profile['Верхняя граница']]
+    return a.append(profile.index[profile['Результат'] < profile['Нижняя граница']])
+
+_membership = {}
+
+def group_membership():
+    """
+    returns (column, matrix, sizes): column of every metabolite id in matrix (-1 - in no group,
+    the extra last item answers id -1), matrix metabolite x group of groups2 (1 - member)
+    and len() of every group; a metabolite listed twice in a group is one row of
+    the matrix but counts twice in its size
+    """
+    n = len(metabolite_registry)
+    cached = _membership.get(n)
+    if cached is None:
+        members = np.unique(np.concatenate(groups2_ids))
+        column = np.full(n + 1, -1)
+        column[members] = np.arange(len(members))
+        matrix = np.zeros((len(members), len(groups2)))
+        for g, ids in enumerate(groups2_ids):
+            matrix[column[ids], g] = 1
+        sizes = np.array([len(group) for group in groups2], dtype = float)
+        # ids are never renumbered, only the latest registry size is needed
+        _membership.clear()
+        cached = _membership[n] = (column, matrix, sizes)
+    return cached
+
+def group_parts(patients, ids, abnormal, n_patients):
+    """
+    patients - patient number (0 .. n_patients-1) of every profile row
+    ids - metabolite id of every row, abnormal - row is outside of the reference range
+
+    returns array (n_patients, len(groups2)): percentage of abnormal metabolites in every group
+    """
+    column, matrix, sizes = group_membership()
+    columns = column[ids]
+    selected = abnormal & (columns >= 0)
+    flags = np.zeros((n_patients, len(matrix)))
+    flags[patients[selected], columns[selected]] = 1
+    return np.round(flags @ matrix / sizes * 100, 0)
+
+def abnormal_rows(profile):
+    """
+    boolean array: row of the profile is outside of the reference range
+    """
+    values = profile['Результат'].to_numpy(dtype = float)
+    return ((values > profile['Верхняя граница'].to_numpy(dtype = float)) |
+            (values < profile['Нижняя граница'].to_numpy(dtype = float)))
+
+def get_parts(profile):
+    """
+    percentage of abnormal metabolites in every group of groups2
+    """
+    ids = metabolite_registry.ids(profile.index)
+    parts = group_parts(np.zeros(len(ids), dtype = int), ids, abnormal_rows(profile), 1)
+    return parts[0].tolist()
+
+def cohort_parts(profiles):
+    """
+    profiles - 2nd result of prepare_cohort()
+    returns DataFrame: one row per patient, get_parts() of every patient in columns names
+    """
+    patients = profiles.index.get_level_values('Пациент')
+    metabolites = profiles.index.get_level_values('Метаболит')
+    patient_codes, patient_index = pd.factorize(patients)
+    metabolite_codes, metabolite_index = pd.factorize(metabolites)
+    ids = metabolite_registry.ids(metabolite_index)[metabolite_codes]
+    parts = group_parts(patient_codes, ids, abnormal_rows(profiles), len(patient_index))
+    return pd.DataFrame(parts, index = patient_index, columns = names)
+
+def get_part_dis(desease_cvd, desease_lc):
+    """
+    risk values for the main figure from desease_prediction_cvd() and
+    desease_prediction_lc() results, there is no ageing model yet
+    """
+    return [proba_age, desease_cvd['ССЗ'], desease_lc['Рак легкого'],
+            desease_lc['Рак почки'], desease_lc['Колоректальный\nрак']]
+
+def get_plot(profile, part_dis = default_part_dis):
+    """
+    profile - 2nd result of prepare_data() function
+    part_dis - risk values in the order of diseases
+    """
+    return plot_parts(get_parts(profile), part_dis)
+
+def box_style(value, high_color):
+    if value < 20.0:
+        return dict(boxstyle='round', facecolor='lightgreen', alpha=1, edgecolor='g')
+    elif value > 60.0:
+        return dict(boxstyle='round', facecolor=high_color, alpha=1, edgecolor='r')
+    else:
+        return dict(boxstyle='round', facecolor='lemonchiffon', alpha=1, edgecolor='sienna')
+
+def figure_elements(part, part_dis):
+    """
+    backend independent description of the main figure,
+    every rendering engine draws exactly these lines and text boxes
+
+    returns dict: 'hlines' - (y, xmin, xmax, linewidth, color),
+                  'texts' - (x, y, text, fontsize, bbox or None)
+    """
+    hlines = [(14.5, 60, 100, 10, 'r'),
+              (14.5, 20, 60, 10, 'gold'),
+              (14.5, 0, 20, 10, 'seagreen'),
+              (4.3, 0, 100, 3, 'lightgrey'),
+              (6.8, 0, 100, 3, 'lightgrey')]
+
+    texts = []
+    number = dict(boxstyle='circle', facecolor='grey', alpha=0.07, edgecolor='black')
+    for n, (i_x, i_y) in enumerate(zip(part, y_line)):
+        texts.append((i_x-4, i_y+0.2, names[n], 9, box_style(i_x, 'tomato')))
+        texts.append((i_x, i_y-0.4, numbers[n], 7, number))
+
+    number = dict(boxstyle='circle', facecolor='black', alpha=0.07, edgecolor='black')
+    for n, (i_x, i_y) in enumerate(zip(part_dis, y_line_2)):
+        texts.append((i_x-1, i_y+0.3, diseases[n], 9, box_style(i_x, 'lightsalmon')))
+        texts.append((i_x, i_y-0.4, numbers_dis[n], 8, number))
+
+    texts += [(40, 15.1, 'СТЕПЕНЬ РИСКА', 11, None),
+              (2, 13.5, 'МИНИМАЛЬНАЯ', 9, None),
+              (34, 13.5, 'СРЕДНЯЯ', 9, None),
+              (75, 13.5, 'ВЫСОКАЯ', 9, None)]
+
+    return {'hlines' : hlines, 'texts' : texts, 'xlim' : (0, 100), 'ylim' : (-1, 16)}
+
+def plot_parts(part, part_dis):
+    """
+    returns a standalone matplotlib Figure, pyplot global state is not used
+    so figures can be drawn from several threads at once
+    """
+    # matplotlib is imported on the first draw, not with this module
+    from matplotlib.figure import Figure
+
+    elements = figure_elements(part, part_dis)
+
+    fig = Figure(figsize=(7,5), dpi=300)
+    ax = fig.subplots()
+    ax.plot(part, y_line, 'ro', markersize=0)
+    for y, xmin, xmax, linewidth, color in elements['hlines']:
+        ax.hlines(y=y, xmin=xmin, xmax=xmax, linewidth=linewidth, color=color)
+
+    ax.grid(True, linewidth=0.15, color = 'Grey')
+    ax.tick_params(axis='y', labelcolor='white')
+    ax.tick_params(axis='x', labelsize=7, labelcolor='b')
+    ax.set_xlim(*elements['xlim'])
+    ax.set_ylim(*elements['ylim'])
+    for label in ax.get_xticklabels() + ax.get_yticklabels():
+        label.set_fontfamily(font_family)
+
+    for x, y, text, fontsize, bbox in elements['texts']:
+        ax.text(x, y, text, color = 'black', bbox=bbox, fontsize = fontsize,
+                fontfamily = font_family)
+
     for pos in ['top']:
-        plt.gca().spines[pos].set_visible(False)
-    
-    fig = plt.Figure()
-    fig.set_canvas(plt.gcf().canvas)
-    return  plt
-
-def save_figure():
-    fig = get_plot()
-    # Save it to a temporary buffer.
+        ax.spines[pos].set_visible(False)
+
+    return fig
+
+def get_graph_color(value, b = 50):
+    """
+    value - in range 0-100, colour of the model probability bars
+    (Dash charts and static reports)
+    """
+    r = int(255*value/100.)
+    g = 255 - r
+    return f'rgb({r},{g},{b})'
+
+def css_color(color, alpha = 1):
+    from matplotlib.colors import to_rgba
+    r, g, b, a = to_rgba(color, alpha)
+    return f'rgba({int(r*255)},{int(g*255)},{int(b*255)},{a:g})'
+
+def plotly_figure(part, part_dis):
+    """
+    the main figure as a native Plotly figure dict, rendered in the browser
+    """
+    elements = figure_elements(part, part_dis)
+
+    shapes = [{'type' : 'line', 'xref' : 'x', 'yref' : 'y',
+               'x0' : xmin, 'x1' : xmax, 'y0' : y, 'y1' : y,
+               'line' : {'color' : css_color(color), 'width' : linewidth}}
+              for y, xmin, xmax, linewidth, color in elements['hlines']]
+
+    annotations = []
+    for x, y, text, fontsize, bbox in elements['texts']:
+        annotation = {'x' : x, 'y' : y, 'xref' : 'x', 'yref' : 'y',
+                      'text' : str(text).replace('\n', '<br>'),
+                      'showarrow' : False, 'xanchor' : 'left', 'yanchor' : 'bottom',
+                      'align' : 'left', 'font' : {'size' : fontsize * 1.4, 'color' : 'black'}}
+        if bbox is not None:
+            annotation['bgcolor'] = css_color(bbox['facecolor'], bbox['alpha'])
+            annotation['bordercolor'] = css_color(bbox['edgecolor'])
+            annotation['borderpad'] = 3
+        annotations.append(annotation)
+
+    return {
+        'data' : [],
+        'layout' : {
+            'shapes' : shapes,
+            'annotations' : annotations,
+            'height' : 500,
+            'margin' : {'l' : 10, 'r' : 10, 't' : 10, 'b' : 30},
+            'plot_bgcolor' : 'white',
+            'paper_bgcolor' : 'white',
+            'xaxis' : {'range' : list(elements['xlim']), 'showgrid' : True,
+                       'gridcolor' : css_color('grey', 0.3), 'showline' : True,
+                       'linecolor' : 'black', 'tickfont' : {'size' : 10, 'color' : 'blue'},
+                       'fixedrange' : True},
+            'yaxis' : {'range' : list(elements['ylim']), 'showgrid' : True,
+                       'gridcolor' : css_color('grey', 0.3), 'showline' : True,
+                       'mirror' : True, 'linecolor' : 'black',
+                       'showticklabels' : False, 'fixedrange' : True},
+            },
+        }
+
+# svg.fonttype can only be set through rcParams
+_svg_lock = threading.Lock()
+
+def matplotlib_bytes(part, part_dis, fmt):
+    from matplotlib import rc_context
+    fig = plot_parts(part, part_dis)
     buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=300)
-    fig.close()
-    # Embed the result in the html output.
-    fig_data = base64.b64encode(buf.getbuffer()).decode("utf8")
-    buf.close()
-    fig_main_matplotlib = f'bio-master:main_png;base64,{fig_data}'
-    return fig_main_matplotlib
+    if fmt == 'svg':
+        # keep text as text in SVG, it is several times smaller than glyph paths
+        with _svg_lock, rc_context({'svg.fonttype' : 'none'}):
+            fig.savefig(buf, format=fmt, dpi=300, bbox_inches='tight')
+    else:
+        fig.savefig(buf, format=fmt, dpi=300, bbox_inches='tight')
+    return buf.getvalue()
+
+# matplotlib single letter colors, the other names are also CSS names
+svg_colors = {'r' : 'red', 'g' : 'green', 'b' : 'blue', 'k' : 'black'}
+
+def svg_figure(part, part_dis, width = 760, height = 500):
+    """
+    the main figure as SVG markup written directly from figure_elements(),
+    about a hundred times faster than matplotlib, text widths are estimated
+    """
+    from html import escape
+
+    elements = figure_elements(part, part_dis)
+    (x0, x1), (y0, y1) = elements['xlim'], elements['ylim']
+    # labels of high values stick out of the axes on the right like in matplotlib
+    left, right, top, bottom = 20, width - 80, 10, height - 25
+    # sizes are in points like in matplotlib, the figure is 100 px per inch
+    pt = 100 / 72
+
+    def px(x):
+        return left + (x - x0) / (x1 - x0) * (right - left)
+
+    def py(y):
+        return bottom - (y - y0) / (y1 - y0) * (bottom - top)
+
+    out = [f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" '
+           f'font-family="{font_family}, sans-serif">',
+           f'<rect width="{width}" height="{height}" fill="white"/>']
+    for tick in range(int(x0), int(x1) + 1, 20):
+        out.append(f'<line x1="{px(tick):.1f}" x2="{px(tick):.1f}" y1="{top}" y2="{bottom}" '
+                   f'stroke="grey" stroke-width="0.3"/>'
+                   f'<text x="{px(tick):.1f}" y="{bottom + 14}" font-size="{7 * pt:.1f}" '
+                   f'fill="blue" text-anchor="middle">{tick}</text>')
+    for tick in range(int(y0) + 1, int(y1) + 1, 2):
+        out.append(f'<line x1="{left}" x2="{right}" y1="{py(tick):.1f}" y2="{py(tick):.1f}" '
+                   f'stroke="grey" stroke-width="0.3"/>')
+    out.append(f'<path d="M{left},{top}V{bottom}H{right}V{top}" fill="none" stroke="black" stroke-width="1"/>')
+
+    for y, xmin, xmax, linewidth, color in elements['hlines']:
+        out.append(f'<line x1="{px(xmin):.1f}" x2="{px(xmax):.1f}" y1="{py(y):.1f}" y2="{py(y):.1f}" '
+                   f'stroke="{svg_colors.get(color, color)}" stroke-width="{linewidth * pt:.1f}"/>')
+
+    for x, y, text, fontsize, bbox in elements['texts']:
+        size = fontsize * pt
+        lines = str(text).split('\n')
+        # the anchor is the baseline of the last line, like a bottom aligned label
+        first = py(y) - (len(lines) - 1) * size * 1.2
+        if bbox is not None:
+            text_width = max(len(line) for line in lines) * size * 0.55
+            text_height = len(lines) * size * 1.2
+            pad = 0.3 * size
+            fill = svg_colors.get(bbox['facecolor'], bbox['facecolor'])
+            stroke = svg_colors.get(bbox['edgecolor'], bbox['edgecolor'])
+            if bbox['boxstyle'] == 'circle':
+                out.append(f'<circle cx="{px(x) + text_width / 2:.1f}" cy="{py(y) - size * 0.35:.1f}" '
+                           f'r="{max(text_width, text_height) / 2 + pad:.1f}" fill="{fill}" '
+                           f'fill-opacity="{bbox["alpha"]:g}" stroke="{stroke}"/>')
+            else:
+                out.append(f'<rect x="{px(x) - pad:.1f}" y="{first - size - pad:.1f}" '
+                           f'width="{text_width + 2 * pad:.1f}" height="{text_height + 2 * pad - size * 0.2:.1f}" '
+                           f'rx="{pad:.1f}" fill="{fill}" fill-opacity="{bbox["alpha"]:g}" stroke="{stroke}"/>')
+        spans = ''.join(f'<tspan x="{px(x):.1f}" y="{first + i * size * 1.2:.1f}">{escape(line)}</tspan>'
+                        for i, line in enumerate(lines))
+        out.append(f'<text font-size="{size:.1f}">{spans}</text>')
+
+    out.append('</svg>')
+    return '\n'.join(out).encode('utf8')
+
+# engine name -> (render function, media type)
+engines = {'png' : (lambda part, part_dis: matplotlib_bytes(part, part_dis, 'png'), 'image/png'),
+           'svg' : (lambda part, part_dis: matplotlib_bytes(part, part_dis, 'svg'), 'image/svg+xml'),
+           'svg-lite' : (svg_figure, 'image/svg+xml'),
+           'plotly' : (plotly_figure, None)}
+
+def figure_key(part, part_dis, engine = 'png'):
+    """
+    content hash of everything that ends up on the main figure
+    """
+    payload = json.dumps([[float(x) for x in part], [float(x) for x in part_dis], engine])
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+
+class FigureCache:
+    """
+    bounded LRU of rendered figures keyed by figure_key()
+    """
+
+    def __init__(self, maxsize = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            figure = self._items.get(key)
+            if figure is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return figure
+
+    def put(self, key, figure):
+        with self._lock:
+            self._items[key] = figure
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+figure_cache = FigureCache()
+
+
+def render(profile, part_dis = default_part_dis, engine = 'png'):
+    """
+    returns the main figure rendered by one of engines:
+    PNG or SVG bytes, or a Plotly figure dict. Repeated inputs are served from figure_cache
+    """
+    render_engine, _ = engines[engine]
+    part = get_parts(profile)
+    key = figure_key(part, part_dis, engine)
+    figure = figure_cache.get(key)
+    if figure is None:
+        figure = render_engine(part, part_dis)
+        figure_cache.put(key, figure)
+    return figure
+
+def render_png(profile, part_dis = default_part_dis):
+    """
+    returns PNG bytes of the main figure, repeated inputs skip matplotlib
+    """
+    return render(profile, part_dis, 'png')
 
+def save_figure(profile, part_dis = default_part_dis):
+    """
+    stores the PNG in image_store, returns its URL path for html.Img
+    """
+    import image_store
+    png = render_png(profile, part_dis)
+    return image_store.put_image(png, 'image/png')
@@ -0,0 +1,54 @@
+'''
+Multi-process / multi-threaded serving configuration.
+
+    gunicorn -c gunicorn.conf.py dash_app:server
+
+The processing pipeline keeps no per-request module state (group
+membership is returned by prepare_data, figures are standalone
+matplotlib Figure objects) and all shared caches and registries are
+guarded by locks, so requests can be served by several threads of
+several worker processes. tests/test_concurrency.py verifies that parallel
+uploads of different patients do not mix.
+
+Every setting can be overridden from the environment.
+'''
+
+import os
+
+
+bind = os.environ.get('BIO_BIND', '0.0.0.0:8050')
+
+# processes x threads; uploads are CPU bound (Excel parsing, rendering),
+# so threads mostly help while other requests wait on I/O
+workers = int(os.environ.get('BIO_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('BIO_THREADS', 4))
+
+# large multi-file uploads
+timeout = int(os.environ.get('BIO_TIMEOUT', 120))
+graceful_timeout = 30
+
+# load ranges and models once in the master, workers share them copy-on-write
+preload_app = True
+
+# every gunicorn worker already is a separate process, do not start
+# an additional upload process pool inside each of them; queued job files
+# are processed by a runner thread of every worker instead (post_fork)
+os.environ.setdefault('BIO_UPLOAD_WORKERS', '0')
+os.environ.setdefault('BIO_JOB_WORKERS', '0')
+
+accesslog = '-'
+
+
+def when_ready(server):
+    # importing dash_app loads nothing, ranges, models and the matplotlib
+    # font cache are loaded here, in the master before the workers fork
+    import dash_app
+    dash_app.warm_up()
+
+
+def post_fork(server, worker):
+    # the shared job database is served by all workers, not only by the one
+    # that received the upload
+    import jobs
+    jobs.job_queue.start()
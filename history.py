@@ -0,0 +1,142 @@
+'''
+Longitudinal store of processed profiles.
+
+Every report shown in the app is saved once (per patient and analysed content)
+to an SQLite database: BIO_HISTORY_DB, by default history.sqlite in a private
+directory of the user ($XDG_DATA_HOME/bio, see sqlite_store.py).
+BIO_HISTORY_DB='' turns the history off, profile_history is None then.
+
+    visits          one row per report: patient info, predictions, group parts
+    profile_values  one row per metabolite of a visit, indexed by
+                    (patient, visit_time) - a patient's history is one
+                    index range scan, nothing is recomputed
+
+The patient key is the 'Номер' column.
+'''
+
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import get_main_figure as gmf
+from result_cache import user_data_dir
+from sqlite_store import SQLiteStore
+
+
+schema = '''
+create table if not exists visits (
+    visit_id integer primary key,
+    patient text not null,
+    visit_time real not null,
+    report text not null,
+    info text,
+    predictions text,
+    parts text,
+    unique (patient, report)
+);
+create index if not exists visits_patient on visits (patient, visit_time);
+create table if not exists profile_values (
+    patient text not null,
+    visit_time real not null,
+    visit_id integer not null,
+    metabolite text not null,
+    result real,
+    lower real,
+    upper real,
+    verdict text
+);
+create index if not exists profile_values_patient on profile_values (patient, visit_time);
+'''
+
+
+def patient_key(number):
+    """
+    Номер as stored: 54512, 54512.0 and '54512' are the same patient
+    """
+    if isinstance(number, (float, np.floating)) and float(number).is_integer():
+        number = int(number)
+    return str(number).strip()
+
+
+def json_ready(values):
+    return {str(k) : (None if pd.isna(v) else v.item() if isinstance(v, np.generic) else v)
+            for k, v in values.items()}
+
+
+class ProfileHistory(SQLiteStore):
+
+    schema = schema
+    private = True
+
+    def save(self, result, visit_time = None):
+        """
+        result - pipeline result with 'visit' (pipeline.content_key()), saved once
+        per patient and content, whatever figure engine the report was drawn with
+        returns visit id, None if it was saved before
+        """
+        info = result['info']
+        profile = result['profile']
+        patient = patient_key(info['Номер'].iloc[0])
+        visit_time = time.time() if visit_time is None else visit_time
+
+        predictions = dict()
+        for name in ('desease_cvd', 'desease', 'desease_lc'):
+            predictions.update(result[name])
+
+        with self._transaction() as db:
+            cursor = db.execute('insert or ignore into visits (patient, visit_time, report, info, predictions, parts) '
+                                'values (?, ?, ?, ?, ?, ?)',
+                                (patient, visit_time, result['visit'],
+                                 json.dumps(json_ready(info.iloc[0]), ensure_ascii = False),
+                                 json.dumps(json_ready(predictions), ensure_ascii = False),
+                                 json.dumps(gmf.get_parts(profile))))
+            if cursor.rowcount == 0:
+                return None
+            visit_id = cursor.lastrowid
+
+            rows = zip(profile.index,
+                       profile['Результат'].astype(float),
+                       profile['Нижняя граница'].astype(float),
+                       profile['Верхняя граница'].astype(float),
+                       profile['Вывод'])
+            db.executemany('insert into profile_values values (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(patient, visit_time, visit_id, m, None if np.isnan(r) else r,
+                             None if np.isnan(lo) else lo, None if np.isnan(hi) else hi, v)
+                            for m, r, lo, hi, v in rows])
+        return visit_id
+
+    def visits(self, patient):
+        """
+        returns DataFrame of the patient's visits ordered by time: visit_id, visit_time,
+        report, info, predictions, parts (dicts / lists)
+        """
+        df = pd.read_sql_query('select visit_id, visit_time, report, info, predictions, parts from visits '
+                               'where patient = ? order by visit_time', self.db, params = (patient_key(patient),))
+        for col in ('info', 'predictions', 'parts'):
+            df[col] = df[col].map(json.loads)
+        return df
+
+    def values(self, patient):
+        """
+        returns long DataFrame of all metabolite values of the patient ordered by time
+        """
+        return pd.read_sql_query('select visit_id, visit_time, metabolite, result, lower, upper, verdict '
+                                 'from profile_values where patient = ? order by visit_time',
+                                 self.db, params = (patient_key(patient),))
+
+    def trend(self, patient, last = 4):
+        """
+        returns (visits, values) of the last visits of the patient
+        """
+        visits = self.visits(patient).tail(last)
+        values = self.values(patient)
+        return visits, values[values['visit_id'].isin(visits['visit_id'])]
+
+
+# not in the cache dir: the history has to survive restarts
+HISTORY_DB = os.environ.get('BIO_HISTORY_DB', os.path.join(user_data_dir('history'), 'history.sqlite'))
+
+profile_history = ProfileHistory(HISTORY_DB) if HISTORY_DB else None
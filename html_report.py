@@ -0,0 +1,282 @@
+'''
+Static HTML reports: the sections of dash_app.report_output() as one
+self-contained file per patient that opens without the Dash server.
+
+The page skeleton (styles, logos, legend, headings and the footer) is
+compiled once per process into literal chunks and slot names, a report
+only fills the slots: patient table, main figure, model bars and the
+metabolite tables.
+
+    html = html_report.render_report(result)      # pipeline.analyse_bytes() result
+    bio-batch INPUT -o OUT_DIR --html              # reports/<file hash>/<row>_<Номер>.html
+'''
+
+import base64
+import functools
+import io
+import math
+import os
+import re
+from html import escape
+
+import get_main_figure as gmf
+
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+
+# the main figure of static reports, svg-lite does not need matplotlib
+REPORT_ENGINE = os.environ.get('BIO_REPORT_ENGINE', 'svg-lite')
+
+# Результат cell class, the first verdict column > 0 wins like the last rule in metabolit_info
+verdict_classes = [('Повышено', 'up'), ('Риск повышения', 'risk-up'),
+                   ('Риск понижения', 'risk-down'), ('Понижено', 'down')]
+
+report_css = '''
+body { font-family: sans-serif; }
+.page { min-height: 0; }
+table { border-collapse: collapse; width: 98%; margin: 0 auto; font-size: 14px; }
+th, td { border: 1px solid #d9d9d9; padding: 3px 5px; text-align: center; background: white; }
+th { font-weight: bold; }
+td.name { text-align: left; }
+td.up { background: red; color: white; }
+td.risk-up { background: lightyellow; }
+td.risk-down { background: aliceblue; }
+td.down { background: aqua; }
+h3 { text-align: center; font-size: 20px; }
+.info td { font-size: 16px; }
+.figure svg, .figure img { width: 100%; display: block; border-radius: 5px 5px 0 0; margin-top: 8px; }
+.legend { width: 100%; display: block; border-radius: 0 0 5px 5px; }
+.bars { width: 90%; margin: 6px auto; }
+.bar { display: flex; align-items: center; margin: 4px 0; font-size: 14px; }
+.bar .label { width: 30%; text-align: right; padding-right: 8px; }
+.bar .track { width: 60%; background: #f3f3f1; }
+.bar .fill { display: block; height: 16px; }
+.bar .value { padding-left: 6px; font-weight: bold; white-space: nowrap; }
+.header, .footer { width: 100%; display: flex; margin-top: 10px; }
+.footer p { margin: 0; font-size: 11px; text-align: right; }
+'''
+
+page_skeleton = '''<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>Метаболомный профиль {{number}}</title>
+<style>{{css}}</style>
+</head>
+<body>
+<div class="page">
+<div class="header">
+<div style="width:50%"><img src="{{ncmu_logo}}" style="width:100px;height:110px"><img src="{{sechenov_logo}}" style="width:110px;height:110px;margin-left:16px"></div>
+<div style="width:50%"><img src="{{metaboscan_logo}}" style="float:right;width:200px;margin-top:25px"></div>
+</div>
+<div class="six columns pretty_container">
+<h3>Результаты метаболомного профилирования</h3>
+<br>
+<h5 style="font-size:16px">Информация о пациенте</h5>
+{{info}}
+</div>
+<div class="figure">{{figure}}<img class="legend" src="{{legend}}"></div>
+<div class="six columns pretty_container">
+<h3>Сердечно-сосудистые патологии</h3>
+{{cvd}}
+{{desease}}
+</div>
+<div class="six columns pretty_container">
+<h3>Онкологические заболевания</h3>
+{{lc}}
+</div>
+{{metabolites}}
+<div class="footer">
+<div style="width:52%"><p style="text-align:left;font-style:italic;font-size:13px;margin-top:4px">Результаты данного отчета не являются диагнозом и должны быть интерпретированы лечащим врачом на основании клинико-лабораторных данных и других диагностических исследований</p></div>
+<div style="width:48%">
+<p>117418 Москва | Нахимовский проспект, 45</p>
+<p style="font-weight:bold">Лаборатория фармакокинетики и метаболомного анализа</p>
+<p>Институт трансляционной медицины и биотехнологий</p>
+<p>Сеченовского Университета</p>
+</div>
+</div>
+</div>
+</body>
+</html>
+'''
+
+
+class CompiledTemplate:
+    """
+    text with {{slot}} markers split once into literal chunks and slot names,
+    render() only joins the chunks with the slot values
+    """
+
+    def __init__(self, text):
+        parts = re.split(r'\{\{(\w+)\}\}', text)
+        self.chunks = parts[0::2]
+        self.slots = parts[1::2]
+
+    def render(self, values):
+        """
+        values - dict: {'slot' : HTML text}, raises KeyError for a missing slot
+        """
+        out = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            out.append(values[slot])
+            out.append(chunk)
+        return ''.join(out)
+
+    def partial(self, values):
+        """
+        returns a new template with the given slots filled
+        """
+        return CompiledTemplate(self.render({slot : values.get(slot, '{{%s}}' % slot) for slot in self.slots}))
+
+
+def image_uri(fname, width = None):
+    """
+    asset as a data URI, scaled down to width pixels when Pillow is installed
+    (it comes with matplotlib): the logos are stored far larger than shown
+    """
+    fname = os.path.join(ASSETS_DIR, fname)
+    media_type = 'image/jpeg' if fname.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
+    with open(fname, 'rb') as f:
+        content = f.read()
+
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None and width is not None:
+        image = Image.open(io.BytesIO(content))
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            buf = io.BytesIO()
+            if media_type == 'image/jpeg':
+                image.convert('RGB').save(buf, format = 'JPEG', quality = 90)
+            else:
+                image.save(buf, format = 'PNG', optimize = True)
+            content = buf.getvalue()
+
+    return f'data:{media_type};base64,{base64.b64encode(content).decode("ascii")}'
+
+
+@functools.lru_cache(maxsize = 1)
+def page_template():
+    """
+    the report page with styles and images inlined, built once per process
+    """
+    with open(os.path.join(ASSETS_DIR, 'base.css'), encoding = 'utf8') as f:
+        css = f.read() + report_css
+    # twice the displayed size keeps the images sharp in print
+    return CompiledTemplate(page_skeleton).partial({
+        'css' : css,
+        'ncmu_logo' : image_uri('NCMU_logo.jpeg', 200),
+        'sechenov_logo' : image_uri('sechenov_logo(1).png', 220),
+        'metaboscan_logo' : image_uri('metaboscan_logo.png', 400),
+        'legend' : image_uri('legend_full.png', 1600),
+        })
+
+
+def cell(value):
+    if isinstance(value, str):
+        return escape(value)
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return f'{value:.2f}'
+
+
+def info_table(info):
+    """
+    info - 1st result of prepare_data(), one row
+    """
+    head = ''.join(f'<th>{escape(str(x))}</th>' for x in info.columns)
+    rows = ''.join('<tr>' + ''.join(f'<td>{escape(str(x))}</td>' for x in row) + '</tr>'
+                   for row in info.itertuples(index = False))
+    return f'<table class="info"><tr>{head}</tr>{rows}</table>'
+
+
+def model_bars(deseases):
+    """
+    deseases - dict: {'desease name' : desease probability}
+    """
+    rows = []
+    for name, value in deseases.items():
+        label = escape(name.replace('\n', ' '))
+        width = min(max(float(value), 0.0), 100.0)
+        rows.append(f'<div class="bar"><span class="label">{label}</span>'
+                    f'<span class="track"><span class="fill" style="width:{width:.1f}%;'
+                    f'background:{gmf.get_graph_color(width)}"></span></span>'
+                    f'<span class="value">{value:.2f} %</span></div>')
+    return '<div class="bars">' + ''.join(rows) + '</div>'
+
+
+def metabolite_tables(profile, groups_content):
+    """
+    profile - 2nd result of prepare_data(), groups_content - {'group name' : [metabolites]}
+    returns list of HTML tables with the rows and columns of dash_app.metabolit_info,
+    every profile row is formatted once even when it is listed in several groups
+    """
+    columns = ['Метаболит'] + profile.columns.to_list()
+    classes = [''] * len(profile)
+    for column, css_class in reversed(verdict_classes):
+        if column in profile:
+            flags = (profile[column] > 0).to_numpy()
+            classes = [f' class="{css_class}"' if flag else c for c, flag in zip(classes, flags)]
+
+    result = columns.index('Результат')
+    values = [profile.index.to_list()] + [profile[column].to_list() for column in columns[1:]]
+    rows = []
+    for i, row in enumerate(zip(*values)):
+        cells = [f'<td class="name">{escape(str(row[0]))}</td>']
+        for j, value in enumerate(row[1:], 1):
+            cells.append(f'<td{classes[i] if j == result else ""}>{cell(value)}</td>')
+        rows.append('<tr>' + ''.join(cells) + '</tr>')
+
+    # metabolites without a range are skipped like in metabolit_frame
+    has_range = profile['Верхняя граница'].notna().to_numpy()
+    position = {name : i for i, name in enumerate(profile.index)}
+    head = '<tr>' + ''.join(f'<th>{escape(x)}</th>' for x in columns) + '</tr>'
+    tables = []
+    for name, metabolites in groups_content.items():
+        group_rows = [rows[position[x]] for x in metabolites if has_range[position[x]]]
+        tables.append(f'<div class="six columns pretty_container"><h3>{escape(name)}</h3>'
+                      f'<table>{head}' + ''.join(group_rows) + '</table></div>')
+    return tables
+
+
+def figure_html(profile, part_dis, engine = None):
+    """
+    the main figure inline: SVG markup as is, PNG as a data URI
+    """
+    engine = engine or REPORT_ENGINE
+    _, media_type = gmf.engines[engine]
+    if media_type is None:
+        raise ValueError(f'{engine} figures need a browser with plotly, use svg-lite, svg or png')
+    figure = gmf.render(profile, part_dis, engine)
+    if media_type == 'image/svg+xml':
+        # the XML declaration of matplotlib SVG is not allowed inside HTML
+        return re.sub(r'^<\?xml[^>]*>\s*(<!DOCTYPE[^>]*>\s*)?', '', figure.decode('utf8'))
+    return f'<img src="data:{media_type};base64,{base64.b64encode(figure).decode("ascii")}">'
+
+
+def report_html(info, profile, groups_content, desease_cvd, desease, desease_lc, engine = None):
+    """
+    info, profile, groups_content - prepare_data() results (info with one row),
+    desease_* - desease_prediction_*() results
+    returns the report page as text
+    """
+    part_dis = gmf.get_part_dis(desease_cvd, desease_lc)
+    return page_template().render({
+        'number' : escape(str(info['Номер'].iloc[0])),
+        'info' : info_table(info),
+        'figure' : figure_html(profile, part_dis, engine),
+        'cvd' : model_bars(desease_cvd),
+        'desease' : model_bars(desease),
+        'lc' : model_bars(desease_lc),
+        'metabolites' : '\n'.join(metabolite_tables(profile, groups_content)),
+        })
+
+
+def render_report(result, engine = None):
+    """
+    result - pipeline.analyse_bytes() output
+    """
+    return report_html(result['info'], result['profile'], result['groups_content'],
+                       result['desease_cvd'], result['desease'], result['desease_lc'], engine)
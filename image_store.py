@@ -0,0 +1,58 @@
+'''
+Content-addressed store of rendered report images.
+
+The report layout references the main figure by URL instead of embedding
+it as a base64 data URI: the image is put here under the sha256 of its
+bytes and served by the /images/<digest>.<ext> route with a strong ETag
+and an immutable Cache-Control, so browsers and proxies fetch every
+distinct figure once.
+
+The disk tier (BIO_IMAGE_DIR, a private directory of the user by default,
+see result_cache.private_directory()) is shared by all worker processes of
+a host, so any worker can answer for an image rendered by another one.
+BIO_IMAGE_DIR='' keeps images in memory only.
+'''
+
+import hashlib
+import os
+
+from flask import Blueprint, abort, current_app, request
+
+from result_cache import ResultCache, user_cache_dir
+
+
+extensions = {'image/png' : 'png', 'image/svg+xml' : 'svg'}
+
+image_cache = ResultCache(
+    max_bytes = int(os.environ.get('BIO_IMAGE_CACHE_BYTES', 64 * 2**20)),
+    directory = os.environ.get('BIO_IMAGE_DIR', user_cache_dir('images')) or None,
+    max_disk_bytes = int(os.environ.get('BIO_IMAGE_DISK_BYTES', 2**30)))
+
+blueprint = Blueprint('images', __name__)
+
+
+def put_image(data, media_type):
+    """
+    data - image bytes, media_type - one of extensions
+    returns path of the image: /images/<sha256>.<ext>
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if digest not in image_cache:
+        image_cache.put(digest, (media_type, data))
+    return f'/images/{digest}.{extensions[media_type]}'
+
+
+@blueprint.route('/images/<digest>.<ext>')
+def get_image(digest, ext):
+    # the content never changes under its hash: revalidation needs no lookup
+    if digest in request.if_none_match:
+        response = current_app.response_class(status = 304)
+    else:
+        item = image_cache.get(digest)
+        if item is None or extensions[item[0]] != ext:
+            abort(404)
+        media_type, data = item
+        response = current_app.response_class(data, mimetype = media_type)
+    response.set_etag(digest)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
@@ -0,0 +1,144 @@
+'''
+Reading uploaded / batch input tables.
+
+The format is detected from the content (file name extension as a hint),
+every format is read with the fastest reader available and the result is
+checked against the expected schema: info_columns + numeric metabolites.
+Text tables are utf-8 or cp1251, ';' separated ones use a decimal comma
+like the CSV export of Russian Excel.
+
+Optional readers: pyarrow (CSV, Parquet), python-calamine (Excel).
+'''
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from bio_df_processing import info_columns, sample_date_column, canonical_metabolites
+
+
+formats = ['xlsx', 'xls', 'parquet', 'csv', 'tsv']
+
+
+def has_module(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def detect_format(content, filename = None):
+    """
+    content - file bytes
+    returns one of formats
+    """
+    head = content[:8]
+    if head.startswith(b'PAR1'):
+        return 'parquet'
+    if head.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    if head.startswith(b'\xd0\xcf\x11\xe0'):
+        return 'xls'
+
+    ext = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if ext in ('tsv', 'tab'):
+        return 'tsv'
+
+    # text table: pick the delimiter from the header line
+    return 'tsv' if text_delimiter(content) == '\t' else 'csv'
+
+
+def text_encoding(content):
+    """
+    utf-8 (with or without BOM), otherwise cp1251 of the Russian Excel CSV export
+    """
+    try:
+        content.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'cp1251'
+    return 'utf-8-sig'
+
+
+def text_delimiter(content):
+    first_line = content.split(b'\n', 1)[0].decode('utf-8-sig', errors = 'replace')
+    counts = {d : first_line.count(d) for d in ',;\t'}
+    return max(counts, key = counts.get)
+
+
+def read_text(content, delimiter):
+    encoding = text_encoding(content)
+    if delimiter == ',' and encoding == 'utf-8-sig' and has_module('pyarrow'):
+        # multi-threaded parser, several times faster than the C engine on large files
+        return pd.read_csv(io.BytesIO(content), engine = 'pyarrow', encoding = 'utf-8')
+    # ';' separated files come from locales with a decimal comma (Russian Excel)
+    return pd.read_csv(io.BytesIO(content), sep = delimiter, encoding = encoding,
+                       decimal = ',' if delimiter == ';' else '.')
+
+
+def read_excel(content, fmt = 'xlsx'):
+    if has_module('python_calamine'):
+        # Rust reader, an order of magnitude faster than openpyxl
+        return pd.read_excel(io.BytesIO(content), engine = 'calamine')
+    if fmt == 'xls':
+        return pd.read_excel(io.BytesIO(content))
+    # pandas opens the workbook read-only: rows are streamed, not kept as cell objects
+    return pd.read_excel(io.BytesIO(content), engine = 'openpyxl')
+
+
+def enforce_schema(df):
+    """
+    checks info_columns are present, converts metabolite columns to float and
+    renames them to canonical names, raises ValueError describing the problem otherwise
+    """
+    df.columns = [str(x) for x in df.columns]
+
+    missing = [x for x in info_columns if x not in df.columns]
+    if missing:
+        raise ValueError(f'missing patient info columns: {missing}')
+
+    metabolites = [x for x in df.columns if x not in info_columns and x != sample_date_column]
+    if not metabolites:
+        raise ValueError('no metabolite columns')
+
+    # one spelling per metabolite from here on, see metabolites.py
+    canonical = canonical_metabolites(metabolites)
+    if canonical.has_duplicates:
+        raise ValueError(f'duplicated metabolite columns: {list(canonical[canonical.duplicated()])}')
+
+    values = df[metabolites]
+    if not all(np.issubdtype(t, np.number) for t in values.dtypes):
+        converted = values.apply(pd.to_numeric, errors = 'coerce')
+        # a value that was there but is not a number, e.g. '12,5' or '<LOD'
+        bad = converted.isna() & values.notna()
+        if bad.any().any():
+            raise ValueError(f'non-numeric metabolite values in columns: {list(bad.columns[bad.any()])}')
+        values = converted
+    df[metabolites] = values.astype(float)
+    df = df.rename(columns = dict(zip(metabolites, canonical)))
+
+    return df
+
+
+def read_table(content, filename = None):
+    """
+    content - file bytes (upload or batch input)
+    returns DataFrame with one patient per row
+    """
+    fmt = detect_format(content, filename)
+    if fmt in ('xlsx', 'xls'):
+        df = read_excel(content, fmt)
+    elif fmt == 'parquet':
+        df = pd.read_parquet(io.BytesIO(content))
+    elif fmt == 'tsv':
+        df = read_text(content, '\t')
+    else:
+        df = read_text(content, text_delimiter(content))
+    return enforce_schema(df)
+
+
+def read_file(fname):
+    with open(fname, 'rb') as f:
+        return read_table(f.read(), fname)
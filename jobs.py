@@ -0,0 +1,296 @@
+'''
+SQLite-backed queue of upload jobs.
+
+A job is one upload of one or more files; every file is a queue item.
+A runner thread of the serving process claims files and processes them
+in a pool of BIO_JOB_WORKERS processes, the workers report stages and
+see cancellation through the database. BIO_JOB_WORKERS=0 (the gunicorn
+setup) processes files in the runner threads, every gunicorn worker
+runs them:
+
+    queued -> running -> done | failed | cancelled
+
+The database (BIO_JOBS_DB, jobs.sqlite in a private directory of the user
+by default) holds the uploads and pickled results, so its directory must
+be the user's only (see sqlite_store.py). It is shared by all gunicorn
+workers of a host: any of them may process a file and any of them may
+answer a progress poll. A file whose runner died is queued again once its
+lease expires, failed files can be queued again by retry().
+'''
+
+import os
+import pickle
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import pipeline
+from result_cache import user_cache_dir
+from sqlite_store import SQLiteStore
+
+
+# worker processes for queued files, 0 - process them in the runner threads
+JOB_WORKERS = int(os.environ.get('BIO_JOB_WORKERS', max(2, os.cpu_count() or 1)))
+
+# runner threads per process without worker processes, 0 - do not process jobs in this process
+JOB_THREADS = int(os.environ.get('BIO_JOB_THREADS', 1))
+
+# a running file not updated for this long is considered abandoned
+LEASE_SECONDS = 600
+
+# finished jobs are removed after a day
+JOB_TTL = 24 * 3600
+
+finished_states = ('done', 'failed', 'cancelled')
+
+schema = '''
+create table if not exists jobs (
+    id text primary key,
+    session text,
+    engine text,
+    created real,
+    cancelled integer default 0
+);
+create table if not exists job_files (
+    job_id text,
+    idx integer,
+    filename text,
+    content blob,
+    state text,
+    stage text,
+    attempts integer default 0,
+    error text,
+    result blob,
+    updated real,
+    primary key (job_id, idx)
+);
+create index if not exists job_files_state on job_files (state, updated);
+'''
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobQueue(SQLiteStore):
+
+    schema = schema
+    private = True
+
+    def __init__(self, path, threads = JOB_THREADS, workers = JOB_WORKERS):
+        super().__init__(path)
+        self.threads = threads
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._runners = []
+        self._pool = None
+        self._pid = None
+
+    def submit(self, session, files, engine = 'png'):
+        """
+        files - list of (filename, decoded content)
+        returns job id
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('delete from job_files where job_id in (select id from jobs where created < ?)',
+                       (now - JOB_TTL,))
+            db.execute('delete from jobs where created < ?', (now - JOB_TTL,))
+            db.execute('insert into jobs (id, session, engine, created) values (?, ?, ?, ?)',
+                       (job_id, session, engine, now))
+            db.executemany('insert into job_files (job_id, idx, filename, content, state, stage, updated) '
+                           "values (?, ?, ?, ?, 'queued', 'queued', ?)",
+                           [(job_id, i, name, content, now) for i, (name, content) in enumerate(files)])
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def status(self, job_id):
+        """
+        returns list of dicts (one per file): filename, state, stage, attempts, error
+        """
+        rows = self.db.execute('select filename, state, stage, attempts, error from job_files '
+                               'where job_id = ? order by idx', (job_id,)).fetchall()
+        return [dict(zip(['filename', 'state', 'stage', 'attempts', 'error'], row)) for row in rows]
+
+    def finished(self, job_id):
+        return all(x['state'] in finished_states for x in self.status(job_id))
+
+    def results(self, job_id):
+        """
+        returns list of (result, error) in the upload order, like pipeline.analyse_uploads()
+        """
+        rows = self.db.execute('select filename, state, error, result from job_files '
+                               'where job_id = ? order by idx', (job_id,)).fetchall()
+        res = []
+        for filename, state, error, result in rows:
+            if state == 'done':
+                res.append((pickle.loads(result), None))
+            else:
+                res.append((None, error or f'{filename}: {state}'))
+        return res
+
+    def cancel(self, job_id):
+        with self._transaction() as db:
+            db.execute('update jobs set cancelled = 1 where id = ?', (job_id,))
+            db.execute("update job_files set state = 'cancelled', stage = 'cancelled', updated = ? "
+                       "where job_id = ? and state = 'queued'", (time.time(), job_id))
+
+    def retry(self, job_id):
+        """
+        queues failed and cancelled files of the job again
+        """
+        with self._transaction() as db:
+            db.execute('update jobs set cancelled = 0 where id = ?', (job_id,))
+            db.execute("update job_files set state = 'queued', stage = 'queued', error = null, updated = ? "
+                       "where job_id = ? and state in ('failed', 'cancelled')", (time.time(), job_id))
+        self.start()
+        self._wakeup.set()
+
+    def _claim(self):
+        """
+        marks the oldest queued (or abandoned running) file as running and returns it
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("select f.job_id, f.idx, f.filename, f.content, j.engine, j.created from job_files f "
+                             "join jobs j on j.id = f.job_id "
+                             "where f.state = 'queued' or (f.state = 'running' and f.updated < ?) "
+                             "order by j.created, f.idx limit 1", (now - LEASE_SECONDS,)).fetchone()
+            if row is not None:
+                db.execute("update job_files set state = 'running', stage = 'start', "
+                           "attempts = attempts + 1, updated = ? where job_id = ? and idx = ?",
+                           (now, row[0], row[1]))
+        return row
+
+    def _progress(self, job_id, idx, stage):
+        with self._transaction() as db:
+            db.execute('update job_files set stage = ?, updated = ? where job_id = ? and idx = ?',
+                       (stage, time.time(), job_id, idx))
+            cancelled, = db.execute('select cancelled from jobs where id = ?', (job_id,)).fetchone()
+        if cancelled:
+            raise JobCancelled()
+
+    def _finish(self, job_id, idx, state, stage, error = None, result = None):
+        with self._transaction() as db:
+            db.execute('update job_files set state = ?, stage = ?, error = ?, result = ?, updated = ? '
+                       'where job_id = ? and idx = ?',
+                       (state, stage, error, result, time.time(), job_id, idx))
+
+    def run_file(self, job_id, idx, filename, content, engine, created):
+        """
+        processes one claimed file and stores its outcome, runs in a worker process
+        or in a runner thread; ages are computed on the day the job was submitted
+        """
+        try:
+            result = pipeline.analyse_with_progress(content, filename, engine,
+                                                    lambda stage: self._progress(job_id, idx, stage),
+                                                    pipeline.analysis_date(created))
+        except JobCancelled:
+            self._finish(job_id, idx, 'cancelled', 'cancelled')
+        except Exception as e:
+            self._finish(job_id, idx, 'failed', 'failed', error = f'{filename}: {e!r}')
+        else:
+            self._finish(job_id, idx, 'done', 'done',
+                         result = pickle.dumps(result, protocol = pickle.HIGHEST_PROTOCOL))
+
+    def process_one(self):
+        """
+        processes one queued file in this thread, returns False if there was none
+        """
+        row = self._claim()
+        if row is None:
+            return False
+        self.run_file(*row)
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                while self.process_one():
+                    pass
+            except Exception:
+                traceback.print_exc()
+            # other processes may queue files as well, look again from time to time
+            self._wakeup.wait(timeout = 1)
+            self._wakeup.clear()
+
+    def _dispatch(self):
+        """
+        keeps up to self.workers claimed files running in the process pool
+        """
+        running = {}
+        while True:
+            try:
+                while len(running) < self.workers:
+                    row = self._claim()
+                    if row is None:
+                        break
+                    try:
+                        if self._pool is None:
+                            self._pool = pipeline.new_pool(self.workers)
+                        running[self._pool.submit(run_file, self.path, row)] = row
+                    except Exception as e:
+                        self._finish(row[0], row[1], 'failed', 'failed', error = f'{row[2]}: {e!r}')
+                        self._pool = None
+                        raise
+            except Exception:
+                traceback.print_exc()
+                time.sleep(1)
+
+            if not running:
+                self._wakeup.wait(timeout = 1)
+                self._wakeup.clear()
+                continue
+
+            done, _ = wait(running, timeout = 1, return_when = FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                job_id, idx, filename = running.pop(future)[:3]
+                try:
+                    future.result()
+                except Exception as e:
+                    # the worker process died, the file is not left running until its lease expires
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    self._finish(job_id, idx, 'failed', 'failed', error = f'{filename}: {e!r}')
+            if broken:
+                self._pool.shutdown(wait = False, cancel_futures = True)
+                self._pool = None
+
+    def start(self):
+        """
+        starts the runner threads in this process (again after a fork)
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._runners = []
+                self._pool = None
+                self._pid = os.getpid()
+            self._runners = [x for x in self._runners if x.is_alive()]
+            # with worker processes one thread feeds the pool
+            target, count = (self._dispatch, 1) if self.workers > 0 else (self._run, self.threads)
+            while len(self._runners) < count:
+                runner = threading.Thread(target = target, name = 'job-runner', daemon = True)
+                runner.start()
+                self._runners.append(runner)
+
+
+# queue of the worker process by database path
+_worker_queues = {}
+
+
+def run_file(path, row):
+    """
+    process pool entry point: row - (job_id, idx, filename, content, engine, created) claimed by _dispatch
+    """
+    if path not in _worker_queues:
+        _worker_queues[path] = JobQueue(path, threads = 0, workers = 0)
+    _worker_queues[path].run_file(*row)
+
+
+job_queue = JobQueue(os.environ.get('BIO_JOBS_DB', os.path.join(user_cache_dir('jobs'), 'jobs.sqlite')))
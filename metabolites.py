@@ -0,0 +1,154 @@
+'''
+Canonical metabolite names.
+
+Input headers, range tables, group lists and model features spell the same
+metabolite in different ways: Cyrillic letters that look like Latin ones
+('С6DC' / 'C6DC'), spacing, case, or a short code ('Gly', 'C5-DC').
+Every spelling is reduced to a lookup key by name_key() and the registry
+maps keys (and aliases) to an integer id and one canonical name, so the
+rest of the pipeline compares integers instead of strings.
+
+Ids are never reused or renumbered, arrays indexed by id only need to be
+extended when new names are registered.
+'''
+
+import functools
+import re
+import threading
+import unicodedata
+
+import numpy as np
+
+
+# Cyrillic letters with a Latin twin
+lookalikes = str.maketrans('АВСЕЁКМНОРТХУавсеёкмнорстухіІ',
+                           'ABCEEKMHOPTXYabceekmhopctyxiI')
+
+# other spellings -> canonical name, e.g. column names of the GrBoost_cardio model;
+# lookalike, spacing and case variants do not need an entry
+aliases = {'5-hydroxytryptophan' : '5-Hydroxytryptophan',
+           'Anthranillic acid' : 'Antranillic acid',
+           'Xanthurenic acid' : 'Xanturenic acid',
+           'Indole-3-lactic acid' : 'Indole-3-lactate',
+           'Indole-3-acetic acid' : 'Indole-3-acetate',
+           'Indole-3-acrylic acid' : 'Indole-3-acrylate',
+           'Indole-3-propionic acid' : 'Indole-3-propionate',
+           'Indole-3-butyric' : 'Indole-3-butyrate',
+           'Gly' : 'Глицин',
+           'Ala' : 'Аланин',
+           'Pro' : 'Пролин',
+           'Val' : 'Валин',
+           'Leu' : 'Лейцин',
+           'Ile' : 'Изолейцин',
+           'Ornithine' : 'Орнитин',
+           'Asp' : 'Аспаргиновая кислота',
+           'Phe' : 'Фенилаланин',
+           'Arg' : 'Аргинин',
+           'Arginine' : 'Аргинин',
+           'Citrulline' : 'Цитруллин',
+           'Ser' : 'Серин',
+           'Thr' : 'Треонин',
+           'Lys' : 'Лизин',
+           'Tyr' : 'Тирозин',
+           'Met' : 'Метионин',
+           'C0' : 'Карнитин (С0)',
+           'C2' : 'Acetylcarnitine (С2)',
+           'C3' : 'Propionylcarnitine (С3)',
+           'C4' : 'Butyrylcarnitine (С4)',
+           'C5' : 'Isovalerylcarnitine (iC5)',
+           'C5-1' : 'Tiglylcarnitine (C5:1)',
+           'C5-OH' : 'Hydroxyisovalerylcarnitine (iC5-OH)',
+           'C5-DC' : 'Glutarylcarnitine (С5DC)',
+           'C6' : 'Hexanoylcarnitine (C6)',
+           'C6-DC' : 'Adipoylcarnitine (С6DC)',
+           # the template labels both C8 columns '(C8)', the acyl name tells them apart
+           'C8' : 'Octanoylcarnitine (C8)',
+           'C8-1' : 'Octenoylcarnitine (C8)',
+           'C10' : 'Decanoylcarnitine (C10)',
+           'C10-1' : 'Decenoylcarnitine (C10:1)',
+           'C10-2' : 'Decadienoylcarnitine (C10:2)',
+           'C12' : 'Dodecanoylcarnitine (С12)',
+           'C12-1' : 'Dodecenoylcarnitine (C12:1)',
+           'C14' : 'Tetradecanoylcarnitine (C14)',
+           'C14-1' : 'Tetradecenoylcarnitine (C14:1)',
+           'C14-2' : 'Tetradecadienoylcarnitine (C14:2)',
+           'C14-OH' : 'Hydroxytetradecanoylcarnitine (C14:2-OH)',
+           'C16' : 'Palmitoylcarnitine (C16)',
+           'C16-1' : 'Hexadecenoylcarnitine (C16:1)',
+           'C16-OH' : 'Hydroxyhexadecanoylcarnitine (C16-OH)',
+           'C16-1-OH' : 'Hydroxyhexadecenoylcarnitine (C16:1-OH)',
+           'C18' : 'Stearoylcarnitine (C18)',
+           'C18-1' : 'Oleoylcarnitine (C18:1)',
+           'ADMA' : 'АДМА',
+           'SDMA' : 'СДМА',
+           'Choline' : 'Холин (свободный)'}
+
+
+@functools.lru_cache(maxsize = 4096)
+def name_key(name):
+    """
+    'Adipoylcarnitine  (С6DC) ' -> 'adipoylcarnitine(c6dc)'
+    """
+    name = unicodedata.normalize('NFKC', str(name)).translate(lookalikes).casefold()
+    return re.sub(r'\s+', '', name)
+
+
+class MetaboliteRegistry:
+    """
+    names - canonical name of every id
+    """
+
+    def __init__(self, aliases = None):
+        self.names = []
+        self._ids = {}
+        self._aliases = {}
+        self._lock = threading.Lock()
+        for alias, name in (aliases or {}).items():
+            self.add_alias(alias, name)
+
+    def add_alias(self, alias, name):
+        self._aliases[name_key(alias)] = name_key(name)
+
+    def _key(self, name):
+        key = name_key(name)
+        return self._aliases.get(key, key)
+
+    def register(self, names, canonical = False):
+        """
+        gives ids to new names and returns ids of all names,
+        canonical - these spellings become the canonical names (range tables)
+        """
+        ids = []
+        with self._lock:
+            for name in names:
+                name = str(name).strip()
+                key = self._key(name)
+                i = self._ids.get(key)
+                if i is None:
+                    i = self._ids[key] = len(self.names)
+                    self.names.append(name)
+                elif canonical:
+                    self.names[i] = name
+                ids.append(i)
+        return np.array(ids, dtype = int)
+
+    def ids(self, names):
+        """
+        returns array of ids, -1 for unknown names
+        """
+        return np.array([self._ids.get(self._key(x), -1) for x in names], dtype = int)
+
+    def canonical(self, names):
+        """
+        returns list of canonical names, unknown names are only stripped
+        """
+        res = []
+        for name, i in zip(names, self.ids(names)):
+            res.append(self.names[i] if i >= 0 else str(name).strip())
+        return res
+
+    def __len__(self):
+        return len(self.names)
+
+
+metabolite_registry = MetaboliteRegistry(aliases)
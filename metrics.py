@@ -0,0 +1,230 @@
+'''
+Lightweight in-process metrics: counters, histograms and per-stage timers,
+rendered in the Prometheus text exposition format by the /metrics route.
+
+    with metrics.stage('parse'):
+        df = ingest.read_table(...)
+
+Stage durations go to the bio_stage_seconds histogram. Inside a
+collect() block they are gathered into a dict instead, so that work done
+in a worker process can be returned with its result and observed by the
+serving process (observe_stages()).
+
+instrument() adds the /metrics route and request timing to the Flask
+server. With BIO_PROFILE_DIR set every request is also run under cProfile
+and dumped to <BIO_PROFILE_DIR>/<time>_<pid>_<route>.prof (open with
+pstats or snakeviz).
+
+Values are per process: with several gunicorn workers every scrape shows
+the worker that answered it.
+'''
+
+import bisect
+import contextlib
+import cProfile
+import os
+import threading
+import time
+
+
+time_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+size_buckets = (2**10, 10 * 2**10, 100 * 2**10, 2**20, 10 * 2**20, 100 * 2**20)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                     for k, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # an unlabelled counter is exposed as 0 before the first inc()
+        self._values = {} if self.labelnames else {() : 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(labels.get(x, '') for x in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(x, '') for x in self.labelnames), 0)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames = (), buckets = time_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., +Inf count], sum
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(x, '') for x in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(tuple(labels.get(x, '') for x in self.labelnames), ([0], 0))
+        return sum(counts)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        names = self.labelnames + ('le',)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{format_labels(names, key + (format_value(bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {format_value(float(total))}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class CallbackMetric:
+    """
+    values are read from func() at scrape time: {label values tuple : value},
+    for counters kept elsewhere (cache statistics)
+    """
+
+    def __init__(self, name, documentation, func, labelnames = (), kind = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self.func().items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}')
+        return lines
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+stage_seconds = register(Histogram('bio_stage_seconds', 'Duration of upload processing stages.', ['stage']))
+uploads = register(Counter('bio_uploads_total', 'Uploaded files.'))
+upload_errors = register(Counter('bio_upload_errors_total', 'Uploaded files that could not be processed.'))
+upload_bytes = register(Histogram('bio_upload_bytes', 'Size of uploaded files.', buckets = size_buckets))
+request_seconds = register(Histogram('bio_request_seconds', 'Duration of HTTP requests.', ['endpoint']))
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def collect():
+    """
+    gathers stage durations of this thread into the yielded dict {'stage' : seconds}
+    """
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings = {}
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+@contextlib.contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            stage_seconds.observe(elapsed, stage = name)
+        else:
+            timings[name] = timings.get(name, 0) + elapsed
+
+
+def observe_stages(timings):
+    """
+    timings - dict gathered by collect(), possibly in another process
+    """
+    for name, elapsed in timings.items():
+        stage_seconds.observe(elapsed, stage = name)
+
+
+def exposition():
+    """
+    all registered metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+
+def instrument(server):
+    """
+    server - Flask app: adds request timing, the /metrics route and,
+    when BIO_PROFILE_DIR is set, a cProfile dump of every request
+    """
+    from flask import g, request
+
+    profile_dir = os.environ.get('BIO_PROFILE_DIR')
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok = True)
+
+    @server.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        if profile_dir:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @server.after_request
+    def finish_request(response):
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            request_seconds.observe(time.perf_counter() - start, endpoint = endpoint)
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            name = f"{time.time_ns()}_{os.getpid()}_{endpoint.strip('/').replace('/', '_') or 'index'}.prof"
+            profiler.dump_stats(os.path.join(profile_dir, name))
+        return response
+
+    @server.route('/metrics')
+    def metrics_route():
+        return server.response_class(exposition(), mimetype = 'text/plain; version=0.0.4; charset=utf-8')
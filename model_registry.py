@@ -0,0 +1,149 @@
+'''
+Process-wide registry of the prediction models.
+
+Every model and its scaler are loaded once from the arrays exported by
+tree_ensemble.py (<model>.npz) and warmed with a dummy prediction, after
+that predict_proba() scores a whole feature matrix (one row per patient)
+in a single call. Serving does not import scikit-learn unless an .npz is
+missing or older than its pickles, then the pickles are converted in memory.
+'''
+
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import tree_ensemble
+from metabolites import metabolite_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+def feature_matrix(profile, features, absent = 'raise'):
+    """
+    profile - 2nd result of prepare_data() or prepare_cohort()
+    features - list of metabolites, e.g. model_requirements
+    absent - 'raise': KeyError for features the profile has no column for, 'nan': NaN columns
+
+    returns DataFrame: one row per patient, one column per feature
+    """
+    values = profile['Результат']
+    if isinstance(values.index, pd.MultiIndex):
+        patients = values.index.unique('Пациент')
+        wide = values.unstack('Метаболит').reindex(patients)
+    else:
+        wide = values.to_frame().T
+
+    # features and profile metabolites are matched by canonical id, so
+    # 'Gly' or 'Adipoylcarnitine (C6DC)' find 'Глицин' and 'Adipoylcarnitine (С6DC)'
+    ids = metabolite_registry.register(features)
+    position = {i : p for p, i in enumerate(metabolite_registry.ids(wide.columns)) if i >= 0}
+    missing = [x for x, i in zip(features, ids) if i not in position]
+    if missing and absent == 'raise':
+        raise KeyError(f'profile has no values for model features: {missing}')
+
+    data = wide.iloc[:, [position[i] for i in ids if i in position]].astype(float)
+    data.columns = [x for x, i in zip(features, ids) if i in position]
+    return data.reindex(columns = list(features)) if missing else data
+
+
+class ModelRegistry:
+    """
+    specs - dict: {'model name' : {'model' : pickle file,
+                                   'scaler' : pickle file or None,
+                                   'features' : list of metabolites or None}}
+    features None means the model's own feature_names_in_,
+    the exported arrays are read from 'arrays' (<model>.npz by default)
+    """
+
+    def __init__(self, specs):
+        self.specs = dict(specs)
+        self._models = {}
+        self.errors = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _load_one(self, name):
+        spec = self.specs[name]
+        source = tree_ensemble.file_digest([spec['model'], spec.get('scaler')])
+        fname = tree_ensemble.arrays_fname(spec)
+        model = tree_ensemble.TreeEnsemble.load(fname) if os.path.exists(fname) else None
+        if model is None or model.source != source:
+            logger.warning('model %s: %s is missing or stale, converting the pickles '
+                           '(run python tree_ensemble.py to export them)', name, fname)
+            model = tree_ensemble.export_spec(spec)[0]
+
+        # warm up with an average patient: the first call allocates
+        # the index arrays of the tree walk
+        dummy = model.mean if model.mean.size else np.ones(model.n_features_in_)
+        model.predict_proba(dummy)
+
+        self._models[name] = model
+
+    def load(self):
+        """
+        loads and warms every model, a model that fails to load is reported
+        in self.errors and stays unavailable, the others are still served;
+        cheap once everything is loaded
+        """
+        with self._lock:
+            for name in self.specs:
+                if name in self._models or name in self.errors:
+                    continue
+                try:
+                    self._load_one(name)
+                except Exception as e:
+                    logger.error('model %s is not available: %r', name, e)
+                    self.errors[name] = e
+        return self
+
+    def version(self):
+        """
+        hash of all model and scaler files
+        """
+        if self._version is None:
+            h = hashlib.sha256()
+            for name in sorted(self.specs):
+                for key in ('model', 'scaler'):
+                    fname = self.specs[name].get(key)
+                    if fname:
+                        with open(fname, 'rb') as f:
+                            h.update(f.read())
+            self._version = h.hexdigest()
+        return self._version
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def get(self, name):
+        if name not in self._models:
+            with self._lock:
+                if name not in self._models:
+                    self._load_one(name)
+        return self._models[name]
+
+    def features(self, name):
+        features = self.specs[name].get('features')
+        if features is None:
+            features = list(self.get(name).feature_names_in_)
+        return features
+
+    def predict_proba(self, name, features):
+        """
+        features - DataFrame from feature_matrix() or array (n_patients, n_features)
+        returns array (n_patients, n_classes) of probabilities
+        """
+        return self.get(name).predict_proba(features)
+
+    def predict_profiles(self, name, profile):
+        """
+        profile - 2nd result of prepare_data() or prepare_cohort()
+        returns DataFrame of probabilities indexed like feature_matrix()
+        """
+        data = feature_matrix(profile, self.features(name))
+        proba = self.predict_proba(name, data)
+        return pd.DataFrame(proba, index = data.index, columns = self.get(name).classes_)
@@ -0,0 +1,308 @@
+'''
+Upload processing stages that do not depend on Dash: decode, parse,
+analyse, predict and render the main figure.
+
+Results are plain data (DataFrames, dicts, bytes), so they can be
+computed in worker processes and turned into a layout afterwards.
+'''
+
+import base64
+import datetime
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bio_df_processing as helper
+import get_main_figure as gmf
+import ingest
+import metrics
+from result_cache import ResultCache, make_key, user_cache_dir
+
+
+# number of worker processes for multi-file uploads, 0 or 1 - process in the calling thread
+UPLOAD_WORKERS = int(os.environ.get('BIO_UPLOAD_WORKERS', os.cpu_count() or 1))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# processed uploads by content hash; the disk tier (BIO_RESULT_CACHE_DIR, a private
+# directory of the user by default) lets every gunicorn worker answer table pages and
+# report downloads of an upload processed by another one, '' keeps results in memory only
+result_cache = ResultCache(
+    max_bytes = int(os.environ.get('BIO_RESULT_CACHE_BYTES', 256 * 2**20)),
+    directory = os.environ.get('BIO_RESULT_CACHE_DIR', user_cache_dir('results')) or None,
+    max_disk_bytes = int(os.environ.get('BIO_RESULT_CACHE_DISK_BYTES', 2**30)))
+
+
+def cache_hits():
+    stats = result_cache.stats()
+    return {('result', 'memory') : stats['memory_hits'],
+            ('result', 'disk') : stats['disk_hits'],
+            ('figure', 'memory') : gmf.figure_cache.hits}
+
+
+def cache_misses():
+    return {('result',) : result_cache.stats()['misses'],
+            ('figure',) : gmf.figure_cache.misses}
+
+
+metrics.register(metrics.CallbackMetric('bio_cache_hits_total', 'Cache hits.', cache_hits,
+                                        ['cache', 'tier'], kind = 'counter'))
+metrics.register(metrics.CallbackMetric('bio_cache_misses_total', 'Cache misses.', cache_misses,
+                                        ['cache'], kind = 'counter'))
+
+
+def decode_contents(contents):
+    """
+    contents - dcc.Upload data URI
+    """
+    content_type, content_string = contents.split(',')
+    return base64.b64decode(content_string)
+
+
+def analysis_date(timestamp = None):
+    """
+    the date recorded with a result (of timestamp, today by default),
+    patients without a sample date are aged on it
+    """
+    return datetime.date.fromtimestamp(time.time() if timestamp is None else timestamp).isoformat()
+
+
+def result_date(decoded, filename, on = None):
+    """
+    on (analysis_date() by default) if the result of the file depends on it, None otherwise,
+    see bio_df_processing.age_date(); the file is parsed here only when ranges are stratified
+    """
+    if helper.range_strata() is None:
+        return None
+    return helper.age_date(ingest.read_table(decoded, filename), on or analysis_date())
+
+
+def analyse_bytes(decoded, engine = 'png', filename = None, progress = None, on = None):
+    """
+    decoded - content of an uploaded table: Excel, CSV, TSV or Parquet
+    returns dict with prepare_data() results, predictions, the rendered main figure,
+    the date of the ages ('date') and the stage durations ('timings', observed by the caller)
+
+    progress - called with the name of every stage before it starts
+    on - result_date() of the file, None when the ages do not change the result (today)
+    """
+    if progress is None:
+        progress = lambda stage: None
+
+    with metrics.collect() as timings:
+        progress('parse')
+        with metrics.stage('parse'):
+            df = ingest.read_table(decoded, filename)
+
+        progress('analyse')
+        info, profile, groups_content = helper.prepare_data(df, on)
+
+        progress('models')
+        with metrics.stage('models'):
+            desease_cvd = helper.desease_prediction_cvd(profile)
+            desease = helper.desease_prediction(profile)
+            desease_lc = helper.desease_prediction_lc(profile)
+
+        part_dis = gmf.get_part_dis(desease_cvd, desease_lc)
+
+        progress('render')
+        with metrics.stage('render'):
+            figure = gmf.render(profile, part_dis, engine)
+
+    return {'info' : info,
+            'profile' : profile,
+            'groups_content' : groups_content,
+            'desease_cvd' : desease_cvd,
+            'desease' : desease,
+            'desease_lc' : desease_lc,
+            'part_dis' : part_dis,
+            'figure' : figure,
+            'date' : on,
+            'timings' : timings}
+
+
+def decode_upload(contents):
+    """
+    decode_contents() timed and counted in the upload size histogram
+    """
+    with metrics.stage('decode'):
+        decoded = decode_contents(contents)
+    metrics.upload_bytes.observe(len(decoded))
+    return decoded
+
+
+def with_keys(result, key, decoded):
+    """
+    every returned result carries its cache key as 'key' (report id)
+    and its content_key() as 'visit' (history.py)
+    """
+    result['key'] = key
+    result['visit'] = content_key(decoded, result['date'])
+    return result
+
+
+def record_result(key, decoded, result, error):
+    """
+    freshly computed result: observe its stage timings and cache it
+    """
+    if error is not None:
+        metrics.upload_errors.inc()
+        return
+    with_keys(result, key, decoded)
+    metrics.observe_stages(result['timings'])
+    result_cache.put(key, result)
+
+
+def content_key(decoded, on = None):
+    """
+    the same file gives a new key once range tables or models change,
+    on - result_date(): a file whose result does not depend on the day keeps its key
+    """
+    versions = [helper.range_registry.version(), helper.model_registry.version()]
+    return make_key(decoded, versions + ([on] if on else []))
+
+
+def result_key(decoded, engine, on = None):
+    """
+    content_key() of the file drawn with the figure engine
+    """
+    versions = [helper.range_registry.version(), helper.model_registry.version()]
+    return make_key(decoded, versions + ([on] if on else []) + [engine])
+
+
+def analyse_decoded(decoded, filename, engine = 'png', on = None):
+    """
+    never raises: returns (result, None) or (None, error message)
+    """
+    try:
+        return analyse_bytes(decoded, engine, filename, on = on), None
+    except Exception as e:
+        return None, f'{filename}: {e!r}'
+
+
+def analyse_with_progress(decoded, filename, engine = 'png', progress = None, on = None):
+    """
+    analyse_bytes() for the job queue: served from result_cache when possible,
+    raises on errors
+    """
+    metrics.uploads.inc()
+    metrics.upload_bytes.observe(len(decoded))
+    on = result_date(decoded, filename, on)
+    key = result_key(decoded, engine, on)
+    result = result_cache.get(key)
+    if result is not None:
+        return with_keys(result, key, decoded)
+    try:
+        result = analyse_bytes(decoded, engine, filename, progress, on)
+    except Exception:
+        metrics.upload_errors.inc()
+        raise
+    record_result(key, decoded, result, None)
+    return result
+
+
+def analyse_contents(contents, filename, engine = 'png'):
+    """
+    never raises: returns (result, None) or (None, error message),
+    files seen before are served from result_cache
+    """
+    metrics.uploads.inc()
+    try:
+        decoded = decode_upload(contents)
+        on = result_date(decoded, filename)
+        key = result_key(decoded, engine, on)
+    except Exception as e:
+        metrics.upload_errors.inc()
+        return None, f'{filename}: {e!r}'
+
+    result = result_cache.get(key)
+    if result is not None:
+        return with_keys(result, key, decoded), None
+
+    result, error = analyse_decoded(decoded, filename, engine, on)
+    record_result(key, decoded, result, error)
+    return result, error
+
+
+def warm_up():
+    helper.range_registry.table()
+    helper.range_arrays()
+    helper.model_registry.load()
+    # the first matplotlib draw builds the font cache
+    gmf.engines['png'][0]([0.0] * len(gmf.groups2), gmf.default_part_dis)
+
+
+def new_pool(workers):
+    """
+    process pool with warmed up workers
+    """
+    # spawn: forking a multi-threaded server process may copy held locks
+    return ProcessPoolExecutor(max_workers = workers,
+                               mp_context = multiprocessing.get_context('spawn'),
+                               initializer = warm_up)
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = new_pool(UPLOAD_WORKERS)
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures = True)
+            _pool = None
+
+
+def analyse_uploads(list_of_contents, list_of_names, engine = 'png'):
+    """
+    processes every uploaded file, several files in parallel in the process pool
+
+    returns list of (result, error) in the order of list_of_contents
+    """
+    uploads = list(zip(list_of_contents, list_of_names))
+    if UPLOAD_WORKERS < 2 or len(uploads) < 2:
+        return [analyse_contents(c, n, engine) for c, n in uploads]
+
+    # cached files are answered here, only the rest goes to the pool
+    results = [None] * len(uploads)
+    pending = []
+    today = analysis_date()
+    for i, (contents, name) in enumerate(uploads):
+        metrics.uploads.inc()
+        try:
+            decoded = decode_upload(contents)
+            on = result_date(decoded, name, today)
+            key = result_key(decoded, engine, on)
+        except Exception as e:
+            metrics.upload_errors.inc()
+            results[i] = (None, f'{name}: {e!r}')
+            continue
+        result = result_cache.get(key)
+        if result is not None:
+            results[i] = (with_keys(result, key, decoded), None)
+        else:
+            pending.append((i, key, decoded, get_pool().submit(analyse_decoded, decoded, name, engine, on)))
+
+    broken = False
+    for i, key, decoded, future in pending:
+        try:
+            results[i] = future.result()
+        except Exception as e:
+            # the worker process itself died, other files are still reported
+            broken = broken or isinstance(e, BrokenProcessPool)
+            results[i] = (None, f'{uploads[i][1]}: {e!r}')
+            metrics.upload_errors.inc()
+            continue
+        record_result(key, decoded, *results[i])
+    if broken:
+        shutdown_pool()
+    return results
@@ -0,0 +1,223 @@
+'''
+Reference range registry.
+
+All *_range.xlsx tables are parsed once into a single table indexed by the
+stripped metabolite name. Files are re-read only when their content changes.
+
+A range file may stratify bounds with the optional columns 'Пол'
+(Мужской / Женский) and 'Возраст от' / 'Возраст до' (years, [from, to)).
+Rows with all three empty are the global bounds of table(), the other rows
+are returned by strata() and looked up per patient with StratifiedRanges.
+'''
+
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+range_columns = ['Нижняя граница', 'Верхняя граница']
+strata_columns = ['Пол', 'Возраст от', 'Возраст до']
+
+# ages are looked up as key * AGE_SPAN + age, so ages must stay below it
+AGE_SPAN = 1000
+
+
+def file_signature(fname):
+    st = os.stat(fname)
+    return st.st_mtime_ns, st.st_size
+
+
+class RangeRegistry:
+    """
+    group_files - dict: {'group name' : range file name}
+    """
+
+    def __init__(self, group_files):
+        self.group_files = dict(group_files)
+        self.reloads = 0
+        self.hits = 0
+        self._table = None
+        self._groups = {}
+        self._strata = None
+        # fname -> (stat signature, sha256 of the content)
+        self._signatures = {}
+        self._lock = threading.Lock()
+
+    def _read(self):
+        frames = []
+        signatures = {}
+        for group_name, fname in self.group_files.items():
+            signature = file_signature(fname)
+            with open(fname, 'rb') as f:
+                content = f.read()
+            signatures[fname] = (signature, hashlib.sha256(content).hexdigest())
+
+            range_df = pd.read_excel(io.BytesIO(content), index_col = 'Метаболит')
+            range_df.index = range_df.index.str.strip()
+            range_df = range_df.reindex(columns = range_columns + strata_columns).copy()
+            range_df['Группа'] = group_name
+            frames.append(range_df)
+
+        rows = pd.concat(frames)
+        stratified = rows[strata_columns].notna().any(axis = 1)
+        strata = rows[stratified].copy()
+        table = rows.loc[~stratified, range_columns + ['Группа']]
+        # metabolites with stratified bounds only still belong to their group
+        only_strata = strata[~strata.index.isin(table.index)].groupby(level = 0, sort = False)['Группа'].first()
+        table = pd.concat([table, pd.DataFrame({'Группа' : only_strata}).reindex(columns = table.columns)])
+
+        groups = {grp : table.loc[table['Группа'] == grp, range_columns]
+                  for grp in self.group_files}
+        return table, groups, strata, signatures
+
+    def _is_stale(self):
+        if self._table is None:
+            return True
+
+        for fname in self.group_files.values():
+            signature = file_signature(fname)
+            known_signature, known_digest = self._signatures[fname]
+            if signature == known_signature:
+                continue
+            # file was touched, reload only if the content is really different
+            with open(fname, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            if digest != known_digest:
+                return True
+            self._signatures[fname] = (signature, known_digest)
+
+        return False
+
+    def _refresh(self, force = False, count_hit = True):
+        if force or self._is_stale():
+            self._table, self._groups, self._strata, self._signatures = self._read()
+            self.reloads += 1
+        elif count_hit:
+            self.hits += 1
+
+    def load(self):
+        """
+        (re)reads all range files unconditionally
+        """
+        with self._lock:
+            self._refresh(force = True)
+            return self._table
+
+    def table(self):
+        """
+        returns the combined range table: 'Нижняя граница', 'Верхняя граница', 'Группа'
+        """
+        with self._lock:
+            self._refresh()
+            return self._table
+
+    def strata(self):
+        """
+        returns the stratified rows: 'Нижняя граница', 'Верхняя граница', 'Пол',
+        'Возраст от', 'Возраст до', 'Группа' indexed by metabolite (empty without strata)
+        """
+        with self._lock:
+            self._refresh()
+            return self._strata
+
+    def group(self, group_name):
+        """
+        returns lower/upper bounds of one group indexed by metabolite
+        """
+        with self._lock:
+            self._refresh()
+            return self._groups[group_name]
+
+    def version(self):
+        """
+        hash of the content of all range files
+        """
+        with self._lock:
+            self._refresh(count_hit = False)
+            digests = [self._signatures[fname][1] for fname in self.group_files.values()]
+        return hashlib.sha256(''.join(digests).encode('ascii')).hexdigest()
+
+    def stats(self):
+        return {'reloads' : self.reloads, 'hits' : self.hits}
+
+
+def sex_code(values):
+    """
+    'Мужской', 'муж', 'М', 'male' -> 1, 'Женский', 'Ж', 'female' -> 2, anything else -> 0
+    """
+    codes = []
+    for value in values:
+        value = str(value).strip().lower() if pd.notna(value) else ''
+        codes.append(1 if value.startswith(('м', 'm')) else 2 if value.startswith(('ж', 'f', 'w')) else 0)
+    return np.array(codes, dtype = int)
+
+
+class StratifiedRanges:
+    """
+    interval lookup of stratified bounds
+    metabolites, sex, age_from, age_to, lower, upper - one item per stratified row:
+    metabolite id, sex code (0 - any sex) and the age interval [from, to), NaN - open
+
+    every (metabolite, sex) pair has sorted, non-overlapping age intervals, so
+    the row of a patient x metabolite cell is found by one searchsorted
+    """
+
+    def __init__(self, metabolites, sex, age_from, age_to, lower, upper):
+        # sex codes: 0 - any, 1 - male, 2 - female, see sex_code()
+        keys = np.asarray(metabolites, dtype = int) * 3 + np.asarray(sex, dtype = int)
+        age_from = np.nan_to_num(np.asarray(age_from, dtype = float), nan = -1.0)
+        age_to = np.nan_to_num(np.asarray(age_to, dtype = float), nan = np.inf)
+        if ((age_from >= AGE_SPAN - 1) | (age_to <= age_from)).any():
+            raise ValueError('every age band needs Возраст от < Возраст до < 999')
+
+        order = np.lexsort((age_from, keys))
+        self.keys = keys[order]
+        self.age_from = age_from[order]
+        self.age_to = age_to[order]
+        self.lower = np.asarray(lower, dtype = float)[order]
+        self.upper = np.asarray(upper, dtype = float)[order]
+
+        same = self.keys[1:] == self.keys[:-1]
+        if (same & (self.age_from[1:] < self.age_to[:-1])).any():
+            overlapping = np.flatnonzero(same & (self.age_from[1:] < self.age_to[:-1]))
+            raise ValueError(f'overlapping age bands for metabolite ids {sorted(set(self.keys[overlapping] // 3))}')
+        self.starts = self.keys * AGE_SPAN + self.age_from
+
+    def _find(self, keys, age):
+        """
+        returns row of every query (-1 - no row covers it)
+        """
+        query = keys * AGE_SPAN + np.where(np.isnan(age), -1.0, np.clip(age, -1, AGE_SPAN - 1))
+        pos = np.searchsorted(self.starts, query, side = 'right') - 1
+        candidate = np.maximum(pos, 0)
+        # unknown age only matches rows without age limits
+        inside = np.where(np.isnan(age),
+                          (self.age_from[candidate] == -1) & np.isinf(self.age_to[candidate]),
+                          age < self.age_to[candidate])
+        found = (pos >= 0) & (self.keys[candidate] == keys) & inside
+        return np.where(found, candidate, -1)
+
+    def lookup(self, metabolites, sex, age):
+        """
+        metabolites, sex, age - arrays of metabolite id, sex code and age in years (NaN - unknown),
+        one item per patient x metabolite cell
+
+        returns lower, upper (NaN where no stratum applies) and the boolean found mask;
+        rows of the patient's sex win over rows for any sex
+        """
+        metabolites = np.asarray(metabolites, dtype = int)
+        sex = np.asarray(sex, dtype = int)
+        age = np.asarray(age, dtype = float)
+        if not len(self.keys):
+            empty = np.full(len(metabolites), np.nan)
+            return empty, empty.copy(), np.zeros(len(metabolites), dtype = bool)
+
+        row = self._find(metabolites * 3 + sex, age)
+        row = np.where(row < 0, self._find(metabolites * 3, age), row)
+        found = (row >= 0) & (metabolites >= 0)
+        row = np.maximum(row, 0)
+        return np.where(found, self.lower[row], np.nan), np.where(found, self.upper[row], np.nan), found
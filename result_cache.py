@@ -0,0 +1,192 @@
+'''
+Content-addressed cache of processed uploads.
+
+Results are stored pickled: in a size-bounded in-memory LRU and,
+optionally, in a directory on disk shared by all worker processes of the
+user (user_cache_dir() by default). The pickles are only trusted because
+the directory is private: private_directory() creates it with mode 0700
+and refuses one owned by another user or open to others.
+'''
+
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def make_key(content, versions = ()):
+    """
+    content - uploaded file bytes
+    versions - everything else the result depends on (range tables, models, ...)
+    """
+    h = hashlib.sha256(content)
+    for version in versions:
+        h.update(b'\0' + str(version).encode('utf8'))
+    return h.hexdigest()
+
+
+def user_cache_dir(name):
+    """
+    $XDG_CACHE_HOME/bio/<name> (~/.cache/bio/<name>), a directory of the user running the app
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'bio', name)
+
+
+def user_data_dir(name):
+    """
+    $XDG_DATA_HOME/bio/<name> (~/.local/share/bio/<name>), data kept across restarts
+    """
+    base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, 'bio', name)
+
+
+def private_directory(path):
+    """
+    creates path with mode 0700; raises PermissionError when it already exists
+    but belongs to another user or is open to others
+    """
+    os.makedirs(path, mode = 0o700, exist_ok = True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'{path} must belong to uid {os.getuid()} with mode 0700, '
+                              f'it has uid {st.st_uid} and mode {stat.S_IMODE(st.st_mode):o}')
+    return path
+
+
+class ResultCache:
+    """
+    max_bytes - memory budget for pickled results
+    directory - on-disk tier (see private_directory()), None to keep results in memory only
+    max_disk_bytes - disk budget, the oldest files are removed first
+    """
+
+    def __init__(self, max_bytes = 256 * 2**20, directory = None, max_disk_bytes = 2 * 2**30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._checked = False
+
+    def _disk_ready(self, create):
+        """
+        the directory is checked on first use, not when the cache is created at import;
+        create - make it when missing (put), a read of a missing directory is a miss
+        """
+        if self.directory is None:
+            return False
+        if not self._checked:
+            if not create and not os.path.isdir(self.directory):
+                return False
+            private_directory(self.directory)
+            self._checked = True
+        return True
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def _remember(self, key, data):
+        # caller holds the lock
+        if key in self._items:
+            self._size -= len(self._items.pop(key))
+        if len(data) > self.max_bytes:
+            return
+        self._items[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._items.popitem(last = False)
+            self._size -= len(evicted)
+
+    def _read_disk(self, key):
+        if not self._disk_ready(create = False):
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            # keep recently used files away from eviction
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write_disk(self, key, data):
+        if not self._disk_ready(create = True):
+            return
+        # write + rename, other processes never see a half written file
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        self._prune_disk()
+
+    def _prune_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def get(self, key):
+        """
+        returns the cached result or None
+        """
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.memory_hits += 1
+                return pickle.loads(data)
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, data)
+        return pickle.loads(data)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                return True
+        return self._disk_ready(create = False) and os.path.exists(self._path(key))
+
+    def put(self, key, result):
+        data = pickle.dumps(result, protocol = pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._remember(key, data)
+        self._write_disk(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'memory_hits' : self.memory_hits,
+                    'disk_hits' : self.disk_hits,
+                    'misses' : self.misses,
+                    'entries' : len(self._items),
+                    'bytes' : self._size}
@@ -0,0 +1,56 @@
+'''
+Per-session server-side store of computed reports.
+
+The report layout only carries the first page of every metabolite table,
+further pages and filtered views are cut from the profile kept here, so
+the browser never receives the whole profile.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionStore:
+    """
+    max_entries - reports kept over all sessions, least recently used are dropped
+    ttl - seconds a report stays after its last use
+    """
+
+    def __init__(self, max_entries = 512, ttl = 2 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # caller holds the lock
+        while self._items:
+            key, (used, _) = next(iter(self._items.items()))
+            if now - used <= self.ttl and len(self._items) <= self.max_entries:
+                break
+            del self._items[key]
+
+    def put(self, session, report, value):
+        now = time.monotonic()
+        with self._lock:
+            self._items[(session, report)] = (now, value)
+            self._items.move_to_end((session, report))
+            self._expire(now)
+
+    def get(self, session, report):
+        """
+        returns the stored value or None
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            item = self._items.get((session, report))
+            if item is None:
+                return None
+            self._items[(session, report)] = (now, item[1])
+            self._items.move_to_end((session, report))
+            return item[1]
+
+    def __len__(self):
+        return len(self._items)
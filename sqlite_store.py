@@ -0,0 +1,62 @@
+'''
+SQLite database shared by the threads and processes of the app
+(jobs.JobQueue, history.ProfileHistory).
+
+Every thread of every process has its own connection, opened on first use
+(not at import) in autocommit mode; writes are explicit transactions:
+
+    with store._transaction() as db:
+        db.execute(...)
+
+A private store (patient data, pickles read back by the app) lives in a
+directory of the user only (result_cache.private_directory()) and its
+file is created with mode 0600.
+'''
+
+import contextlib
+import os
+import sqlite3
+import threading
+
+from result_cache import private_directory
+
+
+class SQLiteStore:
+    """
+    path - database file, schema - SQL script run on every new connection
+    """
+
+    schema = ''
+    private = False
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.private:
+            private_directory(os.path.dirname(os.path.abspath(self.path)))
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+        db = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+        db.execute('pragma journal_mode = wal')
+        db.executescript(self.schema)
+        return db
+
+    @property
+    def db(self):
+        # sqlite connections must not cross threads or forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.db = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self.db
+        db.execute('begin immediate')
+        try:
+            yield db
+        except BaseException:
+            db.execute('rollback')
+            raise
+        db.execute('commit')
@@ -0,0 +1,39 @@
+'''
+Patient ages are computed on a fixed date: the sample date where the
+table has one, the date recorded with the result otherwise.
+'''
+
+import numpy as np
+import pandas as pd
+
+import bio_df_processing as helper
+
+
+def info_frame(sample_dates = None):
+    info = pd.DataFrame({'ФИО' : ['А', 'Б'], 'Дата рождения' : ['1 января 1980 года', '01.07.1990'],
+                         'Пол' : ['Мужской', 'Женский'], 'Номер' : [1, 2], 'Объект' : ['Плазма крови'] * 2})
+    if sample_dates is not None:
+        info['Дата забора'] = sample_dates
+    return info
+
+
+def test_age_on_the_given_date():
+    info = info_frame()
+    ages = helper.patient_age(info['Дата рождения'], helper.reference_dates(info, '2020-01-01'))
+    np.testing.assert_allclose(ages, [40.0, 29.5], atol = 0.01)
+
+
+def test_sample_date_wins_where_given():
+    info = info_frame(['01.01.2000', None])
+    ages = helper.patient_age(info['Дата рождения'], helper.reference_dates(info, '2020-01-01'))
+    np.testing.assert_allclose(ages, [20.0, 29.5], atol = 0.01)
+
+
+def test_date_matters_only_for_stratified_ranges(monkeypatch):
+    info = info_frame()
+    monkeypatch.setattr(helper, 'range_strata', lambda: None)
+    assert helper.age_date(info, '2020-01-01') is None
+    monkeypatch.setattr(helper, 'range_strata', lambda: object())
+    assert helper.age_date(info, '2020-01-01') == '2020-01-01'
+    assert helper.age_date(info_frame(['01.01.2000', None]), '2020-01-01') == '2020-01-01'
+    assert helper.age_date(info_frame(['01.01.2000', '1 марта 2001 года']), '2020-01-01') is None
@@ -0,0 +1,73 @@
+'''
+add_analyse() must give exactly the verdicts and deviation columns of the
+former row-wise implementation, kept here as the reference.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bio_df_processing as helper
+
+
+def make_result_column(x):
+    if x[0] < x[2] < x[1]:
+        return 'Норма'
+    if x[2] / 5 < x[1] < x[2]:
+        return 'Риск повышения'
+    if x[2] * 5 > x[0] > x[2]:
+        return 'Риск понижения'
+    if x[2] / 5 > x[1]:
+        return 'Повышено'
+    else:
+        return 'Понижено'
+
+
+def row_wise_analyse(df):
+    existed_cols = df.columns.to_list()
+    df = df.copy()
+    df['Вывод'] = df[['Нижняя граница', 'Верхняя граница','Результат']].apply(make_result_column, axis=1, raw=True)
+
+    rel_up = df['Результат'] / df['Верхняя граница']
+    df['Риск повышения'] = rel_up.loc[rel_up.between(1, 5)]
+    df['Повышено'] = rel_up.loc[rel_up.between(5, np.inf)]
+    df['Норма'] = rel_up.loc[rel_up.between(0, 1)]
+    rel_down = df['Нижняя граница'] / df['Результат']
+    df['Риск понижения'] = rel_down.loc[rel_down.between(1, 5)]
+    df['Понижено'] = rel_down.loc[rel_down.between(5, np.inf)]
+
+    new_cols = ['Вывод', 'Понижено', 'Риск понижения', 'Норма', 'Риск повышения', 'Повышено']
+    return df[existed_cols + new_cols]
+
+
+def boundary_frame():
+    lower, upper = 10.0, 100.0
+    results = [lower, upper, upper * 5, lower / 5, upper * 5 + 1e-9, lower / 5 - 1e-9,
+               50.0, 1.0, 0.0, -3.0, np.nan, np.inf, upper * 2, lower / 2]
+    rows = [(lower, upper, x) for x in results]
+    # missing bounds, zero and equal bounds
+    rows += [(np.nan, np.nan, 5.0), (np.nan, upper, 50.0), (lower, np.nan, 50.0),
+             (0.0, upper, 0.0), (0.0, 0.0, 0.0), (lower, lower, lower), (np.nan, np.nan, np.nan)]
+    index = [f'm{i}' for i in range(len(rows))]
+    return pd.DataFrame(rows, index = index, columns = ['Нижняя граница', 'Верхняя граница', 'Результат'])
+
+
+def test_matches_row_wise_on_boundaries():
+    df = boundary_frame()
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        expected = row_wise_analyse(df)
+    pd.testing.assert_frame_equal(helper.add_analyse(df), expected, check_dtype = False)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_row_wise_on_random_values(seed):
+    rng = np.random.default_rng(seed)
+    n = 500
+    lower = rng.uniform(0, 50, n)
+    upper = lower + rng.uniform(0, 200, n)
+    result = upper * rng.lognormal(0, 1.5, n)
+    result[rng.random(n) < 0.1] = np.nan
+    df = pd.DataFrame({'Нижняя граница' : lower, 'Верхняя граница' : upper, 'Результат' : result})
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        expected = row_wise_analyse(df)
+    pd.testing.assert_frame_equal(helper.add_analyse(df), expected, check_dtype = False)
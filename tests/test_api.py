@@ -0,0 +1,28 @@
+'''
+A model the profile has no values of all features for is not scored, the
+result says which features it misses.
+'''
+
+import os
+
+import pandas as pd
+
+import api
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TEST_test.xlsx')
+
+
+def test_unscored_models_name_their_missing_features():
+    result, = api.score(pd.read_excel(TEMPLATE))
+    assert result['models']
+    for name, error in result['model_errors'].items():
+        assert name not in result['models']
+        assert error.startswith('missing features: ')
+
+
+def test_template_columns_resolve_model_aliases():
+    result, = api.score(pd.read_excel(TEMPLATE))
+    missing = ' '.join(result['model_errors'].values())
+    for alias in ("'C8'", "'C8-1'", "'C14-OH'", "'Arginine'"):
+        assert alias not in missing
@@ -0,0 +1,163 @@
+'''
+Concurrency check for the multi-threaded serving setup.
+
+Uploads different synthetic patients in parallel through the Dash upload
+callback and verifies that every report contains only its own patient's
+info and metabolite values.
+
+    python -m pytest tests/test_concurrency.py                  # in-process, Flask test client
+    BIO_CHECK_URL=http://127.0.0.1:8050 python -m pytest tests/test_concurrency.py   # running server
+
+In-process the history, job database and caches are kept in tmp_path,
+the synthetic patients never reach the stores of the user.
+'''
+
+import base64
+import io
+import json
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bio_df_processing as helper
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TEST_test.xlsx')
+
+PATIENTS = 12
+THREADS = 6
+
+
+def make_patients(n, seed = 0, template = TEMPLATE):
+    """
+    returns list of one-row workbooks (DataFrames) with distinct values
+    """
+    base = pd.read_excel(template)
+    metabolites = [x for x in base.columns if x not in helper.info_columns]
+    rng = np.random.default_rng(seed)
+    patients = []
+    for i in range(n):
+        df = base.copy()
+        df['ФИО'] = f'Пациент {i}'
+        df['Номер'] = 100000 + i
+        df[metabolites] = base[metabolites].to_numpy(dtype = float) * rng.lognormal(0, 0.7, len(metabolites))
+        patients.append(df)
+    return patients
+
+
+def upload_body(df, filename, session = 'check'):
+    buf = io.BytesIO()
+    df.to_excel(buf, index = False)
+    contents = ('data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,'
+                + base64.b64encode(buf.getvalue()).decode('ascii'))
+    return {'output' : 'output-data-upload.children',
+            'outputs' : {'id' : 'output-data-upload', 'property' : 'children'},
+            'inputs' : [{'id' : 'upload-data', 'property' : 'contents', 'value' : [contents]}],
+            'changedPropIds' : ['upload-data.contents'],
+            'state' : [{'id' : 'upload-data', 'property' : 'filename', 'value' : [filename]},
+                       {'id' : 'upload-data', 'property' : 'last_modified', 'value' : [0]},
+                       {'id' : 'session-id', 'property' : 'data', 'value' : session}]}
+
+
+def tables(node, found = None):
+    """
+    collects DataTable data from a serialized layout: {'table id' : [records, ...]}
+    """
+    if found is None:
+        found = {}
+    if isinstance(node, dict):
+        props = node.get('props', {})
+        if node.get('type') == 'DataTable':
+            # metabolite tables have pattern-matching ids {'type' : ..., 'report' : ..., 'group' : ...}
+            table_id = props.get('id')
+            if isinstance(table_id, dict):
+                table_id = table_id['type']
+            found.setdefault(table_id, []).append(props.get('data'))
+        for value in node.values():
+            tables(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            tables(value, found)
+    return found
+
+
+def check_report(response, df):
+    """
+    returns list of problems, empty if the report belongs to df's patient
+    """
+    found = tables(response)
+    problems = []
+
+    info = found.get('patient_info_table', [[]])[0]
+    if len(info) != 1 or info[0]['ФИО'] != df['ФИО'].iloc[0] or info[0]['Номер'] != df['Номер'].iloc[0]:
+        problems.append(f'patient info {info} does not belong to {df["ФИО"].iloc[0]}')
+
+    _, profile, _ = helper.prepare_data(df)
+    for records in found.get('metabolit-table', []):
+        for record in records:
+            expected = profile.loc[record['Метаболит'], 'Результат']
+            if not np.isclose(record['Результат'], expected):
+                problems.append(f'{record["Метаболит"]}: {record["Результат"]} != {expected}')
+    if not found.get('metabolit-table'):
+        problems.append('no metabolite tables in the report')
+    return problems
+
+
+def local_poster(tmp_path, monkeypatch):
+    stores = {'BIO_HISTORY_DB' : str(tmp_path / 'history' / 'history.sqlite'),
+              'BIO_JOBS_DB' : str(tmp_path / 'jobs' / 'jobs.sqlite'),
+              'BIO_RESULT_CACHE_DIR' : str(tmp_path / 'results'),
+              'BIO_IMAGE_DIR' : str(tmp_path / 'images')}
+    for name, value in stores.items():
+        monkeypatch.setenv(name, value)
+
+    import dash_app
+    import history
+    import image_store
+    import jobs
+    import pipeline
+    from result_cache import ResultCache
+
+    # an earlier test may have imported the modules with the stores of the environment
+    monkeypatch.setattr(history, 'profile_history', history.ProfileHistory(stores['BIO_HISTORY_DB']))
+    monkeypatch.setattr(jobs, 'job_queue', jobs.JobQueue(stores['BIO_JOBS_DB']))
+    monkeypatch.setattr(pipeline, 'result_cache', ResultCache(directory = stores['BIO_RESULT_CACHE_DIR']))
+    monkeypatch.setattr(image_store, 'image_cache', ResultCache(directory = stores['BIO_IMAGE_DIR']))
+
+    client = dash_app.server.test_client()
+
+    def post(body):
+        res = client.post('/_dash-update-component', json = body)
+        return res.get_json()
+    return post
+
+
+def url_poster(url):
+    def post(body):
+        req = urllib.request.Request(url.rstrip('/') + '/_dash-update-component',
+                                     data = json.dumps(body).encode('utf8'),
+                                     headers = {'Content-Type' : 'application/json'})
+        with urllib.request.urlopen(req) as res:
+            return json.load(res)
+    return post
+
+
+@pytest.fixture
+def post(tmp_path, monkeypatch):
+    url = os.environ.get('BIO_CHECK_URL')
+    return url_poster(url) if url else local_poster(tmp_path, monkeypatch)
+
+
+def test_parallel_uploads_do_not_mix(post):
+    patients = make_patients(PATIENTS)
+    bodies = [upload_body(df, f'patient_{i}.xlsx') for i, df in enumerate(patients)]
+
+    with ThreadPoolExecutor(max_workers = THREADS) as pool:
+        responses = list(pool.map(post, bodies))
+
+    problems = {i : check_report(response, df)[:5] for i, (df, response) in enumerate(zip(patients, responses))}
+    assert not {i : x for i, x in problems.items() if x}
@@ -0,0 +1,30 @@
+'''
+CSV exports of Russian Excel: ';' separator, decimal comma, cp1251.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingest
+
+
+def sample():
+    return pd.DataFrame({'ФИО' : ['Иван Иванов'], 'Дата рождения' : ['1 января 1980 года'],
+                         'Пол' : ['Мужской'], 'Номер' : [54512], 'Объект' : ['Плазма крови'],
+                         'Глицин' : [193.558], 'Аланин' : [370.531]})
+
+
+@pytest.mark.parametrize('encoding', ['cp1251', 'utf-8', 'utf-8-sig'])
+def test_semicolon_decimal_comma(encoding):
+    content = sample().to_csv(sep = ';', decimal = ',', index = False).encode(encoding)
+    df = ingest.read_table(content, 'export.csv')
+    assert df.loc[0, 'ФИО'] == 'Иван Иванов'
+    np.testing.assert_allclose(df[['Глицин', 'Аланин']].to_numpy()[0], [193.558, 370.531])
+
+
+def test_comma_separated_cp1251():
+    content = sample().to_csv(index = False).encode('cp1251')
+    df = ingest.read_table(content, 'export.csv')
+    assert df.loc[0, 'Пол'] == 'Мужской'
+    assert df.loc[0, 'Глицин'] == 193.558
@@ -0,0 +1,39 @@
+'''
+The disk tier of ResultCache unpickles what it finds, so it only uses a
+directory that is private to the user.
+'''
+
+import os
+import stat
+
+import pytest
+
+from result_cache import ResultCache
+
+
+def test_directory_is_created_private(tmp_path):
+    directory = tmp_path / 'cache'
+    cache = ResultCache(directory = str(directory))
+    cache.put('k', {'a' : 1})
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert ResultCache(directory = str(directory)).get('k') == {'a' : 1}
+
+
+def test_directory_open_to_others_is_refused(tmp_path):
+    directory = tmp_path / 'cache'
+    directory.mkdir(mode = 0o755)
+    os.chmod(directory, 0o755)
+    cache = ResultCache(directory = str(directory))
+    with pytest.raises(PermissionError):
+        cache.get('k')
+    with pytest.raises(PermissionError):
+        cache.put('k', {'a' : 1})
+
+
+def test_directory_is_created_on_first_put(tmp_path):
+    directory = tmp_path / 'cache'
+    cache = ResultCache(directory = str(directory))
+    assert cache.get('k') is None and 'k' not in cache
+    assert not directory.exists()
+    cache.put('k', 1)
+    assert directory.is_dir()
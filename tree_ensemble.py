@@ -0,0 +1,260 @@
+'''
+Array form of the pickled tree ensembles.
+
+RandomForestClassifier and GradientBoostingClassifier models (and the
+StandardScaler in front of them) are flattened once into a few NumPy
+arrays: all trees share one node table (feature, threshold, left and right
+child, leaf values), so a batch of patients walks every tree at once, one
+tree level per step. Scoring needs neither scikit-learn nor unpickling.
+
+    python tree_ensemble.py
+
+exports every model of bio_df_processing.models to <model>.npz next to its
+pickle and checks the probabilities against scikit-learn. Run it again
+after retraining: a stale .npz is noticed by the model registry, which then
+converts the pickle in memory (with scikit-learn) on every start.
+'''
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+
+# rows scored at once, bounds the (rows, trees, outputs) leaf value array
+CHUNK_ROWS = 2048
+
+
+def file_digest(fnames):
+    """
+    sha256 of the files, None entries are skipped
+    """
+    h = hashlib.sha256()
+    for fname in fnames:
+        if fname:
+            with open(fname, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class TreeEnsemble:
+    """
+    arrays - dict of arrays, see export_model()
+
+    classes_, n_features_in_ and feature_names_in_ (if the model had it)
+    mirror the scikit-learn model
+    """
+
+    fields = ('feature', 'threshold', 'left', 'right', 'value', 'roots', 'depth',
+              'base', 'link', 'classes', 'n_features', 'feature_names', 'mean', 'scale', 'normalize', 'source')
+
+    def __init__(self, arrays):
+        self.arrays = {k : np.asarray(arrays[k]) for k in self.fields}
+        for k, v in self.arrays.items():
+            setattr(self, k, v)
+        self.depth = int(self.depth)
+        self.link = str(self.link)
+        self.normalize = bool(self.normalize)
+        self.source = str(self.source)
+        self.classes_ = self.classes
+        self.n_features_in_ = int(self.n_features)
+        if self.feature_names.size:
+            self.feature_names_in_ = self.feature_names
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname, allow_pickle = False) as f:
+            return cls(dict(f))
+
+    def save(self, fname):
+        np.savez_compressed(fname, **self.arrays)
+
+    def transform(self, data):
+        """
+        scaler and l2 normalisation the model was trained with
+        """
+        if self.mean.size:
+            data = (data - self.mean) / self.scale
+        if self.normalize:
+            norms = np.sqrt(np.einsum('ij,ij->i', data, data))
+            norms[norms == 0] = 1
+            data = data / norms[:, None]
+        return data
+
+    def raw_predict(self, data):
+        """
+        sum of the leaf values of all trees plus base, (n_rows, n_outputs)
+        """
+        # trees compare float32 features with float64 thresholds, like scikit-learn
+        data = data.astype(np.float32)
+        rows = np.arange(len(data))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(data), len(self.roots)))
+        # leaves are their own children, so every row may take depth steps
+        for _ in range(self.depth):
+            go_left = data[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.value[nodes].sum(axis = 1) + self.base
+
+    def predict_proba(self, features):
+        """
+        features - array (n_rows, n_features) or one row
+        returns array (n_rows, n_classes) like the scikit-learn predict_proba
+        """
+        data = np.asarray(features, dtype = float)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        if data.shape[1] != self.n_features_in_:
+            raise ValueError(f'X has {data.shape[1]} features, but the model is expecting '
+                             f'{self.n_features_in_} features as input')
+        if not np.isfinite(data).all():
+            raise ValueError('Input contains NaN or infinity')
+
+        data = self.transform(data)
+        raw = np.concatenate([self.raw_predict(data[i:i + CHUNK_ROWS])
+                              for i in range(0, len(data), CHUNK_ROWS)] or [np.zeros((0, len(self.base)))])
+        if self.link == 'sigmoid':
+            proba = 1 / (1 + np.exp(-raw[:, 0]))
+            return np.column_stack([1 - proba, proba])
+        if self.link == 'softmax':
+            raw = np.exp(raw - raw.max(axis = 1, keepdims = True))
+            return raw / raw.sum(axis = 1, keepdims = True)
+        return raw
+
+
+def flatten_trees(trees, leaf_values):
+    """
+    trees - fitted scikit-learn decision trees
+    leaf_values - func(tree index, tree) -> (n_nodes, n_outputs) values added at its leaves
+
+    returns dict: node table of all trees with absolute child indices
+    """
+    parts = {k : [] for k in ('feature', 'threshold', 'left', 'right', 'value')}
+    roots = []
+    depth = 0
+    offset = 0
+    for i, tree in enumerate(trees):
+        t = tree.tree_
+        n = t.node_count
+        leaf = t.children_left == -1
+        index = np.arange(n)
+        parts['feature'].append(np.where(leaf, 0, t.feature))
+        parts['threshold'].append(np.where(leaf, 0, t.threshold))
+        parts['left'].append(np.where(leaf, index, t.children_left) + offset)
+        parts['right'].append(np.where(leaf, index, t.children_right) + offset)
+        parts['value'].append(np.where(leaf[:, None], leaf_values(i, t), 0))
+        roots.append(offset)
+        depth = max(depth, t.max_depth)
+        offset += n
+
+    res = {k : np.concatenate(v) for k, v in parts.items()}
+    res['feature'] = res['feature'].astype(np.int32)
+    res['left'] = res['left'].astype(np.int32)
+    res['right'] = res['right'].astype(np.int32)
+    res['roots'] = np.array(roots, dtype = np.int32)
+    res['depth'] = depth
+    return res
+
+
+def export_model(model, scaler = None, source = ''):
+    """
+    model - RandomForestClassifier or GradientBoostingClassifier (also inside a
+    fitted GridSearchCV), scaler - StandardScaler applied (with l2 normalisation)
+    before it or None
+
+    returns TreeEnsemble
+    """
+    model = getattr(model, 'best_estimator_', model)
+    name = type(model).__name__
+
+    if name in ('RandomForestClassifier', 'ExtraTreesClassifier'):
+        n_trees = len(model.estimators_)
+
+        def leaf_values(i, t):
+            # probabilities of the leaf averaged over the trees
+            value = t.value[:, 0, :model.n_classes_]
+            total = value.sum(axis = 1, keepdims = True)
+            return value / np.where(total == 0, 1, total) / n_trees
+
+        arrays = flatten_trees(model.estimators_, leaf_values)
+        arrays['base'] = np.zeros(model.n_classes_)
+        arrays['link'] = 'identity'
+
+    elif name == 'GradientBoostingClassifier':
+        if model.loss not in ('log_loss', 'deviance'):
+            raise ValueError(f'unsupported loss: {model.loss}')
+        n_outputs = model.estimators_.shape[1]
+        trees = model.estimators_.ravel()
+
+        def leaf_values(i, t):
+            # stage i // n_outputs adds learning_rate * leaf value to output i % n_outputs
+            value = np.zeros((t.node_count, n_outputs))
+            value[:, i % n_outputs] = model.learning_rate * t.value[:, 0, 0]
+            return value
+
+        arrays = flatten_trees(trees, leaf_values)
+        arrays['base'] = model._raw_predict_init(np.zeros((1, model.n_features_in_)))[0]
+        arrays['link'] = 'sigmoid' if n_outputs == 1 else 'softmax'
+
+    else:
+        raise ValueError(f'unsupported model: {name}')
+
+    arrays['classes'] = np.asarray(model.classes_)
+    arrays['n_features'] = model.n_features_in_
+    arrays['feature_names'] = np.asarray(getattr(model, 'feature_names_in_', []), dtype = str)
+    if scaler is not None:
+        n = scaler.n_features_in_
+        arrays['mean'] = scaler.mean_ if scaler.with_mean else np.zeros(n)
+        arrays['scale'] = scaler.scale_ if scaler.with_std else np.ones(n)
+        arrays['normalize'] = True
+    else:
+        arrays['mean'] = np.zeros(0)
+        arrays['scale'] = np.zeros(0)
+        arrays['normalize'] = False
+    arrays['source'] = source
+    return TreeEnsemble(arrays)
+
+
+def arrays_fname(spec):
+    return spec.get('arrays') or os.path.splitext(spec['model'])[0] + '.npz'
+
+
+def export_spec(spec):
+    """
+    spec - model registry entry, converts its pickles (needs scikit-learn)
+    """
+    with open(spec['model'], 'rb') as f:
+        model = pickle.load(f)
+    scaler = None
+    if spec.get('scaler'):
+        with open(spec['scaler'], 'rb') as f:
+            scaler = pickle.load(f)
+    return export_model(model, scaler, source = file_digest([spec['model'], spec.get('scaler')])), model, scaler
+
+
+def main():
+    import pandas as pd
+    from sklearn import preprocessing
+
+    import bio_df_processing as helper
+
+    rng = np.random.default_rng(0)
+    for name, spec in helper.models.items():
+        ensemble, model, scaler = export_spec(spec)
+        ensemble.save(arrays_fname(spec))
+
+        # same scores as scikit-learn on random patients around the training mean
+        if scaler is not None:
+            data = scaler.mean_ + rng.normal(size = (1000, scaler.n_features_in_)) * scaler.scale_
+            expected = model.predict_proba(preprocessing.normalize(scaler.transform(data), norm = 'l2'))
+        else:
+            data = rng.lognormal(size = (1000, model.n_features_in_))
+            expected = model.predict_proba(pd.DataFrame(data, columns = ensemble.feature_names_in_)
+                                           if ensemble.feature_names.size else data)
+        diff = np.abs(ensemble.predict_proba(data) - expected).max()
+        print(f'{name}: {len(ensemble.roots)} trees, {len(ensemble.feature)} nodes '
+              f'-> {arrays_fname(spec)}, max difference {diff:.2e}')
+
+
+if __name__ == '__main__':
+    main()